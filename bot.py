@@ -1,30 +1,71 @@
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import copy
 import datetime
+import functools
+import gc
+import gzip
+import hashlib
+import ipaddress
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
+import signal
+import socket
 import sqlite3
 import subprocess
-from typing import List
-
+import sys
+import threading
+import time
+import tracemalloc
+import unicodedata
+import weakref
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
 import discord
+import httpx
+import numpy as np
 import pytz
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 from google import genai
 from google.genai.types import (
+    Content,
     GenerateContentConfig,
     GoogleSearch,
+    HttpOptions,
     UrlContext,
     Part,
     Tool,
     ThinkingConfig,
 )
-from google.genai.errors import ServerError
+from google.genai.errors import APIError, ClientError, ServerError
 from tenacity import (
-    retry,
+    Retrying,
     stop_after_attempt,
     wait_exponential,
 )
 
+try:
+    import resource  # Unix のみ (/proc が無い環境での RSS 取得に使う)
+except ImportError:
+    resource = None
+
+PROCESS_STARTED_AT = time.monotonic()  # 起動所要時間 (time-to-ready) の計測起点
+
 load_dotenv()  # .envファイルから環境変数を読み込む
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 
@@ -55,13 +96,477 @@ FALLBACK_MIME_TYPES = {
     ".webm": "audio/webm",
 }
 
-intents = discord.Intents.default()
-intents.messages = True  # メッセージ関連のイベントを処理するために必要
-intents.message_content = True  # メッセージ内容を読み取るために必要
+# --- 省リソース運用 (lean runtime) ---
+# 応答に必要なのは TARGET_CHANNEL_IDS・メンション・コマンドのメッセージだけなので、有効にすると
+# 受け取るイベント (intents) とキャッシュを絞り、無関係なメッセージはオブジェクト化する前に捨てる。
+LEAN_RUNTIME = os.getenv("LEAN_RUNTIME", "false").lower() in ("1", "true")
+LEAN_MAX_MESSAGES = (
+    int(os.getenv("LEAN_MAX_MESSAGES", "0")) or None
+)  # 0: discord.py のメッセージキャッシュを持たない (既定の非 lean 時は 1000 件)
+
+if LEAN_RUNTIME:
+    intents = discord.Intents.none()
+    intents.guilds = True  # チャンネル・ロール (権限判定) のキャッシュに必要
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    bot_cache_options = {
+        "max_messages": LEAN_MAX_MESSAGES,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False,
+    }
+else:
+    intents = discord.Intents.default()
+    intents.messages = True  # メッセージ関連のイベントを処理するために必要
+    intents.message_content = True  # メッセージ内容を読み取るために必要
+    bot_cache_options = {}
+
+# --- シャーディング設定 ---
+# single: 従来どおり1プロセス / auto: AutoShardedBot で全シャードを1プロセスで処理
+# worker: SHARD_IDS のシャードだけを担当 / coordinator: ワーカープロセスを起動・監視する
+SHARD_MODE = os.getenv("SHARD_MODE", "single").strip().lower()
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [
+    int(shard_id)
+    for shard_id in os.getenv("SHARD_IDS", "").split(",")
+    if shard_id.strip().isdigit()
+] or None
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "2"))
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+IS_MULTI_WORKER = SHARD_MODE == "worker"
+
+if SHARD_MODE in ("auto", "worker"):
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS if SHARD_MODE == "worker" else None,
+        **bot_cache_options,
+    )
+else:
+    bot = commands.Bot(
+        command_prefix="!", intents=intents, **bot_cache_options
+    )  # コマンドのプレフィックスを'!'に設定
+
+
+# --- プロセス内メトリクス (カウンタと簡易サマリ) ---
+metrics_counters = defaultdict(int)
+metrics_summaries = {}  # name -> {"count", "sum", "max"}
+metrics_gauges = {}  # name -> 最新値 (RSS など、その時点の値を示すもの)
+metrics_lock = threading.Lock()  # Gemini 呼び出しはスレッドから記録されることがある
+
+
+def increment_metric(name, value=1):
+    with metrics_lock:
+        metrics_counters[name] += value
+
+
+def set_gauge(name, value):
+    with metrics_lock:
+        metrics_gauges[name] = value
+
+
+def observe_metric(name, value):
+    """レイテンシやトークン数などの観測値を件数・合計・最大値で集計する。"""
+    with metrics_lock:
+        summary = metrics_summaries.setdefault(
+            name, {"count": 0, "sum": 0.0, "max": 0.0}
+        )
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+
+
+def format_metrics_report():
+    with metrics_lock:
+        lines = [f"{name}: {value}" for name, value in sorted(metrics_counters.items())]
+        lines.extend(
+            f"{name}: {value}" for name, value in sorted(metrics_gauges.items())
+        )
+        for name, summary in sorted(metrics_summaries.items()):
+            average = summary["sum"] / summary["count"] if summary["count"] else 0.0
+            lines.append(
+                f"{name}: count={summary['count']} avg={average:.1f} max={summary['max']:.1f}"
+            )
+    return "\n".join(lines) if lines else "(記録されたメトリクスはありません)"
+
+
+# --- 構造化ログ (キュー経由の非同期 JSON Lines 出力) ---
+# ログ呼び出し側ではレコードをキューに積むだけで、整形と stdout への書き込みは
+# QueueListener のスレッドが行う。イベントループが出力待ちで止まらないようにするため。
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# "event:rate,..." 形式。高頻度イベントは rate (0.0〜1.0) の割合だけ出力する
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, rate in (
+        item.split(":", 1)
+        for item in os.getenv(
+            "LOG_SAMPLE_RATES", "message.received:0.2,gemini.reply:0.2"
+        ).split(",")
+        if ":" in item
+    )
+}
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# LogRecord が標準で持つ属性。これ以外 (extra で渡した値) を JSON のフィールドとして出力する
+_LOG_RECORD_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """LogRecord を1行の JSON に整形する。"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(
+                record.created, pytz.timezone("Asia/Tokyo")
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_RESERVED and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """リクエストIDを付与し、LOG_SAMPLE_RATES に従って高頻度イベントを間引く。"""
+
+    def filter(self, record):
+        # contextvars は呼び出し側のスレッド/タスクでしか読めないため、キューに積む前に付与する
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        event = getattr(record, "event", None)
+        rate = LOG_SAMPLE_RATES.get(event) if event else None
+        if (
+            rate is not None
+            and record.levelno < logging.WARNING
+            and random.random() >= rate
+        ):
+            increment_metric("logging.sampled_out")
+            return False
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯のときは待たずに捨てる (ログのためにイベントループを止めない)。"""
+
+    def prepare(self, record):
+        # 引数と例外はキューに積む前に文字列化し、リスナー側で JSON のフィールドにする
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            increment_metric("logging.dropped")
+
+
+def configure_logging():
+    """ルートロガーをキュー経由の JSON 出力に差し替え、リスナーを返す。"""
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter())
+    listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [queue_handler]
+    root_logger.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)  # 終了時にキューに残ったログを書き出す
+    return listener
+
+
+log_listener = configure_logging()
+logger = logging.getLogger("bot")
+
+
+# --- メモリ使用量の計測 (RSS の推移・自前の構造の件数・tracemalloc の差分) ---
+# 長期稼働中の増加がどのサブシステム由来かを、デバッガを繋がずに !memstats で追えるようにする。
+MEMSTATS_SAMPLE_SECONDS = float(os.getenv("MEMSTATS_SAMPLE_SECONDS", "60"))
+MEMSTATS_RSS_HISTORY = int(
+    os.getenv("MEMSTATS_RSS_HISTORY", "1440")
+)  # 保持するサンプル数 (既定で 60秒 × 1440 = 24時間)
+MEMSTATS_TRACEMALLOC = os.getenv("MEMSTATS_TRACEMALLOC", "false").lower() in (
+    "1",
+    "true",
+)  # tracemalloc は常時オーバーヘッドがあるため明示的に有効化したときだけ使う
+MEMSTATS_TRACEMALLOC_FRAMES = int(os.getenv("MEMSTATS_TRACEMALLOC_FRAMES", "1"))
+MEMSTATS_TOP_N = 10
+rss_samples = deque(maxlen=MEMSTATS_RSS_HISTORY)  # (time.time(), RSS バイト数)
+_tracemalloc_baseline = None  # 差分の基準にする前回のスナップショット
+_last_cpu_sample = None  # 前回サンプル時点のプロセス CPU 時間 (秒)
+
+
+def read_rss_bytes():
+    """現在の RSS。/proc が無い環境では (減ることのない) 最大 RSS で代用する。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def start_memory_tracing():
+    """tracemalloc を開始 (開始済みなら継続) し、現時点を差分の基準にする。"""
+    global _tracemalloc_baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(MEMSTATS_TRACEMALLOC_FRAMES)
+    _tracemalloc_baseline = _take_filtered_snapshot()
+
+
+def stop_memory_tracing():
+    global _tracemalloc_baseline
+    tracemalloc.stop()
+    _tracemalloc_baseline = None
+
+
+def _take_filtered_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+    )
+
+
+def tracemalloc_diff(key_type="lineno", limit=MEMSTATS_TOP_N):
+    """
+    前回の基準からの増加が大きい順に、確保元 (key_type: lineno / filename) を返す。
+    呼び出すたびに今回のスナップショットが次の基準になる。
+    """
+    global _tracemalloc_baseline
+    snapshot = _take_filtered_snapshot()
+    if _tracemalloc_baseline is None:
+        stats = snapshot.statistics(key_type)
+    else:
+        stats = snapshot.compare_to(_tracemalloc_baseline, key_type)
+    _tracemalloc_baseline = snapshot
+    lines = []
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        location = os.path.basename(frame.filename)
+        if key_type == "lineno":
+            location += f":{frame.lineno}"
+        lines.append(
+            f"{location} {stat.size / 1024:.0f}KiB"
+            f" ({getattr(stat, 'size_diff', 0) / 1024:+.0f}KiB) n={stat.count}"
+        )
+    return lines
+
+
+def _inline_data_size(part):
+    """履歴のパートに埋め込まれた画像・音声などのバイト数 (dict 形式の履歴にも対応)。"""
+    inline_data = (
+        part.get("inline_data")
+        if isinstance(part, dict)
+        else getattr(part, "inline_data", None)
+    )
+    data = (
+        inline_data.get("data")
+        if isinstance(inline_data, dict)
+        else getattr(inline_data, "data", None)
+    )
+    return len(data) if data else 0
+
+
+def collect_object_counts():
+    """ボット自身のセッション・キャッシュと discord.py のキャッシュの件数・概算サイズ。"""
+    counts = {}
+    with _character_runtimes_lock:
+        runtimes = list(character_runtimes.values())
+    for runtime in runtimes:
+        history = (
+            runtime.chat_session.get_history(curated=False)
+            if runtime.chat_session
+            else []
+        )
+        inline_sizes = [
+            _inline_data_size(part)
+            for content in history
+            for part in (
+                content.get("parts")
+                if isinstance(content, dict)
+                else getattr(content, "parts", None)
+            )
+            or []
+        ]
+        counts[f"session.{runtime.key}.turns"] = len(history)
+        counts[f"session.{runtime.key}.inline_parts"] = sum(
+            1 for size in inline_sizes if size
+        )
+        counts[f"session.{runtime.key}.inline_kib"] = sum(inline_sizes) // 1024
+    counts["url_cache.entries"] = len(url_content_cache)
+    counts["url_cache.chars"] = url_content_cache.total_chars
+    counts["generation_config_cache"] = build_generation_config.cache_info().currsize
+    with _memory_shards_lock:
+        shards = list(_memory_shards.values())
+    counts["memory_index.shards"] = len(shards)
+    counts["memory_index.rows"] = sum(shard.count for shard in shards)
+    counts["session_locks"] = len(_session_locks)
+    counts["grounding.in_flight"] = len(_grounding_in_flight)
+    with metrics_lock:
+        counts["metrics.series"] = (
+            len(metrics_counters) + len(metrics_summaries) + len(metrics_gauges)
+        )
+    counts["discord.guilds"] = len(bot.guilds)
+    counts["discord.users"] = len(bot.users)
+    counts["discord.members"] = sum(len(guild.members) for guild in bot.guilds)
+    counts["discord.cached_messages"] = len(bot.cached_messages)
+    counts["lean_runtime"] = int(LEAN_RUNTIME)
+    dropped, saved_ms = gateway_savings_estimate()
+    counts["gateway.dropped_messages"] = dropped
+    counts["gateway.saved_parse_ms_estimate"] = round(saved_ms, 1)
+    counts["gc.objects"] = len(gc.get_objects())
+    return counts
+
+
+def format_rss_trend(points=6):
+    """保持している RSS サンプルを等間隔に間引き、増加速度 (MiB/時) を添えて返す。"""
+    samples = list(rss_samples)
+    if not samples:
+        return "RSS: (サンプルなし)"
+    step = max(1, len(samples) // points)
+    picked = samples[::step]
+    if picked[-1] is not samples[-1]:
+        picked.append(samples[-1])
+    trend = " → ".join(
+        f"{datetime.datetime.fromtimestamp(ts, JST):%H:%M} {rss / 2**20:.0f}"
+        for ts, rss in picked
+    )
+    (first_ts, first_rss), (last_ts, last_rss) = samples[0], samples[-1]
+    hours = (last_ts - first_ts) / 3600
+    rate = f" ({(last_rss - first_rss) / 2**20 / hours:+.1f}MiB/時)" if hours else ""
+    values = [rss for _, rss in samples]
+    return (
+        f"RSS: {last_rss / 2**20:.1f}MiB (最小 {min(values) / 2**20:.0f} / 最大 {max(values) / 2**20:.0f}){rate}\n"
+        f"推移 (MiB): {trend}"
+    )
+
+
+@tasks.loop(seconds=MEMSTATS_SAMPLE_SECONDS)
+async def sample_memory_usage():
+    """RSS・CPU 使用率 (と tracemalloc 有効時は追跡中の確保量) を定期的に記録する。"""
+    global _last_cpu_sample
+    rss = read_rss_bytes()
+    if rss is None:
+        return
+    now, cpu_seconds = time.time(), time.process_time()
+    if rss_samples and _last_cpu_sample is not None:
+        # 前回のサンプルからの CPU 使用率 (1コア = 100%)
+        elapsed = now - rss_samples[-1][0]
+        if elapsed > 0:
+            set_gauge(
+                "process.cpu_percent",
+                round((cpu_seconds - _last_cpu_sample) / elapsed * 100, 1),
+            )
+    _last_cpu_sample = cpu_seconds
+    rss_samples.append((now, rss))
+    set_gauge("memory.rss_mib", round(rss / 2**20, 1))
+    set_gauge("process.cpu_seconds", round(cpu_seconds, 1))
+    if tracemalloc.is_tracing():
+        traced, peak = tracemalloc.get_traced_memory()
+        set_gauge("memory.traced_mib", round(traced / 2**20, 1))
+        set_gauge("memory.traced_peak_mib", round(peak / 2**20, 1))
+
+
+if MEMSTATS_TRACEMALLOC:
+    tracemalloc.start(MEMSTATS_TRACEMALLOC_FRAMES)
+
+
+# --- ゲートウェイでのメッセージの絞り込み (lean runtime) ---
+GATEWAY_FILTERED_EVENTS = ("MESSAGE_CREATE", "MESSAGE_UPDATE")
+
+
+def is_relevant_message_payload(data):
+    """
+    MESSAGE_CREATE / MESSAGE_UPDATE の生データが、応答・コマンド・autospeak の対象になりうるか。
+    should_respond_to_message / is_command_message と同じ条件を、Message を作る前に判定する。
+    """
+    if "guild_id" not in data:
+        return True  # DM
+    channel_id = int(data["channel_id"])
+    if channel_id in TARGET_CHANNEL_IDS or channel_id in autospeak_channel_ids:
+        # autospeak は channel.last_message_id で静かさを判定するため全メッセージが必要
+        return True
+    if (data.get("content") or "").startswith(bot.command_prefix):
+        return True
+    if data.get("mention_everyone"):
+        return True
+    self_id = bot._connection.self_id
+    return any(int(user["id"]) == self_id for user in data.get("mentions") or [])
+
+
+def install_gateway_message_filter():
+    """
+    discord.py のイベントパーサを差し替え、無関係なギルドのメッセージをオブジェクト化・
+    キャッシュ・on_message 呼び出しの前に捨てる。残したものは解析時間を計測する。
+    discord.py の非公開の属性に依存するため、想定した形でなければ何もせず False を返す
+    (requirements.txt でバージョンを固定しているが、更新時に壊れても Bot は動かし続ける)。
+    """
+    # ゲートウェイは接続時にこの dict を参照する
+    parsers = getattr(getattr(bot, "_connection", None), "parsers", None)
+    if not isinstance(parsers, dict) or not all(
+        callable(parsers.get(event)) for event in GATEWAY_FILTERED_EVENTS
+    ):
+        logger.warning(
+            f"discord.py {discord.__version__} のイベントパーサが想定と異なるため、"
+            "ゲートウェイでのメッセージの絞り込みを無効にします。"
+        )
+        return False
+    for event in GATEWAY_FILTERED_EVENTS:
+        metric_prefix = f"gateway.{event.lower()}"
+        parse = parsers[event]
+        if getattr(parse, "is_gateway_filter", False):
+            continue
+
+        def filtered_parse(data, parse=parse, metric_prefix=metric_prefix):
+            if not is_relevant_message_payload(data):
+                increment_metric(f"{metric_prefix}.dropped")
+                return
+            started_at = time.perf_counter()
+            parse(data)
+            increment_metric(f"{metric_prefix}.kept")
+            observe_metric(
+                f"{metric_prefix}.parse_us", (time.perf_counter() - started_at) * 1e6
+            )
+
+        filtered_parse.is_gateway_filter = True
+        parsers[event] = filtered_parse
+    return True
 
-bot = commands.Bot(
-    command_prefix="!", intents=intents
-)  # コマンドのプレフィックスを'!'に設定
+
+def gateway_savings_estimate():
+    """捨てたイベント数と、残したイベントの平均解析時間から見積もった節約 CPU 時間 (ミリ秒)。"""
+    dropped = 0
+    saved_ms = 0.0
+    with metrics_lock:
+        for event in GATEWAY_FILTERED_EVENTS:
+            metric_prefix = f"gateway.{event.lower()}"
+            event_dropped = metrics_counters.get(f"{metric_prefix}.dropped", 0)
+            summary = metrics_summaries.get(f"{metric_prefix}.parse_us")
+            if summary and summary["count"]:
+                saved_ms += event_dropped * summary["sum"] / summary["count"] / 1000
+            dropped += event_dropped
+    return dropped, saved_ms
 
 
 def list_available_character_keys():
@@ -98,7 +603,7 @@ async def extract_supported_attachment_parts(message: discord.Message) -> List[P
     if not message.attachments:
         return attachment_parts
 
-    print(
+    logger.debug(
         f"添付ファイル付きメッセージを受信しました from {message.author.display_name} in channel {message.channel.name}"
     )
 
@@ -118,80 +623,384 @@ async def extract_supported_attachment_parts(message: discord.Message) -> List[P
 
         try:
             file_data_bytes = await attachment.read()
-            print(
+            logger.debug(
                 f"添付ファイルをダウンロードしました: {attachment.filename} ({resolved_mime_type})"
             )
             attachment_parts.append(
                 Part.from_bytes(data=file_data_bytes, mime_type=resolved_mime_type)
             )
         except Exception as e:
-            print(f"添付ファイル処理中にエラーが発生しました: {e}")
+            logger.error(f"添付ファイル処理中にエラーが発生しました: {e}")
 
     return attachment_parts
 
 
-@bot.command(name="resetchat")
-@commands.has_permissions(administrator=True)  # 管理者権限が必要な場合
-async def resetchat(ctx):
+# --- メッセージ内URLの事前取得とキャッシュ ---
+URL_PREFETCH_ENABLED = os.getenv("URL_PREFETCH_ENABLED", "true").lower() not in (
+    "0",
+    "false",
+    "off",
+)
+URL_PREFETCH_MAX_URLS = int(os.getenv("URL_PREFETCH_MAX_URLS", "3"))
+URL_PREFETCH_MAX_CONCURRENCY = int(os.getenv("URL_PREFETCH_MAX_CONCURRENCY", "4"))
+URL_PREFETCH_TIMEOUT_SECONDS = float(os.getenv("URL_PREFETCH_TIMEOUT_SECONDS", "8"))
+URL_PREFETCH_MAX_BYTES = int(os.getenv("URL_PREFETCH_MAX_BYTES", str(1024 * 1024)))
+URL_PREFETCH_MAX_CHARS = int(
+    os.getenv("URL_PREFETCH_MAX_CHARS", "6000")
+)  # 1ページあたりモデルに渡す最大文字数
+URL_CACHE_TTL_SECONDS = float(os.getenv("URL_CACHE_TTL_SECONDS", "3600"))
+URL_CACHE_MAX_ENTRIES = int(os.getenv("URL_CACHE_MAX_ENTRIES", "256"))
+URL_CACHE_MAX_CHARS = int(os.getenv("URL_CACHE_MAX_CHARS", "2000000"))
+
+
+class UrlContentCache:
+    """URL ごとの抽出テキストを TTL 付き LRU で保持するキャッシュ (件数・総文字数で上限)。"""
+
+    def __init__(self, ttl_seconds, max_entries, max_chars):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries = OrderedDict()  # url -> (expires_at, text)
+        self._total_chars = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_chars(self):
+        return self._total_chars
+
+    def get(self, url):
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        expires_at, text = entry
+        if expires_at <= time.monotonic():
+            self._remove(url)
+            return None
+        self._entries.move_to_end(url)
+        return text
+
+    def put(self, url, text):
+        if len(text) > self.max_chars:
+            return
+        self._remove(url)
+        self._entries[url] = (time.monotonic() + self.ttl_seconds, text)
+        self._total_chars += len(text)
+        while (
+            len(self._entries) > self.max_entries or self._total_chars > self.max_chars
+        ):
+            oldest_url = next(iter(self._entries))
+            self._remove(oldest_url)
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._total_chars -= len(entry[1])
+
+
+class ReadableTextExtractor(HTMLParser):
+    """HTML から本文らしいテキストだけを取り出す簡易パーサ。"""
+
+    SKIPPED_TAGS = {
+        "script",
+        "style",
+        "noscript",
+        "svg",
+        "nav",
+        "footer",
+        "header",
+        "form",
+    }
+    BLOCK_TAGS = {
+        "p",
+        "br",
+        "div",
+        "li",
+        "h1",
+        "h2",
+        "h3",
+        "h4",
+        "tr",
+        "section",
+        "article",
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self._chunks = []
+        self._skip_depth = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag in self.BLOCK_TAGS:
+            self._chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag == "title":
+            self._in_title = False
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data.strip()
+        elif not self._skip_depth:
+            self._chunks.append(data)
+
+    def get_text(self):
+        lines = (" ".join(line.split()) for line in "".join(self._chunks).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def extract_urls(text):
+    """テキスト中の URL を出現順・重複なしで返す。"""
+    urls = []
+    for match in URL_PATTERN.finditer(text or ""):
+        url = match.group(0).rstrip(".,、。!！?？")
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def is_fetchable_url(url):
     """
-    現在のキャラクターの会話履歴をリセットします（管理者限定）。
+    ループバックやプライベートアドレスなど内部向けの URL を取得対象から外す。
+    ホスト名が内部アドレスに解決される場合は PublicAddressResolver が接続時に弾く。
     """
-    global shared_chat_session, active_character_key
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        return False
+    hostname = parts.hostname
+    if not hostname or hostname == "localhost" or hostname.endswith(".local"):
+        return False
+    try:
+        address = ipaddress.ip_address(hostname)
+    except ValueError:
+        return True
+    return address.is_global
 
-    if active_character_key is None:
-        await ctx.send("エラー：現在アクティブなキャラクターが設定されていません。")
-        return
 
-    table_name = get_history_table_name(active_character_key)
-    conn = None
+class PublicAddressResolver(AbstractResolver):
+    """
+    名前解決の結果からグローバルでないアドレス (ループバック・プライベート・リンクローカル等) を除く
+    リゾルバ。接続に使うアドレスそのものを検査するため、内部アドレスに解決される
+    ホスト名 (例: 127.0.0.1.nip.io) や DNS の再バインドでも内部には接続しない。
+    """
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        results = await self._resolver.resolve(host, port, family)
+        public = [
+            result
+            for result in results
+            if ipaddress.ip_address(result["host"].split("%")[0]).is_global
+        ]
+        if not public:
+            raise OSError(
+                f"{host} はグローバルでないアドレスに解決されたため接続しません"
+            )
+        return public
+
+    async def close(self):
+        await self._resolver.close()
+
+
+URL_PREFETCH_MAX_REDIRECTS = 5
+_url_http_session = None
+_url_fetch_semaphore = None
+
+
+async def fetch_url_text(url) -> Optional[str]:
+    """既定のフェッチャ: aiohttp で URL を取得し、読みやすいテキストに変換する。"""
+    global _url_http_session, _url_fetch_semaphore
+    if _url_http_session is None or _url_http_session.closed:
+        _url_http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=URL_PREFETCH_TIMEOUT_SECONDS),
+            connector=aiohttp.TCPConnector(
+                limit=URL_PREFETCH_MAX_CONCURRENCY, resolver=PublicAddressResolver()
+            ),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; LycaonBot/1.0)"},
+        )
+        _url_fetch_semaphore = asyncio.Semaphore(URL_PREFETCH_MAX_CONCURRENCY)
+
+    async with _url_fetch_semaphore:
+        response = await _get_without_internal_redirects(url)
+        if response is None:
+            return None
+        async with response:
+            if response.status != 200:
+                logger.info(
+                    f"URL取得: {url} がステータス {response.status} を返しました。"
+                )
+                return None
+            content_type = response.headers.get("Content-Type", "").lower()
+            if "html" not in content_type and not content_type.startswith("text/"):
+                return None
+            body = await response.content.read(URL_PREFETCH_MAX_BYTES)
+            charset = response.charset or "utf-8"
+
+    decoded = body.decode(charset, errors="replace")
+    if "html" not in content_type:
+        return decoded.strip()
+    extractor = ReadableTextExtractor()
+    extractor.feed(decoded)
+    text = extractor.get_text()
+    return f"{extractor.title}\n{text}" if extractor.title else text
+
+
+async def _get_without_internal_redirects(url):
+    """
+    リダイレクトを自動では追わず、行き先ごとに is_fetchable_url で検査しながら
+    URL_PREFETCH_MAX_REDIRECTS 回までたどる。取得できない場合は None を返す。
+    """
+    for _ in range(URL_PREFETCH_MAX_REDIRECTS + 1):
+        response = await _url_http_session.get(url, allow_redirects=False)
+        location = response.headers.get("Location")
+        if response.status not in (301, 302, 303, 307, 308) or not location:
+            return response
+        response.release()
+        url = urljoin(str(response.url), location)
+        if not is_fetchable_url(url):
+            logger.info(f"URL取得: 内部向けの {url} へのリダイレクトを拒否しました。")
+            return None
+    logger.info(f"URL取得: リダイレクトが多すぎるため {url} の取得をやめました。")
+    return None
+
+
+async def close_url_http_session():
+    if _url_http_session is not None and not _url_http_session.closed:
+        await _url_http_session.close()
+
+
+# テストではスタブに差し替えられるよう、フェッチャとキャッシュはモジュール変数で保持する
+url_fetcher: Callable[[str], Awaitable[Optional[str]]] = fetch_url_text
+url_content_cache = UrlContentCache(
+    URL_CACHE_TTL_SECONDS, URL_CACHE_MAX_ENTRIES, URL_CACHE_MAX_CHARS
+)
+
+
+def set_url_fetcher(fetcher):
+    global url_fetcher
+    url_fetcher = fetcher
+
+
+def set_url_content_cache(cache):
+    global url_content_cache
+    url_content_cache = cache
+
+
+async def _get_url_text(url):
+    cached = url_content_cache.get(url)
+    if cached is not None:
+        increment_metric("url_prefetch.cache_hits")
+        return cached
+    increment_metric("url_prefetch.cache_misses")
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        text = await url_fetcher(url)
+    except Exception as e:
+        logger.error(f"URL取得中にエラーが発生しました ({url}): {e}")
+        increment_metric("url_prefetch.errors")
+        return None
+    if not text:
+        return None
+    text = text[:URL_PREFETCH_MAX_CHARS]
+    url_content_cache.put(url, text)
+    return text
 
+
+async def prefetch_url_parts(user_input):
+    """
+    発言中の URL を並行取得し、本文テキストを Part の配列にして返す。
+    戻り値は (parts, 全URLを取得できたか)。URL がなければ ([], False)。
+    """
+    urls = [url for url in extract_urls(user_input) if is_fetchable_url(url)]
+    urls = urls[:URL_PREFETCH_MAX_URLS]
+    if not URL_PREFETCH_ENABLED or not urls:
+        return [], False
+
+    texts = await asyncio.gather(*(_get_url_text(url) for url in urls))
+    parts = [
+        Part.from_text(text=f'<url_content url="{url}">\n{text}\n</url_content>')
+        for url, text in zip(urls, texts)
+        if text
+    ]
+    return parts, len(parts) == len(urls)
+
+
+def clear_history_table(table_name):
+    """履歴テーブルの行をすべて削除する。テーブルがなければ False を返す。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         # 履歴テーブルの存在チェック
         cursor.execute(
-            f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';"
-        )
-        if cursor.fetchone():
-            # テーブルが存在すれば履歴を削除
-            cursor.execute(f"DELETE FROM {table_name}")
-            conn.commit()
-            print(f"テーブル {table_name} の会話履歴を削除しました。")
-            # await ctx.send(f"現在のキャラクター「{active_character_display_name}」の会話履歴をリセットしました。", mention_author=False) # active_character_display_name が使えるなら
+            "SELECT name FROM sqlite_master WHERE type='table' AND name = ?",
+            (table_name,),
+        )
+        if not cursor.fetchone():
+            return False
+        cursor.execute(f"DELETE FROM {table_name}")
+        _create_restored_rows_table(cursor)
+        cursor.execute(
+            "DELETE FROM restored_history_rows WHERE table_name = ?", (table_name,)
+        )
+    return True
+
+
+@bot.command(name="resetchat")
+@commands.has_permissions(administrator=True)  # 管理者権限が必要な場合
+async def resetchat(ctx):
+    """
+    このチャンネルのキャラクターの会話履歴をリセットします（管理者限定）。
+    同じキャラクターを使う他のチャンネルとは履歴を共有しているため、そちらにも反映されます。
+    """
+    character_key = resolve_channel_character(*channel_route_ids(ctx.channel))
+    table_name = get_history_table_name(character_key)
+    try:
+        # 大きな履歴の DELETE はイベントループを止めないよう別スレッドで行う
+        # (空いたページの解放は毎日の history_maintenance に任せる)
+        if await asyncio.to_thread(clear_history_table, table_name):
+            # 削除した会話が <memory> として戻ってこないよう記憶索引からも取り除く
+            await asyncio.to_thread(request_memory_prune, character_key)
+            logger.info(f"テーブル {table_name} の会話履歴を削除しました。")
             await ctx.send(
-                f"現在のキャラクター「{active_character_key}」の会話履歴をリセットしました。",
+                f"現在のキャラクター「{character_key}」の会話履歴をリセットしました。",
                 mention_author=False,
             )
         else:
             # テーブルが存在しない場合はリセットする履歴がない
-            print(
+            logger.warning(
                 f"警告：テーブル {table_name} が見つかりませんでした。リセットする履歴はありません。"
             )
             await ctx.send(
-                f"現在のキャラクター「{active_character_key}」の会話履歴は存在しませんでした。リセットは不要です。",
+                f"現在のキャラクター「{character_key}」の会話履歴は存在しませんでした。リセットは不要です。",
                 mention_author=False,
             )
 
         # メモリ上のセッションを再初期化
-        # initialize_chat_session 関数が DB から履歴を読み込む際、
+        # load_character_runtime が DB から履歴を読み込む際、
         # 上記で削除したため履歴なしでセッションが開始されます。
-        initialize_chat_session(active_character_key)
-        print("チャットセッションを再初期化しました。")
+        await asyncio.to_thread(load_character_runtime, character_key)
+        logger.info("チャットセッションを再初期化しました。")
 
     except sqlite3.Error as e:
-        print(f"データベースエラーが発生しました: {e}")
+        logger.error(f"データベースエラーが発生しました: {e}")
         await ctx.send(
             f"履歴のリセット中にデータベースエラーが発生しました。",
             mention_author=False,
         )
     except Exception as e:
-        print(f"予期せぬエラーが発生しました: {e}")
+        logger.error(f"予期せぬエラーが発生しました: {e}")
         await ctx.send(
             f"履歴のリセット中にエラーが発生しました。", mention_author=False
         )
-    finally:
-        if conn:
-            conn.close()
 
 
 @resetchat.error
@@ -200,24 +1009,166 @@ async def resetchat_error(ctx, error):
         await ctx.send("このコマンドを実行する権限がありません。", mention_author=False)
     else:
         # その他のエラーはコンソールに出力するなど
-        print(f"コマンドエラー: {error}")
+        logger.error(f"コマンドエラー: {error}")
         await ctx.send("コマンド実行中にエラーが発生しました。", mention_author=False)
 
 
+@bot.command(name="archivehistory")
+@commands.has_permissions(administrator=True)
+async def archivehistory_command(ctx):
+    """保持期間を過ぎた会話履歴を今すぐアーカイブします（管理者専用）。"""
+    async with ctx.channel.typing():
+        results = await asyncio.to_thread(apply_history_retention)
+    if not results:
+        await ctx.send("アーカイブ対象の履歴はありませんでした。", mention_author=False)
+        return
+    lines = [
+        f"- `{table_name}`: {count}件 → `{os.path.basename(path)}`"
+        for table_name, count, path in results
+    ]
+    await ctx.send(
+        "履歴をアーカイブしました:\n" + "\n".join(lines), mention_author=False
+    )
+
+
+@bot.command(name="restorehistory")
+@commands.has_permissions(administrator=True)
+async def restorehistory_command(ctx, char_key: str, archive_name: str = None):
+    """
+    アーカイブ済みの会話履歴を DB に戻します（管理者専用）。
+    使用法: !restorehistory <キャラクターキー> [アーカイブ名|all]
+    アーカイブ名を省略すると利用可能なアーカイブを一覧表示します。
+    """
+    archives = list_history_archives(char_key)
+    if not archives:
+        await ctx.send(
+            f"キャラクター「{char_key}」のアーカイブは見つかりませんでした。",
+            mention_author=False,
+        )
+        return
+    if archive_name is None:
+        await ctx.send(
+            "利用可能なアーカイブ:\n"
+            + "\n".join(f"- `{os.path.basename(path)}`" for path in archives)
+            + "\n`!restorehistory <キャラクターキー> <アーカイブ名|all>` で復元します。",
+            mention_author=False,
+        )
+        return
+
+    if archive_name != "all":
+        archives = [path for path in archives if os.path.basename(path) == archive_name]
+        if not archives:
+            await ctx.send(
+                f"アーカイブ `{archive_name}` は見つかりませんでした。",
+                mention_author=False,
+            )
+            return
+
+    async with ctx.channel.typing():
+        restored = 0
+        for path in archives:
+            restored += await asyncio.to_thread(restore_history_archive, char_key, path)
+    await ctx.send(
+        f"キャラクター「{char_key}」の履歴を {restored} 件復元しました。",
+        mention_author=False,
+    )
+
+
+@bot.command(name="search")
+@commands.guild_only()
+async def search_command(ctx, *, query_text: str = ""):
+    """
+    このサーバーでのこのチャンネルのキャラクターの会話履歴を全文検索します。
+    使用法: !search <キーワード> [author:名前] [from:YYYY-MM-DD] [to:YYYY-MM-DD] [before:ID] [limit:N]
+    結果は新しい順で、続きは表示される before:ID を付けて再検索します。
+    管理者は scope:legacy でサーバーを記録する前の履歴も検索できます。
+    """
+    try:
+        query = parse_search_query(query_text)
+    except ValueError as e:
+        await ctx.send(
+            f"検索条件を解釈できませんでした: {e}\n"
+            "使用法: `!search <キーワード> [author:名前] [from:YYYY-MM-DD] [to:YYYY-MM-DD] [before:ID] [limit:N]`",
+            mention_author=False,
+        )
+        return
+    if query.include_legacy and not ctx.author.guild_permissions.administrator:
+        # サーバー不明の行には他のサーバーの会話が含まれうる
+        await ctx.send("scope:legacy は管理者のみ使用できます。", mention_author=False)
+        return
+
+    character_key = resolve_channel_character(*channel_route_ids(ctx.channel))
+    results = iter_history_search(character_key, query, ctx.guild.id)
+    started_at = time.monotonic()
+    buffer = ""
+    hit_count = 0
+    last_id = None
+    async with ctx.channel.typing():
+        while True:
+            # 1件ずつスレッドで取得し、2000文字に達したら順次送信する
+            row = await asyncio.to_thread(next, results, None)
+            if row is None:
+                break
+            hit_count += 1
+            last_id = row["id"]
+            line = format_search_hit(row, query.terms)[:1900]
+            if len(buffer) + len(line) + 1 > 1900:
+                await ctx.send(buffer, mention_author=False)
+                buffer = ""
+            buffer += line + "\n"
+    observe_metric("search.latency_ms", (time.monotonic() - started_at) * 1000)
+
+    if hit_count == 0:
+        await ctx.send("該当する発言は見つかりませんでした。", mention_author=False)
+        return
+    if hit_count >= query.limit:
+        next_query = " ".join(
+            token
+            for token in query_text.split()
+            if not token.lower().startswith("before:")
+        )
+        buffer += f"続きは `!search {next_query} before:{last_id}` で表示できます。"
+    await ctx.send(buffer, mention_author=False)
+
+
 @bot.command(name="setchar")
-async def setchar_command(ctx, char_key: str):
+async def setchar_command(ctx, char_key: str, scope: str = "channel"):
     """
-    ボットのキャラクターを変更します（管理者限定）。
-    使用法: !setchar <キャラクターキー>
+    このチャンネルのキャラクターを変更します。
+    使用法: !setchar <キャラクターキー> [channel|server|all]
+    server はこのサーバーの既定、all は全体の既定 (定期ジョブにも使用) を変更します（管理者限定）。
+    他のチャンネルのセッションには影響しません。
     """
+    if scope not in ("channel", "server", "all"):
+        await ctx.send(
+            "範囲は channel / server / all のいずれかを指定してください。",
+            mention_author=False,
+        )
+        return
+    if scope != "channel" and not getattr(
+        getattr(ctx.author, "guild_permissions", None), "administrator", False
+    ):
+        raise commands.MissingPermissions(["administrator"])
+
     # 利用可能なキャラクターかチェック (PROMPT_DIR内のファイル名リストと比較など)
     available_chars = list_available_character_keys()
     if char_key in available_chars:
         try:
-            initialize_chat_session(char_key)  # 新しいキャラでセッション再初期化
-            # active_character_display_name が更新されていることを利用
+            guild_id, channel_id = channel_route_ids(ctx.channel)
+            if scope == "server":
+                channel_id = ROUTE_SCOPE_ALL
+            elif scope == "all":
+                guild_id = channel_id = ROUTE_SCOPE_ALL
+            # 読み込み済みなら再利用し、未読み込みならこのキャラクターだけを読み込む
+            runtime = await asyncio.to_thread(get_character_runtime, char_key)
+            set_channel_character(guild_id, channel_id, char_key)
+            scope_label = {
+                "channel": "このチャンネル",
+                "server": "このサーバーの既定",
+                "all": "全体の既定",
+            }[scope]
             await ctx.send(
-                f"キャラクターを「{active_character_display_name}」に変更しました。",
+                f"{scope_label}のキャラクターを「{runtime.display_name}」に変更しました。",
                 mention_author=False,
             )
         except Exception as e:
@@ -242,7 +1193,7 @@ async def setchar_error(ctx, error):
             mention_author=False,
         )
     else:
-        print(f"setchar コマンドエラー: {error}")
+        logger.error(f"setchar コマンドエラー: {error}")
         await ctx.send("コマンド実行中にエラーが発生しました。", mention_author=False)
 
 
@@ -261,6 +1212,7 @@ async def listchars_command(ctx):
         )
         return
 
+    current_key = resolve_channel_character(*channel_route_ids(ctx.channel))
     available_keys = list_available_character_keys()
     if not available_keys:
         await ctx.send(
@@ -275,10 +1227,10 @@ async def listchars_command(ctx):
                 char_key
             )  # 表示名取得のため一時的に読み込み
             available_chars_info.append(
-                f"- `{char_key}` ({display_name}) {'(現在使用中)' if active_character_key == char_key else ''}"
+                f"- `{char_key}` ({display_name}) {'(現在使用中)' if current_key == char_key else ''}"
             )
         except Exception as e:
-            print(f"キャラクター情報読み込みエラー ({char_key}): {e}")
+            logger.error(f"キャラクター情報読み込みエラー ({char_key}): {e}")
             available_chars_info.append(f"- `{char_key}` (情報の読み込みに失敗)")
 
     if available_chars_info:
@@ -293,211 +1245,1030 @@ async def listchars_command(ctx):
         )
 
 
+@bot.command("metrics")
+@commands.has_permissions(administrator=True)
+async def metrics_command(ctx):
+    """プロセス内メトリクスを表示します（管理者専用）。"""
+    controller = get_admission_controller()
+    report = (
+        f"admission.in_flight: {controller.in_flight}/{controller.max_in_flight}\n"
+        f"admission.queued: {controller.queued}/{controller.max_queued}\n"
+        + format_metrics_report()
+    )
+    await ctx.send(
+        f"```\n{report[:MAX_DISCORD_MESSAGE_LENGTH - 8]}\n```", mention_author=False
+    )
+
+
+@bot.command("memstats")
+@commands.has_permissions(administrator=True)
+async def memstats_command(ctx, action: str = None, option: str = None):
+    """
+    メモリ使用量を表示します（管理者専用）。
+    使用法: !memstats [trace on|off] [diff [lineno|filename]]
+    diff は前回の diff (または trace on) 以降に増えた確保元を表示します。
+    """
+    if action == "trace" and option in ("on", "off"):
+        if option == "on":
+            await asyncio.to_thread(start_memory_tracing)
+            message = (
+                "tracemalloc を開始しました。`!memstats diff` で増加分を確認できます。"
+            )
+        else:
+            stop_memory_tracing()
+            message = "tracemalloc を停止しました。"
+        await ctx.send(message, mention_author=False)
+        return
+    if action == "diff":
+        if not tracemalloc.is_tracing():
+            await ctx.send(
+                "tracemalloc が無効です。`!memstats trace on` で開始してください。",
+                mention_author=False,
+            )
+            return
+        key_type = option if option in ("lineno", "filename") else "lineno"
+        lines = await asyncio.to_thread(tracemalloc_diff, key_type)
+        report = "\n".join(lines) or "(差分はありません)"
+    elif action is not None:
+        await ctx.send(
+            "使用法: `!memstats [trace on|off] [diff [lineno|filename]]`",
+            mention_author=False,
+        )
+        return
+    else:
+        counts = await asyncio.to_thread(collect_object_counts)
+        lines = [format_rss_trend()]
+        if tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            lines.append(
+                f"tracemalloc: {traced / 2**20:.1f}MiB (ピーク {peak / 2**20:.1f}MiB)"
+            )
+        lines.extend(f"{name}: {value}" for name, value in counts.items())
+        report = "\n".join(lines)
+    await ctx.send(
+        f"```\n{report[:MAX_DISCORD_MESSAGE_LENGTH - 8]}\n```", mention_author=False
+    )
+
+
+@bot.command("routestats")
+@commands.has_permissions(administrator=True)
+async def routestats_command(ctx, days: int = 7):
+    """生成プロファイルごとの呼び出し数・レイテンシ・トークン数を集計表示します（管理者専用）。"""
+    rows = summarize_routing_log(days)
+    if not rows:
+        await ctx.send("ルーティング記録はまだありません。", mention_author=False)
+        return
+    lines = [f"直近{days}日間のルーティング集計:"]
+    for row in rows:
+        lines.append(
+            f"- `{row['profile']}` ({row['model']}): {row['calls']}件"
+            f" 平均{row['avg_latency_ms']:.0f}ms"
+            f" 入力{row['avg_prompt_tokens'] or 0:.0f}tok"
+            f" 出力{row['avg_output_tokens'] or 0:.0f}tok"
+        )
+    await ctx.send("\n".join(lines), mention_author=False)
+
+
+@bot.command(name="autospeak")
+@commands.has_permissions(administrator=True)
+async def autospeak_command(ctx, mode: str = None):
+    """
+    このチャンネルが静かなときにキャラクターから話しかけるかを切り替えます（管理者限定）。
+    使用法: !autospeak on|off
+    """
+    if mode not in ("on", "off"):
+        await ctx.send("使用法: `!autospeak on|off`", mention_author=False)
+        return
+    await asyncio.to_thread(set_autospeak, ctx.channel.id, mode == "on")
+    if mode == "on":
+        message = f"このチャンネルが {AUTOSPEAK_IDLE_MINUTES} 分以上静かなときに話しかけます。"
+        if not STARTER_ENABLED:
+            message += " (STARTER_ENABLED=false のため現在は動作しません)"
+    else:
+        message = "このチャンネルでの自動の話しかけを停止しました。"
+    await ctx.send(message, mention_author=False)
+
+
 @bot.command("talktome")
 async def talktome_command(ctx):
     user = ctx.author.display_name
-    talk_prompt = f"{user}との過去の会話を踏まえて、{user}との会話を再開するような発言をしてください。挨拶のみ発言することは避けてください。過去に自分が提案したことがある話題の繰り返しは避けるようにしてください。話題がない場合はキャラクター情報から会話のきっかけを考えてください。"
-    async with ctx.channel.typing():
-        response = _send_message_with_retry(shared_chat_session, [talk_prompt])
-        bot_reply = response.text
+    talk_prompt = build_talktome_prompt(user)
+    guild_id = ctx.guild.id if ctx.guild else None
+    request_id_var.set(f"m{ctx.message.id}")
+    runtime = await asyncio.to_thread(get_channel_runtime, ctx.channel)
+    if STARTER_ENABLED:
+        # アイドル時に作り置きした話しかけがあれば、生成を待たずに返す
+        # (返信と記録の途中で停止しないよう、この間も処理中として数える)
+        async with track_in_flight():
+            starter_guild_id = guild_id or ROUTE_SCOPE_ALL
+            starter = await asyncio.to_thread(
+                take_conversation_starter,
+                runtime.key,
+                user_starter_target(starter_guild_id, ctx.author.id),
+                await asyncio.to_thread(
+                    user_starter_marker, runtime.key, starter_guild_id, ctx.author.id
+                ),
+            )
+            if starter:
+                await ctx.reply(starter, mention_author=False)
+                await runtime.record_exchange("system", talk_prompt, starter)
+                await asyncio.to_thread(
+                    add_message_to_db,
+                    runtime.key,
+                    "user",
+                    "system",
+                    talk_prompt,
+                    guild_id,
+                )
+                await asyncio.to_thread(
+                    add_message_to_db, runtime.key, "model", "bot", starter, guild_id
+                )
+                return
+    user_profile = await asyncio.to_thread(
+        get_user_profile, guild_id or ROUTE_SCOPE_ALL, ctx.author.id
+    )
+    async with track_in_flight(), admit_request(
+        ctx.author.id, ctx.channel.id
+    ) as ticket:
+        if ticket.status != "admitted":
+            if get_admission_controller().should_send_busy_notice(ctx.channel.id):
+                await ctx.reply(BUSY_NOTICE_TEXT, mention_author=False)
+            return
+        async with ctx.channel.typing():
+            if user_profile is None:
+                # プロフィールがまだない相手は共有セッションの文脈から思い出す
+                response = await runtime.send(
+                    [talk_prompt],
+                    speaker="system",
+                    profile=select_generation_profile(talk_prompt, job_type="talktome"),
+                )
+            else:
+                # 共有セッションの長い履歴は送らず、小さなプロフィールだけを渡す
+                profile_prompt = build_profile_starter_prompt(user, user_profile)
+                response = await send_message_async(
+                    get_genai_client().chats.create(model=MODEL_NAME),
+                    [profile_prompt],
+                    profile=select_generation_profile(
+                        profile_prompt, job_type="talktome"
+                    ),
+                    system_instruction=runtime.system_instruction,
+                )
+                if response.text and response.text.strip():
+                    # 以降の返信で文脈が通じるよう、やり取りは共有セッションにも残す
+                    await runtime.record_exchange("system", talk_prompt, response.text)
+            bot_reply = response.text
 
     if bot_reply and bot_reply.strip():
         await ctx.reply(bot_reply, mention_author=False)
-        add_message_to_db("user", "system", talk_prompt)
-        add_message_to_db("model", "bot", bot_reply)
+        await asyncio.to_thread(
+            add_message_to_db, runtime.key, "user", "system", talk_prompt, guild_id
+        )
+        await asyncio.to_thread(
+            add_message_to_db, runtime.key, "model", "bot", bot_reply, guild_id
+        )
 
 
-async def _announce_update_if_needed():
-    """前回起動時と git commit hash が異なる場合、差分をキャラクター口調でアナウンスする。"""
-    try:
-        current_hash = (
-            subprocess.check_output(
-                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
-            )
-            .decode()
-            .strip()
+async def _run_git(*args):
+    """git コマンドをイベントループを止めずに実行し、標準出力を返す。"""
+    process = await asyncio.create_subprocess_exec(
+        "git",
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"git {' '.join(args)} が終了コード {process.returncode} で失敗しました"
         )
-    except Exception as e:
-        print(f"アップデート検知: git コマンド失敗のためスキップします: {e}")
+    return stdout.decode().strip()
+
+
+async def _announce_update_if_needed(current_hash=None):
+    """前回起動時と git commit hash が異なる場合、差分をキャラクター口調でアナウンスする。"""
+    if current_hash is None:
+        try:
+            current_hash = await _run_git("rev-parse", "HEAD")
+        except Exception as e:
+            logger.error(f"アップデート検知: git コマンド失敗のためスキップします: {e}")
+            return
+
+    # 複数ワーカーで起動しても、同じコミットのアナウンスは1回だけ行う
+    if not await asyncio.to_thread(claim_job_run, "update_announcement", current_hash):
+        logger.info("アップデート検知: 他のワーカーが処理済みのためスキップします。")
         return
 
-    last_hash = get_setting_from_db("last_deployed_commit", None)
-    set_setting_in_db("last_deployed_commit", current_hash)
+    last_hash = await asyncio.to_thread(
+        get_setting_from_db, "last_deployed_commit", None
+    )
+    await asyncio.to_thread(set_setting_in_db, "last_deployed_commit", current_hash)
 
     if last_hash is None:
-        print(
+        logger.info(
             f"アップデート検知: 初回起動。コミットハッシュを記録しました: {current_hash[:7]}"
         )
         return
 
     if last_hash == current_hash:
-        print("アップデート検知: コミットハッシュに変化なし。通知をスキップします。")
+        logger.info(
+            "アップデート検知: コミットハッシュに変化なし。通知をスキップします。"
+        )
         return
 
     try:
-        commit_log = (
-            subprocess.check_output(
-                ["git", "log", "--oneline", f"{last_hash}..{current_hash}"],
-                stderr=subprocess.DEVNULL,
-            )
-            .decode()
-            .strip()
-        )
+        commit_log = await _run_git("log", "--oneline", f"{last_hash}..{current_hash}")
     except Exception as e:
-        print(f"アップデート検知: git log 取得失敗: {e}")
+        logger.error(f"アップデート検知: git log 取得失敗: {e}")
         commit_log = "(変更内容の取得に失敗しました)"
 
     if not commit_log:
-        print("アップデート検知: 差分コミットなし。通知をスキップします。")
+        logger.info("アップデート検知: 差分コミットなし。通知をスキップします。")
         return
 
-    print(f"アップデート検知: {last_hash[:7]} → {current_hash[:7]}\n{commit_log}")
+    logger.info(f"アップデート検知: {last_hash[:7]} → {current_hash[:7]}\n{commit_log}")
 
-    if not shared_chat_session:
-        print(
+    runtime = await asyncio.to_thread(get_default_runtime)
+    if not runtime.chat_session:
+        logger.info(
             "アップデート検知: チャットセッション未初期化のため通知をスキップします。"
         )
         return
 
-    send_time_iso = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
     update_prompt = (
-        f"システム\n{send_time_iso}\n"
         f"ボットがアップデートされて再起動しました。以下の変更内容をキャラクターとしての口調で"
         f"Discordのみんなに自然にお知らせしてください。2000文字以内でまとめてください。\n\n"
         f"変更内容（git log）:\n{commit_log}"
     )
 
     try:
-        response = _send_message_with_retry(shared_chat_session, [update_prompt])
+        response = await runtime.send(
+            [update_prompt],
+            speaker="system",
+            profile=select_generation_profile(update_prompt, job_type="update"),
+        )
         bot_reply = response.text
         if not bot_reply or not bot_reply.strip():
             return
 
-        for channel_id in TARGET_CHANNEL_IDS:
-            channel = bot.get_channel(channel_id)
-            if channel:
-                await channel.send(bot_reply)
+        await publish_job_output("update_announcement", current_hash, bot_reply)
 
     except Exception as e:
-        print(f"アップデート通知中にエラーが発生しました: {e}")
+        logger.error(f"アップデート通知中にエラーが発生しました: {e}")
 
 
-@tasks.loop(
-    time=datetime.time(
-        hour=7,
-        minute=0,
-        second=0,
-        tzinfo=datetime.timezone(datetime.timedelta(hours=9)),
+# --- ワーカー間の協調 (定期ジョブの排他実行と配信) ---
+JOB_DELIVERY_WINDOW_SECONDS = float(os.getenv("JOB_DELIVERY_WINDOW_SECONDS", "3600"))
+
+
+def _create_job_tables(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS job_claims (
+        job_name TEXT NOT NULL,
+        run_key TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        claimed_at DATETIME NOT NULL,
+        output TEXT,
+        published_at DATETIME,
+        PRIMARY KEY (job_name, run_key)
+    )
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS job_deliveries (
+        job_name TEXT NOT NULL,
+        run_key TEXT NOT NULL,
+        channel_id INTEGER NOT NULL,
+        owner TEXT NOT NULL,
+        delivered_at DATETIME NOT NULL,
+        PRIMARY KEY (job_name, run_key, channel_id)
+    )
+    """
     )
-)
-async def morning_weather_announcement():
-    """毎朝7時(JST)に天気をキャラクターの口調でアナウンスする。"""
-    global shared_chat_session
 
-    if not shared_chat_session:
-        print("朝の天気アナウンス: チャットセッションが未初期化のためスキップします。")
-        return
 
-    locations = [loc.strip() for loc in WEATHER_LOCATION.split(",") if loc.strip()]
-    if len(locations) > 1:
-        location_str = "・".join(locations)
-        weather_prompt = (
-            f"GoogleSearchを使って{location_str}それぞれの今日の天気予報を調べて、"
-            "キャラクターとしての口調でDiscordの特定の誰かではなく、みんなに朝の天気をまとめてお知らせしてください。"
-            "各地点の気温・降水確率・おすすめの服装など実用的な情報を含め、2000文字以内でまとめてください。"
+def _job_run_key(force=False):
+    """定期実行はJSTの日付単位、手動実行は実行時刻単位で排他キーを作る。"""
+    if force:
+        return (
+            f"manual-{datetime.datetime.now(pytz.timezone('Asia/Tokyo')).isoformat()}"
         )
-    else:
-        weather_prompt = (
-            f"GoogleSearchを使って{locations[0]}の今日の天気予報を調べて、"
-            "キャラクターとしての口調でDiscordの特定の誰かではなく、みんなに朝の天気をお知らせしてください。"
-            "気温・降水確率・おすすめの服装など実用的な情報を含め、2000文字以内でまとめてください。"
+    return _today_jst()
+
+
+def claim_job_run(job_name, run_key):
+    """(job_name, run_key) の実行権を取得する。既に他のワーカーが取得済みなら False。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_tables(cursor)
+        cursor.execute(
+            "INSERT OR IGNORE INTO job_claims (job_name, run_key, owner, claimed_at) VALUES (?, ?, ?, ?)",
+            (job_name, run_key, WORKER_ID, datetime.datetime.now()),
         )
+        return cursor.rowcount == 1
 
-    send_time_iso = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
-    formatted_prompt = f"システム\n{send_time_iso}\n{weather_prompt}"
 
-    try:
-        response = _send_message_with_retry(shared_chat_session, [formatted_prompt])
-        bot_reply = response.text
-        if not bot_reply or not bot_reply.strip():
-            print("朝の天気アナウンス: 空の応答が返されました。")
-            return
+def release_job_run(job_name, run_key):
+    """失敗したジョブの実行権を手放し、再実行できるようにする。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_tables(cursor)
+        cursor.execute(
+            "DELETE FROM job_claims WHERE job_name = ? AND run_key = ? AND owner = ? AND published_at IS NULL",
+            (job_name, run_key, WORKER_ID),
+        )
 
-        add_message_to_db("user", "system", formatted_prompt)
-        add_message_to_db("model", "bot", bot_reply)
 
-        for channel_id in TARGET_CHANNEL_IDS:
-            channel = bot.get_channel(channel_id)
-            if channel:
-                await channel.send(bot_reply)
-            else:
-                print(
-                    f"朝の天気アナウンス: チャンネルID {channel_id} が見つかりませんでした。"
+def _claim_delivery(job_name, run_key, channel_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_tables(cursor)
+        cursor.execute(
+            """
+        INSERT OR IGNORE INTO job_deliveries (job_name, run_key, channel_id, owner, delivered_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+            (job_name, run_key, channel_id, WORKER_ID, datetime.datetime.now()),
+        )
+        return cursor.rowcount == 1
+
+
+def _release_delivery(job_name, run_key, channel_id):
+    """送信に失敗した配信の記録を消し、次回の deliver_pending_job_outputs で再送できるようにする。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_tables(cursor)
+        cursor.execute(
+            "DELETE FROM job_deliveries WHERE job_name = ? AND run_key = ? AND channel_id = ? AND owner = ?",
+            (job_name, run_key, channel_id, WORKER_ID),
+        )
+
+
+async def _deliver_job_output(job_name, run_key, output, delivered=()):
+    """
+    このワーカーから見える配信先チャンネルへ、未配信のものだけ送信する。
+    delivered は配信済みと分かっているチャンネルIDで、DBに問い合わせずに飛ばす。
+    """
+    for channel_id in get_job_channel_ids(job_name):
+        if channel_id in delivered:
+            continue
+        channel = bot.get_channel(channel_id)
+        if not channel:
+            if not IS_MULTI_WORKER:
+                logger.warning(
+                    f"{job_name}: チャンネルID {channel_id} が見つかりませんでした。"
                 )
+            continue
+        # 二重送信を防ぐため送信前に配信権を取り、失敗したら手放して再送に回す
+        if not await asyncio.to_thread(_claim_delivery, job_name, run_key, channel_id):
+            continue
+        try:
+            await channel.send(output)
+        except Exception:
+            await asyncio.to_thread(_release_delivery, job_name, run_key, channel_id)
+            raise
 
-    except Exception as e:
-        print(f"朝の天気アナウンス中にエラーが発生しました: {e}")
 
+async def publish_job_output(job_name, run_key, output):
+    """
+    ジョブの生成結果を記録して配信する。他のシャードが担当するチャンネルや、
+    送信に失敗したチャンネルには各ワーカーの deliver_pending_job_outputs が配信する。
+    """
+    await asyncio.to_thread(_record_job_output, job_name, run_key, output)
+    await _deliver_job_output(job_name, run_key, output)
 
-@bot.command("weather")
-@commands.has_permissions(administrator=True)
-async def weather_command(ctx):
-    """天気アナウンスを即時実行するテスト用コマンド（管理者専用）。"""
-    async with ctx.channel.typing():
-        await morning_weather_announcement()
 
+def _record_job_output(job_name, run_key, output):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_tables(cursor)
+        cursor.execute(
+            """
+        INSERT INTO job_claims (job_name, run_key, owner, claimed_at, output, published_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (job_name, run_key) DO UPDATE SET output = excluded.output, published_at = excluded.published_at
+        """,
+            (
+                job_name,
+                run_key,
+                WORKER_ID,
+                datetime.datetime.now(),
+                output,
+                datetime.datetime.now(),
+            ),
+        )
 
-@tasks.loop(
-    time=datetime.time(
-        hour=7,
-        minute=2,
-        second=0,
-        tzinfo=datetime.timezone(datetime.timedelta(hours=9)),
+
+@tasks.loop(seconds=20)
+async def deliver_pending_job_outputs():
+    """他のワーカーが生成したジョブ結果のうち、自分の担当チャンネルに未配信のものを送る。"""
+    since = datetime.datetime.now() - datetime.timedelta(
+        seconds=JOB_DELIVERY_WINDOW_SECONDS
     )
+    try:
+        pending = await asyncio.to_thread(_pending_job_outputs, since)
+        for row in pending:
+            delivered = {
+                int(channel_id)
+                for channel_id in (row["delivered"] or "").split(",")
+                if channel_id
+            }
+            if delivered.issuperset(get_job_channel_ids(row["job_name"])):
+                continue
+            try:
+                await _deliver_job_output(
+                    row["job_name"], row["run_key"], row["output"], delivered
+                )
+            except Exception as e:
+                # 1件の送信失敗で他のジョブ結果の配信を止めない (配信権は手放し済みで次回再送される)
+                logger.error(f"{row['job_name']}: ジョブ結果の配信に失敗しました: {e}")
+    except Exception as e:
+        logger.error(f"ジョブ結果の配信中にエラーが発生しました: {e}")
+
+
+def _pending_job_outputs(since):
+    """配信期間内のジョブ結果を、配信済みチャンネルID (カンマ区切り) と一緒に返す。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_tables(cursor)
+        cursor.execute(
+            """
+        SELECT c.job_name, c.run_key, c.output, GROUP_CONCAT(d.channel_id) AS delivered
+        FROM job_claims c
+        LEFT JOIN job_deliveries d ON d.job_name = c.job_name AND d.run_key = c.run_key
+        WHERE c.published_at >= ? AND c.output IS NOT NULL
+        GROUP BY c.job_name, c.run_key
+        """,
+            (since,),
+        )
+        return cursor.fetchall()
+
+
+def run_shard_coordinator():
+    """SHARD_WORKERS 個のワーカープロセスにシャードを割り当てて起動し、異常終了時は再起動する。"""
+    shard_count = SHARD_COUNT or SHARD_WORKERS
+    worker_count = min(SHARD_WORKERS, shard_count)
+    assignments = [
+        list(range(shard_count))[i::worker_count] for i in range(worker_count)
+    ]
+    processes = {}
+    stopping = False
+
+    def start_worker(index):
+        env = dict(
+            os.environ,
+            SHARD_MODE="worker",
+            SHARD_COUNT=str(shard_count),
+            SHARD_IDS=",".join(str(shard_id) for shard_id in assignments[index]),
+            WORKER_ID=f"{socket.gethostname()}:worker{index}",
+        )
+        processes[index] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)], env=env
+        )
+        logger.info(
+            f"コーディネータ: ワーカー{index} (シャード {assignments[index]}) を起動しました。"
+        )
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    for index in range(worker_count):
+        start_worker(index)
+
+    while True:
+        time.sleep(5)
+        if stopping:
+            for process in processes.values():
+                process.wait()
+            logger.info("コーディネータ: すべてのワーカーを停止しました。")
+            return
+        for index, process in list(processes.items()):
+            if process.poll() is not None:
+                logger.info(
+                    f"コーディネータ: ワーカー{index} が終了しました (code={process.returncode})。再起動します。"
+                )
+                start_worker(index)
+
+
+# --- 定期アナウンス用の検索結果キャッシュ (事実収集とキャラクター描画の分離) ---
+GROUNDING_CACHE_TTL_SECONDS = float(os.getenv("GROUNDING_CACHE_TTL_SECONDS", "21600"))
+NO_GROUNDED_FACTS_MARKER = "NO_RESULTS"
+GROUNDING_SYSTEM_INSTRUCTION = (
+    "あなたはリサーチアシスタントです。GoogleSearch で調べた事実だけを、"
+    "日本語の簡潔な箇条書きで出力してください。キャラクターの口調や前置き・感想は不要です。"
+    "数値 (気温・確率・価格など) と日付は出典の表記どおりに残してください。"
 )
-async def bocchi_news_announcement():
-    """毎朝7時2分(JST)にぼっち・ざ・ろっく！の最新ニュースをアナウンスする。"""
-    global shared_chat_session
+_grounding_in_flight = {}  # (job, location, date) -> asyncio.Task
+
+
+def _today_jst():
+    return datetime.datetime.now(pytz.timezone("Asia/Tokyo")).date().isoformat()
 
-    if not shared_chat_session:
-        print("ぼっちニュース: チャットセッションが未初期化のためスキップします。")
-        return
 
-    news_prompt = (
-        "GoogleSearchを使ってぼっち・ざ・ろっく！（Bocchi the Rock!）に関する"
-        "過去24時間以内の最新ニュースを調べてください。"
-        "アニメ・漫画・ライブ・グッズ・コラボなど関連する新着情報があれば、"
-        "キャラクターとしての口調でDiscordの特定の誰かではなく、みんなにお知らせしてください。"
-        "新しいニュースが特にない場合は何も出力しないでください（空白のみで応答してください）。"
-        "2000文字以内でまとめてください。"
+def _create_grounding_cache_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS grounding_cache (
+        job TEXT NOT NULL,
+        location TEXT NOT NULL,
+        date TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at DATETIME NOT NULL,
+        expires_at DATETIME NOT NULL,
+        PRIMARY KEY (job, location, date)
+    )
+    """
     )
 
-    send_time_iso = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
-    formatted_prompt = f"システム\n{send_time_iso}\n{news_prompt}"
 
-    try:
-        response = _send_message_with_retry(shared_chat_session, [formatted_prompt])
-        bot_reply = response.text
-        if not bot_reply or not bot_reply.strip():
-            print(
-                "ぼっちニュース: 新着ニュースなし、または空応答のためスキップします。"
+def get_cached_grounding(job, location, date):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_grounding_cache_table(cursor)
+        cursor.execute(
+            "SELECT content FROM grounding_cache WHERE job = ? AND location = ? AND date = ? AND expires_at > ?",
+            (job, location, date, datetime.datetime.now()),
+        )
+        row = cursor.fetchone()
+    return row["content"] if row else None
+
+
+def save_grounding(job, location, date, content):
+    now = datetime.datetime.now()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_grounding_cache_table(cursor)
+        cursor.execute("DELETE FROM grounding_cache WHERE expires_at <= ?", (now,))
+        cursor.execute(
+            """
+        INSERT OR REPLACE INTO grounding_cache (job, location, date, content, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (
+                job,
+                location,
+                date,
+                content,
+                now,
+                now + datetime.timedelta(seconds=GROUNDING_CACHE_TTL_SECONDS),
+            ),
+        )
+
+
+def gather_grounded_facts(job, location, research_prompt, date=None):
+    """
+    検索を伴う事実収集ステップ。結果は (job, location, date) 単位でキャッシュし、
+    有効期限内の再実行やリトライ、複数キャラクターでの描画では検索を行わない。
+    """
+    date = date or _today_jst()
+    cached = get_cached_grounding(job, location, date)
+    if cached is not None:
+        increment_metric("grounding.cache_hits")
+        logger.debug(f"検索結果キャッシュを利用します: {job}/{location or '-'}/{date}")
+        return cached
+
+    increment_metric("grounding.cache_misses")
+    research_session = get_genai_client().chats.create(model=MODEL_NAME)
+    response = _send_message_with_retry(
+        research_session,
+        [f"今日の日付: {date}\n{research_prompt}"],
+        profile=select_generation_profile(research_prompt, job_type="grounding"),
+        system_instruction=GROUNDING_SYSTEM_INSTRUCTION,
+    )
+    facts = (response.text or "").strip()
+    if facts:
+        save_grounding(job, location, date, facts)
+    return facts
+
+
+async def gather_grounded_facts_async(job, location, research_prompt, date=None):
+    """gather_grounded_facts をイベントループ外で実行し、同じキーの同時実行は1回の検索にまとめる。"""
+    key = (job, location, date or _today_jst())
+    task = _grounding_in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(
+            asyncio.to_thread(
+                gather_grounded_facts, job, location, research_prompt, key[2]
             )
-            return
+        )
+        _grounding_in_flight[key] = task
+        task.add_done_callback(lambda _: _grounding_in_flight.pop(key, None))
+    return await asyncio.shield(task)
 
-        add_message_to_db("user", "system", formatted_prompt)
-        add_message_to_db("model", "bot", bot_reply)
 
-        for channel_id in TARGET_CHANNEL_IDS:
-            channel = bot.get_channel(channel_id)
-            if channel:
-                await channel.send(bot_reply)
-            else:
-                print(
-                    f"ぼっちニュース: チャンネルID {channel_id} が見つかりませんでした。"
+# --- 宣言的ジョブスケジューラ (scheduled_jobs.json のジョブ定義を実行) ---
+SCHEDULED_JOBS_FILE = os.getenv("SCHEDULED_JOBS_FILE", "scheduled_jobs.json")
+SCHEDULER_MAX_CONCURRENT_JOBS = int(os.getenv("SCHEDULER_MAX_CONCURRENT_JOBS", "2"))
+JOB_DEFAULT_CATCH_UP_HOURS = float(os.getenv("JOB_DEFAULT_CATCH_UP_HOURS", "3"))
+JOB_RETRY_INTERVAL_SECONDS = float(os.getenv("JOB_RETRY_INTERVAL_SECONDS", "600"))
+JST = pytz.timezone("Asia/Tokyo")
+
+
+@dataclass(frozen=True)
+class ScheduledJob:
+    """
+    定期ジョブの定義。at の各時刻 (JST) に research_prompt で事実を集め、
+    character の口調で prompt_template を描画して channels に配信する。
+    """
+
+    name: str
+    at: tuple
+    research_prompt: str
+    prompt_template: str
+    character: Optional[str] = None  # None なら全体既定のキャラクター
+    job_type: str = "render"
+    locations: tuple = ("",)
+    channels: tuple = ()  # 空なら TARGET_CHANNEL_IDS
+    skip_if_no_results: bool = False
+    jitter_seconds: float = 0.0
+    catch_up_hours: float = JOB_DEFAULT_CATCH_UP_HOURS
+    max_concurrency: int = 1
+    enabled: bool = True
+
+
+def load_scheduled_jobs(path=SCHEDULED_JOBS_FILE):
+    """ジョブ定義ファイルを読み込み、名前 -> ScheduledJob の dict を返す。"""
+    if not os.path.exists(path):
+        logger.warning(f"警告: ジョブ定義ファイルが見つかりません: {path}")
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    jobs = {}
+    for entry in data.get("jobs", []):
+        try:
+            at = entry["at"] if isinstance(entry["at"], list) else [entry["at"]]
+            for time_str in at:
+                datetime.datetime.strptime(time_str, "%H:%M")
+            locations = entry.get("locations", "")
+            if isinstance(locations, str):
+                # "${WEATHER_LOCATION}" のような参照は環境変数 (未設定ならこのモジュールの既定値) に置換
+                locations = re.sub(
+                    r"\$\{(\w+)\}",
+                    lambda m: os.getenv(m.group(1), str(globals().get(m.group(1), ""))),
+                    locations,
+                ).split(",")
+            locations = tuple(loc.strip() for loc in locations if loc.strip()) or ("",)
+            job = ScheduledJob(
+                name=entry["name"],
+                at=tuple(at),
+                research_prompt=entry["research_prompt"],
+                prompt_template=entry["prompt_template"],
+                character=entry.get("character"),
+                job_type=entry.get("job_type", "render"),
+                locations=locations,
+                channels=tuple(int(cid) for cid in entry.get("channels", [])),
+                skip_if_no_results=bool(entry.get("skip_if_no_results", False)),
+                jitter_seconds=float(entry.get("jitter_seconds", 0)),
+                catch_up_hours=float(
+                    entry.get("catch_up_hours", JOB_DEFAULT_CATCH_UP_HOURS)
+                ),
+                max_concurrency=int(entry.get("max_concurrency", 1)),
+                enabled=bool(entry.get("enabled", True)),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(
+                f"警告: ジョブ定義を読み込めませんでした ({entry.get('name')}): {e}"
+            )
+            continue
+        jobs[job.name] = job
+    logger.info(f"ジョブ定義を {len(jobs)} 件読み込みました: {', '.join(jobs)}")
+    return jobs
+
+
+scheduled_jobs = load_scheduled_jobs()
+_running_job_counts = defaultdict(int)
+_job_semaphore = asyncio.Semaphore(SCHEDULER_MAX_CONCURRENT_JOBS)
+
+
+def get_job_channel_ids(job_name):
+    job = scheduled_jobs.get(job_name)
+    return set(job.channels) if job and job.channels else TARGET_CHANNEL_IDS
+
+
+def _create_job_runs_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS job_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_name TEXT NOT NULL,
+        run_key TEXT NOT NULL,
+        scheduled_for TEXT,
+        owner TEXT NOT NULL,
+        started_at DATETIME NOT NULL,
+        finished_at DATETIME,
+        status TEXT NOT NULL,
+        error TEXT
+    )
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job_name, run_key)"
+    )
+
+
+def record_job_run_start(job_name, run_key, scheduled_for):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_runs_table(cursor)
+        cursor.execute(
+            """
+        INSERT INTO job_runs (job_name, run_key, scheduled_for, owner, started_at, status)
+        VALUES (?, ?, ?, ?, ?, 'running')
+        """,
+            (
+                job_name,
+                run_key,
+                scheduled_for.isoformat() if scheduled_for else None,
+                WORKER_ID,
+                datetime.datetime.now(),
+            ),
+        )
+        return cursor.lastrowid
+
+
+def record_job_run_finish(run_id, status, error=None):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE job_runs SET finished_at = ?, status = ?, error = ? WHERE id = ?",
+            (datetime.datetime.now(), status, error, run_id),
+        )
+
+
+def get_last_job_run(job_name, run_key=None):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_job_runs_table(cursor)
+        if run_key is None:
+            cursor.execute(
+                "SELECT * FROM job_runs WHERE job_name = ? ORDER BY id DESC LIMIT 1",
+                (job_name,),
+            )
+        else:
+            cursor.execute(
+                "SELECT * FROM job_runs WHERE job_name = ? AND run_key = ? ORDER BY id DESC LIMIT 1",
+                (job_name, run_key),
+            )
+        return cursor.fetchone()
+
+
+def _scheduled_run_key(job, scheduled_for):
+    # 1日1回のジョブは従来どおり日付単位のキーにする (job_claims との互換のため)
+    if len(job.at) == 1:
+        return scheduled_for.date().isoformat()
+    return scheduled_for.strftime("%Y-%m-%dT%H:%M")
+
+
+def find_due_run(job, now=None):
+    """
+    直近の予定時刻が catch_up_hours 以内なら (run_key, 予定時刻) を返す。
+    停止中に過ぎた予定は、この猶予の間であれば再起動後に実行される。
+    """
+    now = now or datetime.datetime.now(JST)
+    latest = None
+    for time_str in job.at:
+        hour, minute = (int(value) for value in time_str.split(":"))
+        for days_ago in (0, 1):
+            candidate = (now - datetime.timedelta(days=days_ago)).replace(
+                hour=hour, minute=minute, second=0, microsecond=0
+            )
+            if candidate <= now and (latest is None or candidate > latest):
+                latest = candidate
+    if latest is None or now - latest > datetime.timedelta(hours=job.catch_up_hours):
+        return None
+    return _scheduled_run_key(job, latest), latest
+
+
+def _should_retry(job_name, run_key):
+    """失敗直後の再実行を JOB_RETRY_INTERVAL_SECONDS 空ける。"""
+    last_run = get_last_job_run(job_name, run_key)
+    if last_run is None or last_run["status"] != "failed":
+        return True
+    started_at = last_run["started_at"]
+    if isinstance(started_at, str):
+        started_at = datetime.datetime.fromisoformat(started_at)
+    return (
+        datetime.datetime.now() - started_at
+    ).total_seconds() >= JOB_RETRY_INTERVAL_SECONDS
+
+
+async def execute_scheduled_job(job, run_key):
+    """
+    事実収集 → キャラクターで描画 → 履歴に保存 → 配信 を行い、結果の状態を返す。
+    戻り値: succeeded / skipped (該当なし) / failed
+    """
+    facts_by_location = await asyncio.gather(
+        *(
+            gather_grounded_facts_async(
+                job.name,
+                location,
+                job.research_prompt.format(
+                    location=location, no_results=NO_GROUNDED_FACTS_MARKER
+                ),
+            )
+            for location in job.locations
+        )
+    )
+    if job.skip_if_no_results and all(
+        not facts or NO_GROUNDED_FACTS_MARKER in facts for facts in facts_by_location
+    ):
+        logger.info(f"{job.name}: 該当する情報がないためスキップします。")
+        return "skipped"
+    facts_blocks = [
+        (
+            f'<facts location="{location}">\n{facts}\n</facts>'
+            if location
+            else f"<facts>\n{facts}\n</facts>"
+        )
+        for location, facts in zip(job.locations, facts_by_location)
+        if facts and NO_GROUNDED_FACTS_MARKER not in facts
+    ]
+    if not facts_blocks:
+        logger.info(f"{job.name}: 情報を取得できなかったためスキップします。")
+        return "failed"
+
+    # 検索を済ませてからランタイムを取得する (読み込み済みなら共有し、他キャラには影響しない)
+    runtime = await asyncio.to_thread(
+        get_character_runtime, job.character or get_default_character_key()
+    )
+    if not runtime.chat_session:
+        logger.info(f"{job.name}: チャットセッションが未初期化のためスキップします。")
+        return "failed"
+
+    job_prompt = job.prompt_template.format(
+        facts="\n".join(facts_blocks),
+        locations="・".join(location for location in job.locations if location),
+    )
+    response = await runtime.send(
+        [job_prompt],
+        speaker="system",
+        profile=select_generation_profile(job_prompt, job_type=job.job_type),
+    )
+    bot_reply = response.text
+    if not bot_reply or not bot_reply.strip():
+        logger.info(f"{job.name}: 空の応答が返されました。")
+        return "failed"
+
+    await asyncio.to_thread(
+        add_message_to_db, runtime.key, "user", "system", job_prompt
+    )
+    await asyncio.to_thread(add_message_to_db, runtime.key, "model", "bot", bot_reply)
+    await publish_job_output(job.name, run_key, bot_reply)
+    return "succeeded"
+
+
+async def run_scheduled_job(job, run_key, scheduled_for=None, claimed=False):
+    """実行権の取得・同時実行数の制限・実行履歴の記録を行ってジョブを実行する。"""
+    if not claimed and not await asyncio.to_thread(claim_job_run, job.name, run_key):
+        logger.info(f"{job.name}: 他のワーカーが実行済みのためスキップします。")
+        return None
+    _running_job_counts[job.name] += 1
+    try:
+        if job.jitter_seconds and scheduled_for is not None:
+            # 同時刻のジョブや複数ワーカーが一斉に API を叩かないよう分散させる
+            await _sleep_unless_shutting_down(random.uniform(0, job.jitter_seconds))
+        async with _job_semaphore, track_in_flight():
+            if shutting_down:
+                # まだ何も投稿していないので、実行権を返して再起動後のキャッチアップに任せる
+                await asyncio.to_thread(release_job_run, job.name, run_key)
+                logger.info(f"{job.name}: 停止処理中のため実行を見送りました。")
+                return None
+            run_id = await asyncio.to_thread(
+                record_job_run_start, job.name, run_key, scheduled_for
+            )
+            request_id_token = request_id_var.set(f"job:{job.name}:{run_id}")
+            started_at = time.monotonic()
+            status, error = "failed", None
+            try:
+                status = await execute_scheduled_job(job, run_key)
+            except asyncio.CancelledError:
+                # ドレインの期限切れで打ち切られた。途中まで投稿した可能性があるため、
+                # 実行権は持ったまま再試行しない状態で記録する (再起動後に二重投稿しない)
+                status, error = "cancelled", "停止処理で中断"
+                raise
+            except Exception as e:
+                error = str(e)
+                logger.error(f"{job.name} の実行中にエラーが発生しました: {e}")
+            finally:
+                if status == "failed":
+                    await asyncio.to_thread(release_job_run, job.name, run_key)
+                await asyncio.to_thread(record_job_run_finish, run_id, status, error)
+                duration_ms = (time.monotonic() - started_at) * 1000
+                increment_metric(f"jobs.{job.name}.{status}")
+                observe_metric(f"jobs.{job.name}.duration_ms", duration_ms)
+                logger.info(
+                    f"{job.name}: ジョブが終了しました ({status})",
+                    extra={
+                        "event": "job.finished",
+                        "job": job.name,
+                        "status": status,
+                        "latency_ms": round(duration_ms, 1),
+                    },
                 )
+                request_id_var.reset(request_id_token)
+        return status
+    finally:
+        _running_job_counts[job.name] -= 1
 
-    except Exception as e:
-        print(f"ぼっちニュースアナウンス中にエラーが発生しました: {e}")
+
+async def _sleep_unless_shutting_down(seconds):
+    """seconds 秒待つ。停止処理が始まったら待つのをやめる。"""
+    until = time.monotonic() + seconds
+    while not shutting_down and time.monotonic() < until:
+        await asyncio.sleep(min(1.0, until - time.monotonic()))
+
+
+@tasks.loop(seconds=60)
+async def job_scheduler():
+    """期限の来たジョブを (停止中に過ぎた分も猶予内なら) 並行して起動する。"""
+    now = datetime.datetime.now(JST)
+    for job in scheduled_jobs.values():
+        if not job.enabled or _running_job_counts[job.name] >= job.max_concurrency:
+            continue
+        due = find_due_run(job, now)
+        if due is None:
+            continue
+        run_key, scheduled_for = due
+        try:
+            if not await asyncio.to_thread(
+                _should_retry, job.name, run_key
+            ) or not await asyncio.to_thread(claim_job_run, job.name, run_key):
+                continue
+        except Exception as e:
+            logger.error(f"{job.name}: スケジュール確認中にエラーが発生しました: {e}")
+            continue
+        if now - scheduled_for > datetime.timedelta(minutes=5):
+            logger.info(
+                f"{job.name}: {scheduled_for.strftime('%m/%d %H:%M')} の実行分を遅れて実行します。"
+            )
+            increment_metric("jobs.catch_up_runs")
+        task = start_background_task(
+            run_scheduled_job(job, run_key, scheduled_for, claimed=True)
+        )
+        scheduled_job_tasks.add(task)
+        task.add_done_callback(scheduled_job_tasks.discard)
+
+
+async def run_job_now(name):
+    """ジョブを手動で即時実行する (定期実行とは別の実行キーを使う)。"""
+    job = scheduled_jobs.get(name)
+    if job is None:
+        return None
+    return await run_scheduled_job(job, _job_run_key(force=True))
+
+
+@bot.command("runjob")
+@commands.has_permissions(administrator=True)
+async def runjob_command(ctx, job_name: str):
+    """定期ジョブを即時実行します（管理者専用）。使用法: !runjob <ジョブ名>"""
+    if job_name not in scheduled_jobs:
+        await ctx.send(
+            f"ジョブ「{job_name}」は定義されていません。`!jobs` で一覧を確認できます。",
+            mention_author=False,
+        )
+        return
+    async with ctx.channel.typing():
+        status = await run_job_now(job_name)
+    if status != "succeeded":
+        await ctx.send(f"ジョブ「{job_name}」: {status}", mention_author=False)
+
+
+@bot.command("jobs")
+@commands.has_permissions(administrator=True)
+async def jobs_command(ctx):
+    """定期ジョブの一覧と直近の実行結果を表示します（管理者専用）。"""
+    if not scheduled_jobs:
+        await ctx.send("定義されているジョブはありません。", mention_author=False)
+        return
+    lines = []
+    for job in scheduled_jobs.values():
+        last_run = await asyncio.to_thread(get_last_job_run, job.name)
+        last_text = (
+            f"{last_run['status']} ({str(last_run['started_at'])[:16]})"
+            if last_run
+            else "未実行"
+        )
+        lines.append(
+            f"- `{job.name}` {','.join(job.at)} JST / {job.character or '既定キャラ'}"
+            f"{'' if job.enabled else ' (無効)'} / 前回: {last_text}"
+        )
+    await ctx.send("定期ジョブ:\n" + "\n".join(lines), mention_author=False)
+
+
+@bot.command("weather")
+@commands.has_permissions(administrator=True)
+async def weather_command(ctx):
+    """天気アナウンスを即時実行するテスト用コマンド（管理者専用）。"""
+    async with ctx.channel.typing():
+        await run_job_now("morning_weather")
 
 
 @bot.command("bocchinews")
@@ -505,92 +2276,151 @@ async def bocchi_news_announcement():
 async def bocchi_news_command(ctx):
     """ぼっちニュースアナウンスを即時実行するテスト用コマンド（管理者専用）。"""
     async with ctx.channel.typing():
-        await bocchi_news_announcement()
+        await run_job_now("bocchi_news")
 
 
-@tasks.loop(
-    time=datetime.time(
-        hour=17,
-        minute=0,
-        second=0,
-        tzinfo=datetime.timezone(datetime.timedelta(hours=9)),
-    )
+@bot.command("alcoholreview")
+@commands.has_permissions(administrator=True)
+async def alcohol_review_command(ctx):
+    """安酒レビューを即時実行するテスト用コマンド（管理者専用）。"""
+    async with ctx.channel.typing():
+        await run_job_now("alcohol_review")
+
+
+# --- 起動パイプライン (独立した初期化を並行実行し、フェーズごとの所要時間を記録) ---
+STARTUP_ANNOUNCE_DELAY_SECONDS = float(
+    os.getenv("STARTUP_ANNOUNCE_DELAY_SECONDS", "30")
 )
-async def evening_alcohol_review():
-    """毎晩17時(JST)にきくりに一時切り替えして安酒レビューをアナウンスし、元のキャラに戻す。"""
-    global shared_chat_session, active_character_key
+startup_phase_timings = {}  # フェーズ名 -> 所要ミリ秒
+_startup_preparation = None  # setup_hook で開始する初期化タスク
+_startup_completed = False
 
-    original_character_key = active_character_key
 
+background_tasks = (
+    set()
+)  # 実行中のバックグラウンドタスクが GC されないよう参照を保持する
+
+
+scheduled_job_tasks = set()  # 停止時に待つ (間に合わなければ中断を記録する) 定期ジョブ
+
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def _timed_phase(name, awaitable):
+    started_at = time.monotonic()
     try:
-        # きくりに一時切り替え
-        initialize_chat_session("kikuri")
-        if not shared_chat_session:
-            print("安酒レビュー: きくりセッションの初期化に失敗したためスキップします。")
-            return
+        return await awaitable
+    finally:
+        elapsed_ms = (time.monotonic() - started_at) * 1000
+        startup_phase_timings[name] = elapsed_ms
+        observe_metric(f"startup.{name}_ms", elapsed_ms)
 
-        review_prompt = (
-            "GoogleSearchを使って今日飲むならこれ！というおすすめの安酒（コンビニ・スーパーで買えるもの）を"
-            "1種類調べてください。値段・味の特徴・どんなシーンに合うかを含め、"
-            "きくりとしての口調でDiscordの特定の誰かではなく、みんなに向けて今日の安酒レビューをしてください。"
-            "2000文字以内でまとめてください。"
+
+def warm_gemini_connection():
+    """クライアント生成とモデル情報の取得で、Gemini への接続 (DNS/TLS) を事前に確立する。"""
+    try:
+        get_genai_client().models.get(model=MODEL_NAME)
+    except Exception as e:
+        logger.error(
+            f"Gemini 接続のウォームアップに失敗しました (起動は続行します): {e}"
         )
 
-        send_time_iso = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
-        formatted_prompt = f"システム\n{send_time_iso}\n{review_prompt}"
 
-        response = _send_message_with_retry(shared_chat_session, [formatted_prompt])
-        bot_reply = response.text
-        if not bot_reply or not bot_reply.strip():
-            print("安酒レビュー: 空応答のためスキップします。")
-            return
+async def _read_git_head():
+    try:
+        return await _run_git("rev-parse", "HEAD")
+    except Exception as e:
+        logger.error(f"アップデート検知: git コマンド失敗のためスキップします: {e}")
+        return None
 
-        add_message_to_db("user", "system", formatted_prompt)
-        add_message_to_db("model", "bot", bot_reply)
 
-        for channel_id in TARGET_CHANNEL_IDS:
-            channel = bot.get_channel(channel_id)
-            if channel:
-                await channel.send(bot_reply)
-            else:
-                print(
-                    f"安酒レビュー: チャンネルID {channel_id} が見つかりませんでした。"
-                )
+async def prepare_startup():
+    """Discord への接続と並行して、セッション構築・接続ウォームアップ・git 読み取りを行う。"""
+    _, _, git_head = await asyncio.gather(
+        _timed_phase(
+            "session",
+            asyncio.to_thread(load_routed_character_runtimes, restore_snapshot=True),
+        ),
+        _timed_phase("gemini_warmup", asyncio.to_thread(warm_gemini_connection)),
+        _timed_phase("git_head", _read_git_head()),
+    )
+    return git_head
 
-    except Exception as e:
-        print(f"安酒レビュー中にエラーが発生しました: {e}")
 
-    finally:
-        # 元のキャラに戻す
-        if original_character_key:
-            initialize_chat_session(original_character_key)
-            print(f"安酒レビュー: キャラクターを「{original_character_key}」に戻しました。")
-            for channel_id in TARGET_CHANNEL_IDS:
-                channel = bot.get_channel(channel_id)
-                if channel:
-                    await channel.send(f"（{active_character_display_name} に戻りました）")
+async def _deferred_update_announcement(git_head):
+    await asyncio.sleep(STARTUP_ANNOUNCE_DELAY_SECONDS)
+    await _announce_update_if_needed(git_head)
 
 
-@bot.command("alcoholreview")
-@commands.has_permissions(administrator=True)
-async def alcohol_review_command(ctx):
-    """安酒レビューを即時実行するテスト用コマンド（管理者専用）。"""
-    async with ctx.channel.typing():
-        await evening_alcohol_review()
+@bot.event
+async def setup_hook():
+    global _startup_preparation
+    startup_phase_timings["login"] = (time.monotonic() - PROCESS_STARTED_AT) * 1000
+    _startup_preparation = asyncio.create_task(prepare_startup())
+    if LEAN_RUNTIME:
+        await asyncio.to_thread(list_autospeak_channels)
+        install_gateway_message_filter()
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: start_background_task(graceful_shutdown())
+        )
+    except NotImplementedError:
+        logger.warning("このプラットフォームでは SIGTERM ハンドラを登録できません。")
 
 
 @bot.event
 async def on_ready():
-    print(f"{bot.user.name} がDiscordに接続しました！")
-    print("------")
-    initialize_chat_session()
-    if not morning_weather_announcement.is_running():
-        morning_weather_announcement.start()
-    if not bocchi_news_announcement.is_running():
-        bocchi_news_announcement.start()
-    if not evening_alcohol_review.is_running():
-        evening_alcohol_review.start()
-    await _announce_update_if_needed()
+    global _startup_completed
+    logger.info(f"{bot.user.name} がDiscordに接続しました！")
+    if _startup_completed:
+        # 再接続時の on_ready では初期化をやり直さない
+        return
+    startup_phase_timings["gateway_ready"] = (
+        time.monotonic() - PROCESS_STARTED_AT
+    ) * 1000
+
+    git_head = None
+    try:
+        git_head = await _startup_preparation
+    except Exception as e:
+        logger.error(f"起動時の初期化中にエラーが発生しました: {e}")
+    await run_history_guild_backfill()
+    if not job_scheduler.is_running():
+        job_scheduler.start()
+    if not history_maintenance.is_running():
+        history_maintenance.start()
+    if not index_conversation_memory.is_running():
+        index_conversation_memory.start()
+    if not refresh_user_profiles.is_running():
+        refresh_user_profiles.start()
+    if not sample_memory_usage.is_running():
+        sample_memory_usage.start()
+    if STARTER_ENABLED:
+        if not pregenerate_conversation_starters.is_running():
+            pregenerate_conversation_starters.start()
+        if not autospeak_idle_channels.is_running():
+            autospeak_idle_channels.start()
+    if IS_MULTI_WORKER:
+        if not deliver_pending_job_outputs.is_running():
+            deliver_pending_job_outputs.start()
+
+    _startup_completed = True
+    time_to_ready_ms = (time.monotonic() - PROCESS_STARTED_AT) * 1000
+    observe_metric("startup.time_to_ready_ms", time_to_ready_ms)
+    breakdown = ", ".join(
+        f"{name}={elapsed_ms:.0f}ms"
+        for name, elapsed_ms in startup_phase_timings.items()
+    )
+    logger.info(f"起動完了: time-to-ready {time_to_ready_ms:.0f}ms ({breakdown})")
+
+    # アップデート通知は応答可能になってから遅れて行う
+    if git_head:
+        start_background_task(_deferred_update_announcement(git_head))
 
 
 @bot.event
@@ -608,502 +2438,3800 @@ async def on_message(message):
     # ctx.command が None でないこと、または単純にプレフィックスで始まるかで判定します。
     # 単純にプレフィックスで始まるかで判定する方が、未定義コマンドへのAI応答も防げるので推奨です。
     if is_command_message(message):
-        print(
-            f"コマンドメッセージを検出しました: {message.content[:50]}..."
-        )  # デバッグ用
+        # 本文はログに残さない (コマンド名と長さのみ)
+        logger.debug(
+            "コマンドメッセージを検出しました: %s (%s文字)",
+            message.content[len(bot.command_prefix) :].partition(" ")[0] or "-",
+            len(message.content),
+            extra={"event": "message.command"},
+        )
         return  # コマンドとして処理されたので、通常のメッセージ処理は行わない
 
-    if not shared_chat_session:
-        await message.channel.send(
-            "ボットのチャット機能が準備中です。少し待ってからもう一度お試しください。"
+    is_mentioned = bot.user.mentioned_in(message)
+    should_respond = should_respond_to_message(message)
+
+    if not should_respond:
+        return
+
+    if shutting_down:
+        # 終了処理中は新しいリクエストを受け付けない (処理中のものはドレインを待つ)
+        logger.info("終了処理中のため、新しいメッセージへの応答をスキップします。")
+        return
+
+    # このメッセージに関するログ (Gemini 呼び出し・リトライ等) を同じIDで追えるようにする
+    request_id_var.set(f"m{message.id}")
+    received_at = time.monotonic()
+
+    # チャンネルに割り当てられたキャラクター (読み込み済みなら他チャンネルと共有)
+    runtime = await asyncio.to_thread(get_channel_runtime, message.channel)
+    if not runtime.chat_session:
+        await message.channel.send(
+            "ボットのチャット機能が準備中です。少し待ってからもう一度お試しください。"
+        )
+        return
+
+    user_input = build_user_input(message, is_mentioned)
+    async with track_in_flight(), admit_request(
+        message.author.id, message.channel.id, user_input
+    ) as ticket:
+        if ticket.status == "merged":
+            # 待機中の同じユーザーのメッセージと一緒に応答する
+            with contextlib.suppress(discord.HTTPException):
+                await message.add_reaction("📥")
+            return
+        if ticket.status != "admitted":
+            if get_admission_controller().should_send_busy_notice(message.channel.id):
+                await message.reply(BUSY_NOTICE_TEXT, mention_author=False)
+            return
+        if ticket.merged_inputs:
+            user_input = "\n".join([user_input] + ticket.merged_inputs)
+
+        async with message.channel.typing():
+            attachment_contents = []
+            if message.attachments:
+                attachment_contents = await extract_supported_attachment_parts(message)
+
+            author_name = message.author.display_name
+            url_parts, all_urls_prefetched = await prefetch_url_parts(user_input)
+            memory_parts = await retrieve_memory_parts(runtime.key, user_input)
+            profile = select_generation_profile(
+                user_input,
+                attachment_count=len(attachment_contents),
+                urls_prefetched=all_urls_prefetched,
+            )
+            bot_reply = await handle_shared_discord_message(
+                runtime,
+                author_name,
+                user_input,
+                attachment_contents + url_parts + memory_parts,
+                profile=profile,
+                guild_id=message.guild.id if message.guild else None,
+                author_id=message.author.id,
+            )
+
+            if bot_reply and bot_reply.strip():  # Ensure there's non-whitespace content
+                await message.reply(bot_reply, mention_author=False)
+                logger.info(
+                    "メッセージに応答しました",
+                    extra={
+                        "event": "message.replied",
+                        "character": runtime.key,
+                        "profile": profile.name,
+                        "latency_ms": round((time.monotonic() - received_at) * 1000, 1),
+                        "chars": len(bot_reply),
+                    },
+                )
+            else:
+                logger.warning(
+                    "Warning: Bot generated an empty or whitespace-only reply.",
+                    extra={"event": "message.empty_reply"},
+                )
+
+
+MODEL_NAME = "gemini-3-flash-preview"
+GEMINI_ATTEMPT_TIMEOUT_SECONDS = float(
+    os.getenv("GEMINI_ATTEMPT_TIMEOUT_SECONDS", "40")
+)
+GEMINI_REQUEST_DEADLINE_SECONDS = float(
+    os.getenv("GEMINI_REQUEST_DEADLINE_SECONDS", "90")
+)  # 1リクエスト (リトライ・フォールバック込み) にかけてよい最大時間
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+GEMINI_RETRY_BUDGET_RATIO = float(
+    os.getenv("GEMINI_RETRY_BUDGET_RATIO", "0.2")
+)  # 初回試行1回あたりに積み立てるリトライ枠
+GEMINI_RETRY_BUDGET_MAX_TOKENS = float(
+    os.getenv("GEMINI_RETRY_BUDGET_MAX_TOKENS", "10")
+)
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(
+    os.getenv("GEMINI_BREAKER_FAILURE_THRESHOLD", "5")
+)
+GEMINI_BREAKER_COOLDOWN_SECONDS = float(
+    os.getenv("GEMINI_BREAKER_COOLDOWN_SECONDS", "60")
+)
+GEMINI_FALLBACK_MODEL_NAME = os.getenv(
+    "GEMINI_FALLBACK_MODEL_NAME", "gemini-2.5-flash-lite"
+).strip()  # 空文字でフォールバック無効
+GEMINI_FALLBACK_MIN_SECONDS = float(
+    os.getenv("GEMINI_FALLBACK_MIN_SECONDS", "5")
+)  # デッドラインまでの残り時間がこれ未満ならフォールバックモデルを試さない
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+client = None  # 起動時間短縮のため初回利用時に生成する (get_genai_client)
+_client_lock = threading.Lock()
+
+
+def get_genai_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                client = genai.Client(
+                    api_key=GOOGLE_API_KEY,
+                    # 1回の試行がハングしてもデッドライン内に打ち切れるよう HTTP タイムアウト (ミリ秒) を設定
+                    http_options=HttpOptions(
+                        timeout=int(GEMINI_ATTEMPT_TIMEOUT_SECONDS * 1000)
+                    ),
+                )
+    return client
+
+
+google_search_tool = Tool(google_search=GoogleSearch())
+google_url_context_tool = Tool(url_context=UrlContext())
+
+
+DB_FILE = "chat_history.db"
+
+
+def adapt_datetime_iso(dt_obj):
+    """datetime.datetime オブジェクトをISO 8601形式の文字列に変換するアダプタ"""
+    return dt_obj.isoformat()
+
+
+def convert_iso_to_datetime(iso_str_bytes):
+    """ISO 8601形式の文字列 (bytes型) をdatetime.datetime オブジェクトに変換するコンバータ"""
+    # DBから読み取られる値はbytes型なので、適切なエンコーディングでstr型にデコードする
+    return datetime.datetime.fromisoformat(iso_str_bytes.decode("utf-8"))
+
+
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SQLITE_BUSY_TIMEOUT_SECONDS", "30"))
+_db_wal_enabled = False
+
+
+def get_db_connection():
+    global _db_wal_enabled
+    # detect_types パラメータを設定して、登録したコンバータが機能するようにする
+    # 複数ワーカーが同じDBを共有するため、ロック競合時は timeout まで待つ
+    conn = sqlite3.connect(
+        DB_FILE,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+    )
+    conn.row_factory = sqlite3.Row  # カラム名でアクセスできるようにする
+    if not _db_wal_enabled:
+        # WAL はDBファイルに永続化される設定。読み取りが書き込みをブロックしないようにする
+        conn.execute("PRAGMA journal_mode=WAL")
+        _db_wal_enabled = True
+    return conn
+
+
+# sqlite3モジュールにアダプタを登録: Pythonのdatetime.datetime型を上記関数で変換
+sqlite3.register_adapter(datetime.datetime, adapt_datetime_iso)
+
+# sqlite3モジュールにコンバータを登録: DBの "datetime" 型 (宣言) の値を上記関数で変換
+# "datetime" はテーブル作成時の型宣言 (TIMESTAMP や DATETIME) に対応
+sqlite3.register_converter(
+    "datetime", convert_iso_to_datetime
+)  # テーブルの型宣言に合わせる
+sqlite3.register_converter(
+    "timestamp", convert_iso_to_datetime
+)  # TIMESTAMP型も同様に扱う場合
+
+
+def get_history_table_name(character_key):
+    # キャラクターキーから安全なテーブル名を生成
+    # ここでは簡易的にキーのプレフィックスとするが、より厳密な検証が必要な場合がある
+    if (
+        not isinstance(character_key, str) or not character_key.isalnum()
+    ):  # 例: 英数字のみを許可
+        logger.warning(f"警告: 不正なキャラクターキーが指定されました: {character_key}")
+        # 不正なキーの場合はデフォルトやエラーを示すテーブル名を返す
+        return "history_default_invalid"
+    return f"history_{character_key}"
+
+
+# 移行前の行の最大 ID を「guild_backfill_until:<テーブル名>」として bot_settings に保存する
+GUILD_BACKFILL_SETTING_PREFIX = "guild_backfill_until:"
+
+
+def create_table_if_not_exists(character_key):
+    if character_key is None:
+        raise ValueError(
+            "キャラクターキーが指定されていません。テーブル名決定できません。"
+        )
+
+    table_name = get_history_table_name(character_key)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role TEXT NOT NULL,
+            author_name TEXT,
+            content TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            guild_id INTEGER,
+            author_id INTEGER
+        )
+        """
+        )
+        # 列がない旧テーブルに追加する (既存行はサーバー・発言者ID不明の NULL)
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        columns = {row["name"] for row in cursor.fetchall()}
+        for column in ("guild_id", "author_id"):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} INTEGER")
+        if "guild_id" not in columns:
+            # 移行前の行の範囲を覚えておき、サーバーが決まれば接続後に埋める
+            # (backfill_history_guild_ids。移行後に NULL で保存される定期ジョブの行は対象外)
+            cursor.execute(f"SELECT MAX(id) FROM {table_name}")
+            last_legacy_id = cursor.fetchone()[0]
+            if last_legacy_id is not None:
+                cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)"
+                )
+                cursor.execute(
+                    "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
+                    (
+                        f"{GUILD_BACKFILL_SETTING_PREFIX}{table_name}",
+                        str(last_legacy_id),
+                    ),
+                )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {table_name}_guild_id ON {table_name} (guild_id, id)"
+        )
+    ensure_history_fts(character_key)
+
+
+def list_pending_guild_backfills():
+    """guild_id を埋めていない移行前の行がある履歴テーブルと、その最大行IDを返す。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        cursor.execute(
+            "SELECT key, value FROM bot_settings WHERE key LIKE ?",
+            (f"{GUILD_BACKFILL_SETTING_PREFIX}%",),
+        )
+        return {
+            row["key"][len(GUILD_BACKFILL_SETTING_PREFIX) :]: int(row["value"])
+            for row in cursor.fetchall()
+        }
+
+
+def backfill_history_guild_ids(guild_id):
+    """移行前の行 (guild_id が NULL) を guild_id のサーバーのものとして埋める。埋めた行数を返す。"""
+    updated = 0
+    for table_name, last_legacy_id in list_pending_guild_backfills().items():
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE {table_name} SET guild_id = ? WHERE guild_id IS NULL AND id <= ?",
+                (guild_id, last_legacy_id),
+            )
+            updated += cursor.rowcount
+            cursor.execute(
+                "DELETE FROM bot_settings WHERE key = ?",
+                (f"{GUILD_BACKFILL_SETTING_PREFIX}{table_name}",),
+            )
+    return updated
+
+
+def derive_legacy_guild_id():
+    """
+    移行前の行がどのサーバーのものか決められるならそのサーバーID、決められなければ None。
+    TARGET_CHANNEL_IDS がすべて1つのサーバーにあるか、Bot が1つのサーバーにしか参加していない場合に限る。
+    """
+    if TARGET_CHANNEL_IDS:
+        channels = [bot.get_channel(channel_id) for channel_id in TARGET_CHANNEL_IDS]
+        if any(getattr(channel, "guild", None) is None for channel in channels):
+            return None  # DM や他のワーカーが担当するチャンネルを含む
+        guild_ids = {channel.guild.id for channel in channels}
+    elif IS_MULTI_WORKER:
+        return None  # 他のワーカーのサーバーが見えない
+    else:
+        guild_ids = {guild.id for guild in bot.guilds}
+    return guild_ids.pop() if len(guild_ids) == 1 else None
+
+
+async def run_history_guild_backfill():
+    """接続後に1回、移行前の履歴行のサーバーを埋める。決められなければ管理者向けの検索に任せる。"""
+    try:
+        if not await asyncio.to_thread(list_pending_guild_backfills):
+            return
+        guild_id = derive_legacy_guild_id()
+        if guild_id is None:
+            logger.warning(
+                "移行前の履歴のサーバーを特定できないため guild_id を埋めませんでした。"
+                "管理者は !search の scope:legacy で検索できます。"
+            )
+            return
+        updated = await asyncio.to_thread(backfill_history_guild_ids, guild_id)
+        logger.info(f"移行前の履歴 {updated} 行にサーバー {guild_id} を設定しました。")
+    except sqlite3.Error as e:
+        logger.error(f"移行前の履歴のサーバー設定中にエラーが発生しました: {e}")
+
+
+def add_message_to_db(
+    character_key, role, author_name, content, guild_id=None, author_id=None
+):
+    """
+    発言を履歴に保存する。guild_id は発言のあったサーバーで、!search の範囲を絞るのに使う
+    (DM や複数サーバーに配信する定期ジョブは None)。author_id は発言者の Discord ユーザーID で、
+    表示名は重複・変更できるため、プロフィールなど人に紐づく情報はこちらで引く。
+    """
+    if character_key is None:
+        raise ValueError(
+            "キャラクターキーが指定されていません。メッセージ保存できません。"
+        )
+
+    table_name = get_history_table_name(character_key)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+        INSERT INTO {table_name} (role, author_name, content, timestamp, guild_id, author_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (role, author_name, content, datetime.datetime.now(), guild_id, author_id),
+        )
+
+
+PROMPT_DIR = "character_prompts"
+
+
+def _load_raw_character_data(character_filename_key):
+    """指定されたキーのキャラクターデータをJSONファイルからそのまま読み込むヘルパー関数"""
+    prompt_file_path = os.path.join(PROMPT_DIR, f"{character_filename_key}.json")
+    if not os.path.exists(prompt_file_path):
+        logger.warning(
+            f"警告: キャラクターデータファイルが見つかりません: {prompt_file_path}"
+        )
+        return None
+    try:
+        with open(prompt_file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data
+    except Exception as e:
+        logger.error(
+            f"エラー: キャラクターデータファイルの読み込み/解析に失敗 ({prompt_file_path}): {e}"
+        )
+        return None
+
+
+def load_character_definition(main_character_key, processed_relations=None):
+    """
+    指定されたキー (ファイル名から拡張子を除いたもの) に基づいて
+    キャラクタープロンプトファイルを読み込み、初期履歴と表示名を返す。
+    """
+    if processed_relations is None:
+        processed_relations = set()
+
+    if main_character_key in processed_relations:
+        return "", [], main_character_key
+
+    processed_relations.add(main_character_key)
+
+    main_char_data = _load_raw_character_data(main_character_key)
+    if not main_char_data:
+        return "", [], main_character_key
+
+    display_name = main_char_data.get("character_name_display", main_character_key)
+    system_instruction_user = main_char_data.get(
+        "system_instruction_user", ""
+    )  # メインキャラの基本指示
+    # 以下は Gemini のプロンプト ベストプラクティスに沿った構造化された補助指示です。
+    system_instruction_user += (
+        "\n\n<context>キャラクター設定として上記のプロンプトを前提とする。</context>\n"
+        "<task>目的: ユーザーと自然な会話を継続し、キャラクター性（口調・動機）を一貫して守る。</task>\n"
+        f"<input_format>{TURN_FORMAT_DESCRIPTION}\n"
+        '画像は別のPartオブジェクトとして渡されることがある。発言中のURLの本文は <url_content url="..."> で囲んだテキストPartとして渡されることがあり、その場合は UrlContext を使わずにこの本文を参照する。<memory> で囲んだテキストPartは過去の会話から検索した関連発言で、必要なときだけ参考にする。</input_format>\n'
+        "<note>送信時刻は JST で与えられます。発言内容の時間的文脈が必要な場合はこの時刻を参照してください。モデルは自身で時刻を推測せず、この提供された時刻を優先して扱ってください。</note>\n"
+        "<output_requirements>言語: 日本語。デフォルトは簡潔で直接的。必要ならユーザーが「詳しく」と要求する。出力は会話文、相手の名前を明示して応答、Discord制限: 最大2000文字。</output_requirements>\n"
+        "<constraints>'私はAI' を明示しない。差別的・違法行為助長表現禁止。\n発言者名が異なる場合は別人として扱うこと。\n文体・語彙・文長を定期的に変化させ、過度に似た導入句や決まり文句を避ける。過去の自分の発言をそのまま繰り返したり逐次的に修正するような出力を行わないこと。\n回答に必要な事実がプロンプト内にない場合は推測で断定せず、GoogleSearch を使って確認すること。\nキャラクター設定に不足している情報が必要な場合も、創作せず GoogleSearch で確認し、確認できない要素は断定しないこと。</constraints>\n"
+        "<tools>利用可能なツール: UrlContext(指定されたURLの内容を読み取る)、GoogleSearch(情報検索)。これらのツールは必要に応じて使用して正確な情報を取得してください。プロンプトや会話履歴・画像だけでは回答に必要な情報が不足している場合や、キャラクター情報の補完が必要な場合は、推測で補わず GoogleSearch を使って確認してください。ツールを使った結果はツールの出力を忠実に扱い、事実確認が取れない場合はその旨を明示してください。</tools>\n"
+        "<multi_modal>画像: Partオブジェクトを受け取る。画像に基づく記述は簡潔に、視覚的情報を補助的に扱う。</multi_modal>\n"
+        "<priority>優先順: task/constraints/output_requirements > tools > multi_modal。</priority>\n"
+        "<anchor>上記指示に基づき、以下のユーザー入力に答えてください:</anchor>\n"
+    )
+
+    if not system_instruction_user:
+        logger.warning(
+            f"警告: メインキャラクター「{display_name}」のプロンプト基本情報が不完全です。"
+        )
+
+    final_initial_prompts = []
+    return system_instruction_user, final_initial_prompts, display_name
+
+
+def get_setting_from_db(key, default_value=None):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
+        row = cursor.fetchone()
+    return row[0] if row else default_value
+
+
+def set_setting_in_db(key, value):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+
+# --- モデルに送る発言の簡潔な表記 (トークン削減) ---
+# 発言者はセッション内の短い別名 (U1, U2, … / システムは SYS) で表し、初出時だけ
+# 「[U1=名前 10/19 14:05]」のように名前を添える。時刻は分単位で、日付は変わったときだけ付ける。
+# 見出し行は発言者が変わったか、前回表示した時刻から TURN_HEADER_GAP_MINUTES 以上経ったときだけ出す。
+COMPACT_TURNS_ENABLED = os.getenv("COMPACT_TURNS_ENABLED", "true").lower() not in (
+    "0",
+    "false",
+)
+TURN_HEADER_GAP_MINUTES = int(os.getenv("TURN_HEADER_GAP_MINUTES", "10"))
+SYSTEM_SPEAKER_NAMES = ("system", "システム")
+TURN_FORMAT_DESCRIPTION = (
+    "ユーザー発言の1行目に [U1=発言者名 10/19 14:05] のような見出しが付くことがあります。"
+    "U1 などは発言者の別名で、名前は初出時だけ示されます (SYS はシステムからの指示)。"
+    "時刻は日本標準時/JST の分単位で、日付が変わったときだけ日付を付けます。"
+    "見出しがない発言は直前と同じ発言者で、時刻もほぼ同じです。"
+    if COMPACT_TURNS_ENABLED
+    else "ユーザー発言は次の形式で送られます\n発言者名\n送信時刻(ISO 8601, タイムゾーン付き・日本標準時/JSTで提供されます)\n発言内容"
+)
+
+
+# 旧形式の見出しの送信時刻 (datetime.isoformat() の出力。日付だけの行は本文とみなす)
+LEGACY_HEADER_TIME_PATTERN = re.compile(
+    r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?([+-]\d{2}:\d{2})?"
+)
+# 旧形式では author_name が "system" の行の見出しは「システム」だった
+LEGACY_HEADER_AUTHOR_ALIASES = {"system": "システム"}
+
+
+def _split_legacy_header(content, author_name):
+    """
+    旧形式「発言者名\\n送信時刻\\n発言内容」なら (送信時刻, 発言内容)、それ以外は (None, content)。
+    本文が日付などで始まる新形式の行を取り違えないよう、1行目がその行の発言者名で、
+    2行目が時刻まで含む送信時刻のときだけ見出しとみなす。
+    """
+    parts = (content or "").split("\n", 2)
+    if len(parts) == 3 and parts[0] in (
+        author_name,
+        LEGACY_HEADER_AUTHOR_ALIASES.get(author_name),
+    ):
+        if LEGACY_HEADER_TIME_PATTERN.fullmatch(parts[1]):
+            try:
+                return datetime.datetime.fromisoformat(parts[1]), parts[2]
+            except ValueError:
+                pass
+    return None, content or ""
+
+
+def _history_row_time(row):
+    """履歴行の送信時刻 (JST)。旧形式の行は見出しの時刻、それ以外は timestamp 列 (ローカル時刻) を使う。"""
+    sent_at, _ = _split_legacy_header(row["content"], row["author_name"])
+    if sent_at is None:
+        sent_at = row["timestamp"]
+        if isinstance(sent_at, str):
+            sent_at = datetime.datetime.fromisoformat(sent_at)
+    if sent_at is None:
+        return None
+    return sent_at.astimezone(JST)  # naive な値はローカル時刻として扱われる
+
+
+class TurnEncoder:
+    """
+    1つのチャットセッションに送る user ターンの見出しを組み立てる。
+    別名や直前の発言者はセッションの履歴と対応しているため、セッションを作り直すときは
+    新しいエンコーダで DB の行を同じ順に通し直す (スナップショットには状態を保存する)。
+    """
+
+    def __init__(self, state=None):
+        self.restore(state)
+
+    def restore(self, state):
+        state = state or {}
+        self.aliases = dict(state.get("aliases", {}))  # 発言者名 -> 別名
+        self.last_speaker = state.get("last_speaker")
+        self.last_shown_at = (
+            datetime.datetime.fromisoformat(state["last_shown_at"])
+            if state.get("last_shown_at")
+            else None
+        )
+
+    def to_dict(self):
+        return {
+            "aliases": dict(self.aliases),
+            "last_speaker": self.last_speaker,
+            "last_shown_at": (
+                self.last_shown_at.isoformat() if self.last_shown_at else None
+            ),
+        }
+
+    def _alias_label(self, author_name):
+        alias = self.aliases.get(author_name)
+        if alias is not None:
+            return alias
+        if author_name in SYSTEM_SPEAKER_NAMES:
+            self.aliases[author_name] = "SYS"
+            return "SYS=システム"
+        alias = f"U{sum(1 for a in self.aliases.values() if a != 'SYS') + 1}"
+        self.aliases[author_name] = alias
+        return f"{alias}={author_name}"
+
+    def encode(self, author_name, text, sent_at=None):
+        sent_at = (sent_at or datetime.datetime.now(JST)).astimezone(JST)
+        if not COMPACT_TURNS_ENABLED:
+            return f"{author_name}\n{sent_at.isoformat()}\n{text}"
+        sent_at = sent_at.replace(second=0, microsecond=0)
+        previous = self.last_shown_at
+        show_time = (
+            previous is None
+            or sent_at.date() != previous.date()
+            or sent_at - previous >= datetime.timedelta(minutes=TURN_HEADER_GAP_MINUTES)
+        )
+        if author_name == self.last_speaker and not show_time:
+            return text
+
+        labels = [self._alias_label(author_name)]
+        if show_time:
+            same_day = previous is not None and sent_at.date() == previous.date()
+            labels.append(sent_at.strftime("%H:%M" if same_day else "%m/%d %H:%M"))
+            self.last_shown_at = sent_at
+        self.last_speaker = author_name
+        return f"[{' '.join(labels)}]\n{text}"
+
+
+def load_history_from_db(
+    character_key, limit=100, encoder=None
+):  # 例: 直近100件のやり取りを読み込む
+    """直近 limit 件をモデル入力用の履歴にする。user ターンは encoder (省略時は新規) で表記する。"""
+    if character_key is None:
+        raise ValueError(
+            "キャラクターキーが指定されていません。履歴読み込みできません。"
+        )
+
+    table_name = get_history_table_name(character_key)
+
+    conn = None
+    raw_rows_from_db = []  # DBから直接読み込んだ行データ
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # timestampの降順で最新N件を取得し、それをさらに昇順に並べ替える
+        # (SQLiteではサブクエリやウィンドウ関数が使えるが、シンプルに全件取得してPython側でハンドリングも可)
+        # ここではシンプルに最新N件のメッセージを取得（userとmodelそれぞれを1件と数える）
+        cursor.execute(
+            f"""
+        SELECT role, author_name, content, timestamp FROM (
+            SELECT role, author_name, content, timestamp
+            FROM {table_name}
+            ORDER BY timestamp DESC
+            LIMIT ?
+        ) ORDER BY timestamp ASC
+        """,
+            (limit,),
+        )
+        raw_rows_from_db = cursor.fetchall()
+        logger.debug(
+            f"テーブル {table_name} から {len(raw_rows_from_db)} 件の履歴をDBより読み込みました。"
+        )  # テーブル名を出力
+    except sqlite3.OperationalError as e:
+        # テーブルが存在しない場合などに発生するエラー
+        logger.info(
+            f"情報: テーブル {table_name} が見つからないかアクセスできません。新しい履歴として扱います。エラー詳細: {e}"
+        )
+        # raw_rows_from_db は空のまま
+    except Exception as e:
+        logger.error(
+            f"DB履歴の読み込み中に予期せぬエラーが発生しました ({table_name}): {e}"
+        )
+        raw_rows_from_db = []  # 念のため空にする
+    finally:
+        if conn:
+            conn.close()
+
+    if not raw_rows_from_db:
+        logger.debug(
+            f"DBテーブル {table_name} から読み込む有効な会話履歴はありませんでした。"
+        )
+        return []
+    return _rows_to_model_history(raw_rows_from_db, encoder or TurnEncoder())
+
+
+def _rows_to_model_history(raw_rows_from_db, encoder):
+    """
+    DB の履歴行をモデル入力用の履歴 (user から始まる) に整形する。
+    user ターンはライブの送信と同じ encoder を通すため、見出しの付き方も同じになる。
+    """
+    history_for_model = []
+
+    # 履歴が必ず "user" メッセージから始まるように調整
+    start_index = -1
+    for i, row_data in enumerate(raw_rows_from_db):
+        if row_data["role"] == "user":
+            start_index = i
+            break
+
+    if start_index != -1:
+        # "user" メッセージが見つかった場合、そこから履歴を開始
+        effective_rows = raw_rows_from_db[start_index:]
+        if start_index > 0:
+            logger.debug(
+                f"読み込んだDB履歴の先頭 {start_index} 件 (modelロール) をスキップし、最初のuserロールのメッセージから履歴を開始します。"
+            )
+
+        for row_data in effective_rows:
+            if row_data["role"] == "user":
+                _, body = _split_legacy_header(
+                    row_data["content"], row_data["author_name"]
+                )
+                text_content = encoder.encode(
+                    row_data["author_name"], body, _history_row_time(row_data)
+                )
+                history_for_model.append(
+                    {"role": "user", "parts": [{"text": text_content}]}
+                )
+            else:
+                # 過去のボット応答は逐語でモデルに渡すと自己模倣を助長するため省略またはプレースホルダを渡す
+                history_for_model.append(
+                    {"role": "model", "parts": [{"text": "[前のボット応答は省略]"}]}
+                )
+        logger.debug(
+            f"DBから {len(effective_rows)} 件の整形済み会話履歴をモデル入力用に準備しました。"
+        )
+    else:
+        # 読み込んだ履歴内に "user" メッセージが見つからなかった場合
+        logger.info(
+            f"読み込んだDB履歴 {len(raw_rows_from_db)} 件の中にuserロールのメッセージが見つからなかったため、DBからの会話履歴は使用しません。"
+        )
+
+    return history_for_model
+
+
+def load_history_rows_after(character_key, last_row_id):
+    """スナップショット以降に書き込まれた履歴行を古い順に返す。"""
+    table_name = get_history_table_name(character_key)
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT id, role, author_name, content, timestamp FROM {table_name} WHERE id > ? ORDER BY id ASC",
+                (last_row_id,),
+            )
+            return cursor.fetchall()
+    except sqlite3.OperationalError as e:
+        logger.info(
+            f"情報: テーブル {table_name} から追加履歴を読み込めませんでした: {e}"
+        )
+        return []
+
+
+def get_latest_history_row_id(character_key):
+    table_name = get_history_table_name(character_key)
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT MAX(id) FROM {table_name}")
+            row = cursor.fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] or 0
+
+
+# --- 履歴の保持期間・アーカイブ・VACUUM ---
+HISTORY_RETENTION_DAYS = int(
+    os.getenv("HISTORY_RETENTION_DAYS", "90")
+)  # 0 以下で無期限。キャラクターJSONの history_retention_days で上書きできる
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "history_archive")
+HISTORY_ARCHIVE_BATCH_SIZE = int(os.getenv("HISTORY_ARCHIVE_BATCH_SIZE", "500"))
+HISTORY_VACUUM_MAX_PAGES = int(
+    os.getenv("HISTORY_VACUUM_MAX_PAGES", "5000")
+)  # 1回のメンテナンスで解放する最大ページ数
+
+
+def _create_restored_rows_table(cursor):
+    # アーカイブから戻した行は元の timestamp のままなので、復元時刻から保持期間を数え直す
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS restored_history_rows (
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        restored_at DATETIME NOT NULL,
+        PRIMARY KEY (table_name, row_id)
+    )
+    """
+    )
+
+
+def list_history_tables():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'history\\_%' ESCAPE '\\'"
+        )
+        return [row["name"] for row in cursor.fetchall()]
+
+
+def get_history_retention_days(character_key):
+    """キャラクターごとの保持日数 (JSON の history_retention_days) を返す。未指定なら既定値。"""
+    char_data = (
+        _load_raw_character_data(character_key) if character_key.isalnum() else None
+    )
+    if char_data and char_data.get("history_retention_days") is not None:
+        try:
+            return int(char_data["history_retention_days"])
+        except (TypeError, ValueError):
+            logger.warning(
+                f"警告: {character_key} の history_retention_days が不正です。既定値を使います。"
+            )
+    return HISTORY_RETENTION_DAYS
+
+
+def _history_archive_dir(character_key):
+    return os.path.join(HISTORY_ARCHIVE_DIR, character_key)
+
+
+def list_history_archives(character_key):
+    archive_dir = _history_archive_dir(character_key)
+    if not character_key.isalnum() or not os.path.isdir(archive_dir):
+        return []
+    return sorted(
+        os.path.join(archive_dir, name)
+        for name in os.listdir(archive_dir)
+        if name.endswith(".jsonl.gz")
+    )
+
+
+def _to_archive_value(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def archive_history_table(table_name, retention_days):
+    """
+    保持期間より古い行を gzip JSONL に逐次書き出してから、一定件数ずつ削除する。
+    戻り値は (アーカイブ件数, アーカイブファイルパス)。
+    """
+    character_key = table_name[len("history_") :]
+    create_table_if_not_exists(
+        character_key
+    )  # 未読み込みのキャラクターの旧テーブルにも guild_id 列を足す
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    os.makedirs(_history_archive_dir(character_key), exist_ok=True)
+    archive_path = os.path.join(
+        _history_archive_dir(character_key),
+        f"{table_name}-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}.jsonl.gz",
+    )
+
+    # 復元から保持期間が経っていない行は、元の timestamp が古くてもアーカイブしない
+    expired_condition = f"""timestamp < ? AND NOT EXISTS (
+        SELECT 1 FROM restored_history_rows r
+        WHERE r.table_name = '{table_name}' AND r.row_id = {table_name}.id AND r.restored_at >= ?
+    )"""
+    archived_count = 0
+    max_archived_id = None
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_restored_rows_table(cursor)
+        cursor.execute(
+            f"SELECT id, role, author_name, content, timestamp, guild_id, author_id FROM {table_name} WHERE {expired_condition} ORDER BY id ASC",
+            (cutoff, cutoff),
+        )
+        with gzip.open(archive_path, "wt", encoding="utf-8") as archive_file:
+            while True:
+                rows = cursor.fetchmany(HISTORY_ARCHIVE_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    archive_file.write(
+                        json.dumps(
+                            {key: _to_archive_value(row[key]) for key in row.keys()},
+                            ensure_ascii=False,
+                        )
+                        + "\n"
+                    )
+                archived_count += len(rows)
+                max_archived_id = rows[-1]["id"]
+
+    if not archived_count:
+        os.remove(archive_path)
+        return 0, None
+
+    # アーカイブの書き出しが完了してから、ロックを長く握らないよう小さなトランザクションで削除する
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+            DELETE FROM {table_name} WHERE id IN (
+                SELECT id FROM {table_name} WHERE id <= ? AND {expired_condition} LIMIT ?
+            )
+            """,
+                (max_archived_id, cutoff, cutoff, HISTORY_ARCHIVE_BATCH_SIZE),
+            )
+            deleted = cursor.rowcount
+        if deleted < HISTORY_ARCHIVE_BATCH_SIZE:
+            break
+    with get_db_connection() as conn:
+        # 再びアーカイブされた復元行の印は不要になる
+        conn.execute(
+            f"DELETE FROM restored_history_rows WHERE table_name = ? AND row_id NOT IN (SELECT id FROM {table_name})",
+            (table_name,),
+        )
+    request_memory_prune(character_key)
+    logger.info(
+        f"{table_name} の {archived_count} 件を {archive_path} にアーカイブしました。"
+    )
+    increment_metric("history.archived_rows", archived_count)
+    return archived_count, archive_path
+
+
+def apply_history_retention():
+    """全キャラクターの履歴テーブルに保持期間を適用する。"""
+    results = []
+    for table_name in list_history_tables():
+        retention_days = get_history_retention_days(table_name[len("history_") :])
+        if retention_days <= 0:
+            continue
+        try:
+            archived_count, archive_path = archive_history_table(
+                table_name, retention_days
+            )
+        except Exception as e:
+            logger.error(f"{table_name} のアーカイブ中にエラーが発生しました: {e}")
+            continue
+        if archived_count:
+            results.append((table_name, archived_count, archive_path))
+    return results
+
+
+def _incremental_vacuum(conn, max_pages=None):
+    """
+    空きページを最大 max_pages (None なら全て) 解放し、(解放前, 解放後) の freelist_count を返す。
+    auto_vacuum=INCREMENTAL でない DB では何もしない。
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:  # 2 = INCREMENTAL
+        return None
+    freelist_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    pages = "" if max_pages is None else f"({int(max_pages)})"
+    # execute() では sqlite3 モジュールが1ステップ (1ページ) しか進めないため、
+    # executescript() で最後まで実行させる
+    conn.executescript(f"PRAGMA incremental_vacuum{pages};")
+    freelist_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    expected = freelist_before if max_pages is None else min(freelist_before, max_pages)
+    if freelist_before - freelist_after < expected:
+        logger.warning(
+            f"incremental vacuum: 空きページが想定どおり減りませんでした ({freelist_before} → {freelist_after})。"
+        )
+    return freelist_before, freelist_after
+
+
+def run_incremental_vacuum():
+    """空きページを少しずつ解放する。初回のみ auto_vacuum=INCREMENTAL へ移行するため VACUUM する。"""
+    conn = get_db_connection()
+    try:
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != 2:  # 2 = INCREMENTAL
+            logger.info(
+                "DB を auto_vacuum=INCREMENTAL に移行します (初回のみ VACUUM を実行)。"
+            )
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        freelist_before, freelist_after = _incremental_vacuum(
+            conn, HISTORY_VACUUM_MAX_PAGES
+        )
+    finally:
+        conn.close()
+    logger.info(
+        f"incremental vacuum: {freelist_before - freelist_after} ページを解放しました (残り {freelist_after})。"
+    )
+    return freelist_before - freelist_after
+
+
+def restore_history_archive(character_key, archive_path):
+    """アーカイブファイルを読み戻し、元の id のまま履歴テーブルに挿入する (重複は無視)。"""
+    table_name = get_history_table_name(character_key)
+    create_table_if_not_exists(character_key)
+
+    restored = 0
+    batch = []
+    restored_at = datetime.datetime.now()
+
+    def flush():
+        nonlocal restored
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            _create_restored_rows_table(cursor)
+            cursor.executemany(
+                f"INSERT OR IGNORE INTO {table_name} (id, role, author_name, content, timestamp, guild_id, author_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                batch,
+            )
+            restored += cursor.rowcount
+            # 次の保持期間の適用ですぐ再アーカイブされないよう、復元した行に印を付ける
+            cursor.executemany(
+                "INSERT OR REPLACE INTO restored_history_rows (table_name, row_id, restored_at) VALUES (?, ?, ?)",
+                [(table_name, row[0], restored_at) for row in batch],
+            )
+        batch.clear()
+
+    with gzip.open(archive_path, "rt", encoding="utf-8") as archive_file:
+        for line in archive_file:
+            row = json.loads(line)
+            batch.append(
+                (
+                    row["id"],
+                    row["role"],
+                    row["author_name"],
+                    row["content"],
+                    row["timestamp"],
+                    row.get("guild_id"),  # 列の追加前に作ったアーカイブにはない
+                    row.get("author_id"),
+                )
+            )
+            if len(batch) >= HISTORY_ARCHIVE_BATCH_SIZE:
+                flush()
+    if batch:
+        flush()
+    logger.info(f"{archive_path} から {table_name} に {restored} 件を復元しました。")
+    return restored
+
+
+@tasks.loop(
+    time=datetime.time(
+        hour=4,
+        minute=0,
+        second=0,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=9)),
+    )
+)
+async def history_maintenance():
+    """毎日4時(JST、オフピーク)に保持期間の適用とincremental vacuumを行う。"""
+    if not await asyncio.to_thread(claim_job_run, "history_maintenance", _today_jst()):
+        return
+    try:
+        await asyncio.to_thread(apply_history_retention)
+        await asyncio.to_thread(run_incremental_vacuum)
+    except Exception as e:
+        logger.error(f"履歴メンテナンス中にエラーが発生しました: {e}")
+
+
+# --- 全文検索 (FTS5 trigram) ---
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "50"))
+SEARCH_BATCH_SIZE = 25
+SEARCH_SNIPPET_CHARS = 80
+_fts_ready_tables = set()
+_fts_unavailable_reason = None
+
+
+def get_history_fts_table_name(character_key):
+    # list_history_tables() の "history_%" に一致しない名前にする
+    return f"fts_{get_history_table_name(character_key)}"
+
+
+def ensure_history_fts(character_key):
+    """
+    履歴テーブルに外部コンテンツ型の FTS5 (trigram) 索引とトリガーを用意する。
+    新規作成時のみ既存行から rebuild し、以降は INSERT/DELETE/UPDATE のトリガーで差分更新する。
+    SQLite が trigram に対応していなければ False を返し、検索は LIKE にフォールバックする。
+    """
+    global _fts_unavailable_reason
+    table_name = get_history_table_name(character_key)
+    fts_table = get_history_fts_table_name(character_key)
+    if fts_table in _fts_ready_tables:
+        return True
+    if _fts_unavailable_reason is not None:
+        return False
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?",
+                (fts_table,),
+            )
+            created = cursor.fetchone() is None
+            cursor.executescript(
+                f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                content, author_name,
+                content='{table_name}', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table_name} BEGIN
+                INSERT INTO {fts_table}(rowid, content, author_name)
+                VALUES (new.id, new.content, new.author_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table_name} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, content, author_name)
+                VALUES ('delete', old.id, old.content, old.author_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE ON {table_name} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, content, author_name)
+                VALUES ('delete', old.id, old.content, old.author_name);
+                INSERT INTO {fts_table}(rowid, content, author_name)
+                VALUES (new.id, new.content, new.author_name);
+            END;
+            """
+            )
+            if created:
+                cursor.execute(
+                    f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"
+                )
+                logger.info(f"全文検索索引 {fts_table} を作成しました。")
+    except sqlite3.OperationalError as e:
+        if "trigram" in str(e) or "fts5" in str(e):
+            _fts_unavailable_reason = str(e)
+            logger.warning(
+                f"警告: FTS5 trigram が使えないため検索は LIKE で行います: {e}"
+            )
+            return False
+        raise
+    _fts_ready_tables.add(fts_table)
+    return True
+
+
+@dataclass
+class HistorySearchQuery:
+    terms: List[str]
+    author: Optional[str] = None
+    since: Optional[datetime.date] = None
+    until: Optional[datetime.date] = None
+    before_id: Optional[int] = None
+    limit: int = SEARCH_PAGE_SIZE
+    include_legacy: bool = (
+        False  # サーバー不明 (guild_id が NULL) の行も含める (管理者のみ)
+    )
+
+
+def parse_search_query(text):
+    """
+    「キーワード author:名前 from:YYYY-MM-DD to:YYYY-MM-DD before:ID limit:N scope:legacy」を解釈する。
+    不正な値は ValueError を送出する。
+    """
+    query = HistorySearchQuery(terms=[])
+    for token in text.split():
+        name, sep, value = token.partition(":")
+        name = name.lower()
+        if (
+            sep
+            and value
+            and name in ("author", "from", "to", "before", "limit", "scope")
+        ):
+            if name == "scope":
+                if value.lower() != "legacy":
+                    raise ValueError("scope: に指定できるのは legacy だけです。")
+                query.include_legacy = True
+            elif name == "author":
+                query.author = value
+            elif name == "from":
+                query.since = datetime.date.fromisoformat(value)
+            elif name == "to":
+                query.until = datetime.date.fromisoformat(value)
+            elif name == "before":
+                query.before_id = int(value)
+            else:
+                query.limit = max(1, min(int(value), SEARCH_MAX_RESULTS))
+        else:
+            query.terms.append(token)
+    if not query.terms and query.author is None:
+        raise ValueError("検索語か author: を指定してください。")
+    return query
+
+
+def iter_history_search(character_key, query, guild_id):
+    """
+    guild_id のサーバーで保存された履歴行のうち、条件に合うものを新しい順に返すジェネレータ。
+    query.include_legacy のときはサーバー不明の行 (移行前の行・定期ジョブの行) も含める。
+    id によるキーセット方式で SEARCH_BATCH_SIZE 件ずつ取得するため、結果が多くても全件をメモリに載せない。
+    3文字以上の語は FTS5 の MATCH、それ未満の語は LIKE で絞り込む。
+    """
+    table_name = get_history_table_name(character_key)
+    fts_table = get_history_fts_table_name(character_key)
+    use_fts = ensure_history_fts(character_key)
+
+    match_terms = []
+    # キャラクターは複数サーバーで共有されるため、他のサーバーの会話は検索対象にしない
+    if query.include_legacy:
+        conditions = ["(h.guild_id = ? OR h.guild_id IS NULL)"]
+    else:
+        conditions = ["h.guild_id = ?"]
+    params = [guild_id]
+    for term in query.terms:
+        if use_fts and len(term) >= 3:
+            match_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            conditions.append("h.content LIKE ? ESCAPE '\\'")
+            escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+    if query.author:
+        conditions.append("h.author_name LIKE ?")
+        params.append(f"%{query.author}%")
+    if query.since:
+        conditions.append("h.timestamp >= ?")
+        params.append(query.since.isoformat())
+    if query.until:
+        conditions.append("h.timestamp < ?")
+        params.append((query.until + datetime.timedelta(days=1)).isoformat())
+
+    if match_terms:
+        source = f"{fts_table} JOIN {table_name} AS h ON h.id = {fts_table}.rowid"
+        conditions.insert(0, f"{fts_table} MATCH ?")
+        params.insert(0, " AND ".join(match_terms))
+    else:
+        source = f"{table_name} AS h"
+
+    last_id = query.before_id
+    remaining = query.limit
+    while remaining > 0:
+        batch_conditions = list(conditions)
+        batch_params = list(params)
+        if last_id is not None:
+            batch_conditions.append("h.id < ?")
+            batch_params.append(last_id)
+        where = " AND ".join(batch_conditions) or "1"
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+            SELECT h.id, h.role, h.author_name, h.content, h.timestamp FROM {source}
+            WHERE {where} ORDER BY h.id DESC LIMIT ?
+            """,
+                (*batch_params, min(SEARCH_BATCH_SIZE, remaining)),
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        remaining -= len(rows)
+        last_id = rows[-1]["id"]
+
+
+def format_search_hit(row, terms):
+    """検索結果1件を「#id [日時] 発言者: …前後の文脈…」の1行にする。"""
+    body = " ".join(_message_body(row).split())
+    position = -1
+    for term in terms:
+        position = body.lower().find(term.lower())
+        if position >= 0:
+            break
+    start = max(0, position - SEARCH_SNIPPET_CHARS // 2) if position >= 0 else 0
+    snippet = body[start : start + SEARCH_SNIPPET_CHARS]
+    if start > 0:
+        snippet = "…" + snippet
+    if start + SEARCH_SNIPPET_CHARS < len(body):
+        snippet += "…"
+    timestamp = _to_archive_value(row["timestamp"]) or ""
+    return f"`#{row['id']}` [{timestamp[:16].replace('T', ' ')}] {row['author_name']}: {snippet}"
+
+
+# --- 過去の会話の意味検索 (オフラインのハッシュ化文字 n-gram TF-IDF) ---
+MEMORY_INDEX_ENABLED = os.getenv("MEMORY_INDEX_ENABLED", "true").lower() not in (
+    "0",
+    "false",
+    "off",
+)
+MEMORY_INDEX_DIR = os.getenv("MEMORY_INDEX_DIR", "memory_index")
+MEMORY_VECTOR_DIM = int(os.getenv("MEMORY_VECTOR_DIM", "1024"))
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.15"))
+MEMORY_EXCLUDE_RECENT_ROWS = int(
+    os.getenv("MEMORY_EXCLUDE_RECENT_ROWS", "30")
+)  # 常に送っている直近の履歴と重複させない
+MEMORY_SNIPPET_CHARS = int(os.getenv("MEMORY_SNIPPET_CHARS", "200"))
+MEMORY_INDEX_BATCH_SIZE = int(os.getenv("MEMORY_INDEX_BATCH_SIZE", "500"))
+MEMORY_SEARCH_CHUNK_ROWS = 8192
+# 複数ワーカー構成ではシャード0を持つワーカーだけが索引を書き込む
+IS_MEMORY_INDEX_OWNER = not IS_MULTI_WORKER or 0 in (SHARD_IDS or [])
+
+
+def _message_body(row):
+    """履歴行の発言内容。旧形式の行「発言者名\n送信時刻\n発言内容」は見出しを除く。"""
+    return _split_legacy_header(row["content"], row["author_name"])[1]
+
+
+def _hashed_ngram_vector(text, dim):
+    """
+    NFKC 正規化した文字 2-gram/3-gram を符号付きハッシュで dim 次元に写像し、
+    サブリニア TF を L2 正規化したベクトルを返す。分かち書き不要で日本語にも使える。
+    """
+    normalized = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    counts = defaultdict(float)
+    for n in (2, 3):
+        for i in range(len(normalized) - n + 1):
+            digest = zlib.crc32(normalized[i : i + n].encode("utf-8"))
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            counts[digest % dim] += sign
+    vector = np.zeros(dim, dtype=np.float32)
+    for index, value in counts.items():
+        vector[index] = np.sign(value) * (1.0 + np.log(abs(value))) if value else 0.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class MemoryIndexShard:
+    """
+    キャラクター1人分の索引。ベクトルは float16 の生バイナリに追記し np.memmap で参照する。
+    rows.jsonl にスニペットを追記し、rowmeta.i64 に各行の (row id, rows.jsonl 内の位置) を持つ。
+    df.npy に文書頻度、state.json に件数・最終 row id・rows.jsonl の有効長を保存する。
+    """
+
+    def __init__(self, character_key, dim=MEMORY_VECTOR_DIM):
+        self.character_key = character_key
+        self.dim = dim
+        self.directory = os.path.join(MEMORY_INDEX_DIR, character_key)
+        self._reset()
+        self._state_mtime = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _reset(self):
+        self.count = 0
+        self.last_row_id = 0
+        self.rows_bytes = 0
+        self.document_frequency = np.zeros(self.dim, dtype=np.float64)
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self._row_offsets = np.zeros(0, dtype=np.int64)
+        self._vectors = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def _vectors_path(self):
+        return self._path("vectors.f16")
+
+    @property
+    def _rows_path(self):
+        return self._path("rows.jsonl")
+
+    @property
+    def _meta_path(self):
+        return self._path("rowmeta.i64")
+
+    @property
+    def _state_path(self):
+        return self._path("state.json")
+
+    def _load(self):
+        if not os.path.exists(self._state_path):
+            return
+        with open(self._state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("dim") != self.dim:
+            logger.info(
+                f"記憶索引 {self.character_key}: 次元数が異なるため索引を作り直します。"
+            )
+            self._reset()
+            return
+        try:
+            self.count = state["count"]
+            self.last_row_id = state["last_row_id"]
+            if "rows_bytes" in state and os.path.exists(self._meta_path):
+                self.rows_bytes = state["rows_bytes"]
+                meta = np.fromfile(
+                    self._meta_path, dtype=np.int64, count=self.count * 2
+                ).reshape(-1, 2)
+            else:
+                meta = self._rebuild_row_meta()
+            if len(meta) != self.count:
+                raise ValueError("rowmeta.i64 の件数が state.json と一致しません")
+            self.row_ids = meta[:, 0].copy()
+            self._row_offsets = meta[:, 1].copy()
+            self.document_frequency = np.load(self._path("df.npy"))
+            self._open_vectors()
+        except (OSError, ValueError, KeyError) as e:
+            # 書き込み途中で落ちた等で整合しない索引は捨て、履歴から作り直させる
+            logger.warning(
+                f"記憶索引 {self.character_key}: 読み込めないため作り直します: {e}"
+            )
+            self._reset()
+        self._state_mtime = os.path.getmtime(self._state_path)
+
+    def _rebuild_row_meta(self):
+        """rowmeta.i64 がない旧形式の索引から、rows.jsonl を一度だけ読んで作る。"""
+        meta = []
+        with open(self._rows_path, "rb") as f:
+            for _ in range(self.count):
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                meta.append((json.loads(line)["row_id"], offset))
+            self.rows_bytes = f.tell()
+        meta = np.array(meta, dtype=np.int64).reshape(-1, 2)
+        meta.tofile(self._meta_path)
+        return meta
+
+    def _open_vectors(self):
+        self._vectors = (
+            np.memmap(
+                self._vectors_path,
+                dtype=np.float16,
+                mode="r",
+                shape=(self.count, self.dim),
+            )
+            if self.count
+            else None
+        )
+
+    def _write_state(self):
+        # state.json を最後に書くことで、途中で落ちても count 以降の追記分は無視される
+        with open(f"{self._state_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "count": self.count,
+                    "last_row_id": self.last_row_id,
+                    "rows_bytes": self.rows_bytes,
+                },
+                f,
+            )
+        os.replace(f"{self._state_path}.tmp", self._state_path)
+        self._state_mtime = os.path.getmtime(self._state_path)
+
+    def reload_if_changed(self):
+        """他のワーカーが索引を更新していれば読み直す。"""
+        if not os.path.exists(self._state_path):
+            return
+        if os.path.getmtime(self._state_path) != self._state_mtime:
+            with self._lock:
+                self._load()
+
+    @staticmethod
+    def _append_at(path, position, data):
+        """path の position 以降を data で置き換える (前回途中で落ちた書き込みは上書きされる)。"""
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(position)
+            f.write(data)
+            f.truncate()
+
+    def add(self, rows):
+        """履歴行 (id, author_name, content, timestamp) を索引に追加する。"""
+        if not rows:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        vectors = []
+        lines = []
+        for row in rows:
+            body = _message_body(row).strip()
+            if body:
+                vectors.append(_hashed_ngram_vector(body, self.dim))
+                entry = {
+                    "row_id": row["id"],
+                    "author": row["author_name"],
+                    "timestamp": _to_archive_value(row["timestamp"]),
+                    "snippet": body[:MEMORY_SNIPPET_CHARS],
+                }
+                lines.append(
+                    (row["id"], (json.dumps(entry, ensure_ascii=False) + "\n").encode())
+                )
+        with self._lock:
+            if vectors:
+                matrix = np.vstack(vectors)
+                self._append_at(
+                    self._vectors_path,
+                    self.count * self.dim * 2,
+                    matrix.astype(np.float16).tobytes(),
+                )
+                # スニペットは既存分を書き直さず末尾に追記する
+                offsets = self.rows_bytes + np.cumsum(
+                    [0] + [len(line) for _, line in lines[:-1]], dtype=np.int64
+                )
+                self._append_at(
+                    self._rows_path,
+                    self.rows_bytes,
+                    b"".join(line for _, line in lines),
+                )
+                new_row_ids = np.array([row_id for row_id, _ in lines], dtype=np.int64)
+                self._append_at(
+                    self._meta_path,
+                    self.count * 16,
+                    np.column_stack([new_row_ids, offsets]).astype(np.int64).tobytes(),
+                )
+                self.document_frequency += (matrix != 0).sum(axis=0)
+                np.save(self._path("df.npy"), self.document_frequency)
+                self.row_ids = np.concatenate([self.row_ids, new_row_ids])
+                self._row_offsets = np.concatenate([self._row_offsets, offsets])
+                self.rows_bytes += sum(len(line) for _, line in lines)
+                self.count += len(lines)
+            self.last_row_id = max(self.last_row_id, rows[-1]["id"])
+            self._write_state()
+            self._open_vectors()
+
+    def remove(self, row_ids=None):
+        """
+        row_ids (None なら全件) の発言を索引から取り除き、ファイルを詰め直す。
+        last_row_id は変えないので、取り除いた行が再び索引されることはない。戻り値は除いた件数。
+        """
+        with self._lock:
+            if not self.count:
+                return 0
+            if row_ids is None:
+                keep = np.zeros(self.count, dtype=bool)
+            else:
+                keep = ~np.isin(self.row_ids, np.asarray(list(row_ids), dtype=np.int64))
+            removed = self.count - int(keep.sum())
+            if not removed:
+                return 0
+            kept_indices = np.flatnonzero(keep)
+            document_frequency = np.zeros(self.dim, dtype=np.float64)
+            offsets = []
+            rows_bytes = 0
+            with open(f"{self._vectors_path}.tmp", "wb") as vectors_file, open(
+                f"{self._rows_path}.tmp", "wb"
+            ) as rows_file, open(self._rows_path, "rb") as source:
+                for start in range(0, len(kept_indices), MEMORY_SEARCH_CHUNK_ROWS):
+                    chunk = kept_indices[start : start + MEMORY_SEARCH_CHUNK_ROWS]
+                    matrix = np.asarray(self._vectors[chunk])
+                    vectors_file.write(matrix.tobytes())
+                    document_frequency += (matrix != 0).sum(axis=0)
+                    for index in chunk:
+                        source.seek(self._row_offsets[index])
+                        line = source.readline()
+                        offsets.append(rows_bytes)
+                        rows_file.write(line)
+                        rows_bytes += len(line)
+            row_ids = self.row_ids[kept_indices]
+            offsets = np.array(offsets, dtype=np.int64)
+            np.column_stack([row_ids, offsets]).astype(np.int64).tofile(
+                f"{self._meta_path}.tmp"
+            )
+            self._vectors = None  # 置き換える前に古いファイルの memmap を手放す
+            for path in (self._vectors_path, self._rows_path, self._meta_path):
+                os.replace(f"{path}.tmp", path)
+            np.save(self._path("df.npy"), document_frequency)
+            self.document_frequency = document_frequency
+            self.row_ids = row_ids
+            self._row_offsets = offsets
+            self.rows_bytes = rows_bytes
+            self.count = len(row_ids)
+            self._write_state()
+            self._open_vectors()
+        logger.info(f"記憶索引 {self.character_key}: {removed} 件を取り除きました。")
+        increment_metric("memory.removed_rows", removed)
+        return removed
+
+    def _read_rows(self, indices, row_ids, offsets):
+        """スニペットは検索でヒットした行だけ rows.jsonl から読む。"""
+        rows = []
+        with open(self._rows_path, "rb") as f:
+            for index in indices:
+                f.seek(offsets[index])
+                row = json.loads(f.readline())
+                if row["row_id"] != row_ids[index]:
+                    raise ValueError("rows.jsonl が読み込み後に詰め直されました")
+                rows.append(row)
+        return rows
+
+    def search(self, query, top_k, max_row_id=None, min_score=MEMORY_MIN_SCORE):
+        """クエリに近い過去の発言を (スコア, 行情報) の降順で返す。max_row_id より新しい行は除外する。"""
+        with self._lock:
+            vectors, row_ids, offsets = self._vectors, self.row_ids, self._row_offsets
+            count = self.count
+            idf = np.log((count + 1) / (self.document_frequency + 1)) + 1.0
+        if vectors is None or not query.strip():
+            return []
+        query_vector = _hashed_ngram_vector(query, self.dim) * idf
+        norm = np.linalg.norm(query_vector)
+        if not norm:
+            return []
+        query_vector = (query_vector / norm).astype(np.float32)
+
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, MEMORY_SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(
+                vectors[start : start + MEMORY_SEARCH_CHUNK_ROWS], dtype=np.float32
+            )
+            scores[start : start + len(chunk)] = chunk @ query_vector
+        if max_row_id is not None:
+            scores[row_ids > max_row_id] = -1.0
+
+        candidate_count = min(top_k, count)
+        candidates = np.argpartition(-scores, candidate_count - 1)[:candidate_count]
+        ranked = [
+            index
+            for index in sorted(candidates, key=lambda index: -scores[index])
+            if scores[index] >= min_score
+        ]
+        try:
+            rows = self._read_rows(ranked, row_ids, offsets)
+        except (OSError, ValueError):
+            return []  # 他のワーカーが詰め直している最中。次の検索で読み直す
+        return [(float(scores[index]), row) for index, row in zip(ranked, rows)]
+
+
+_memory_shards = {}
+_memory_shards_lock = threading.Lock()
+
+
+def get_memory_shard(character_key):
+    with _memory_shards_lock:
+        if character_key not in _memory_shards:
+            _memory_shards[character_key] = MemoryIndexShard(character_key)
+        return _memory_shards[character_key]
+
+
+def index_new_history_rows():
+    """各キャラクターの履歴テーブルから未索引のユーザー発言を索引に追加する。"""
+    indexed = 0
+    for table_name in list_history_tables():
+        character_key = table_name[len("history_") :]
+        if not character_key.isalnum():
+            continue
+        shard = get_memory_shard(character_key)
+        requested = get_setting_from_db(f"memory_prune_requested:{character_key}")
+        if requested and _applied_memory_prunes.get(character_key) != requested:
+            # 他のワーカーでリセット・アーカイブされた履歴を索引から取り除く
+            prune_memory_index(character_key)
+            _applied_memory_prunes[character_key] = requested
+        while True:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f"""
+                SELECT id, author_name, content, timestamp FROM {table_name}
+                WHERE id > ? AND role = 'user' AND author_name != 'system'
+                ORDER BY id ASC LIMIT ?
+                """,
+                    (shard.last_row_id, MEMORY_INDEX_BATCH_SIZE),
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            shard.add(rows)
+            indexed += len(rows)
+    if indexed:
+        logger.info(f"記憶索引: {indexed} 件の発言を追加しました。")
+        increment_metric("memory.indexed_rows", indexed)
+    return indexed
+
+
+_applied_memory_prunes = (
+    {}
+)  # キャラクターキー -> 反映済みの削除要求 (memory_prune_requested:<key>)
+
+
+def prune_memory_index(character_key):
+    """履歴テーブルから消えた行 (リセット・アーカイブ) を記憶索引から取り除く。"""
+    shard = get_memory_shard(character_key)
+    if not shard.count:
+        return 0
+    table_name = get_history_table_name(character_key)
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT id FROM {table_name} WHERE id <= ? AND role = 'user'",
+                (shard.last_row_id,),
+            )
+            existing = np.fromiter((row[0] for row in cursor), dtype=np.int64)
+    except sqlite3.OperationalError:
+        existing = np.zeros(0, dtype=np.int64)  # テーブルごと消えている
+    indexed = shard.row_ids
+    return shard.remove(indexed[~np.isin(indexed, existing)])
+
+
+def request_memory_prune(character_key):
+    """
+    履歴の削除を記憶索引に反映させる。索引を書き込むワーカーならその場で取り除き、
+    そうでなければ索引を持つワーカーの次回の index_new_history_rows に任せる。
+    """
+    requested_at = datetime.datetime.now().isoformat()
+    set_setting_in_db(f"memory_prune_requested:{character_key}", requested_at)
+    if MEMORY_INDEX_ENABLED and IS_MEMORY_INDEX_OWNER:
+        prune_memory_index(character_key)
+        _applied_memory_prunes[character_key] = requested_at
+
+
+def _existing_history_row_ids(character_key, row_ids):
+    table_name = get_history_table_name(character_key)
+    placeholders = ",".join("?" * len(row_ids))
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT id FROM {table_name} WHERE id IN ({placeholders})",
+                list(row_ids),
+            )
+            return {row[0] for row in cursor.fetchall()}
+    except sqlite3.OperationalError:
+        return set()
+
+
+def search_conversation_memory(character_key, query, top_k=MEMORY_TOP_K):
+    shard = get_memory_shard(character_key)
+    shard.reload_if_changed()
+    # 直近の履歴はセッションに含まれているため検索対象から外す
+    max_row_id = get_latest_history_row_id(character_key) - MEMORY_EXCLUDE_RECENT_ROWS
+    results = shard.search(query, top_k, max_row_id=max_row_id)
+    if not results:
+        return results
+    # 索引からの削除が間に合っていない (他のワーカーがリセットした直後など) 行は返さない
+    existing = _existing_history_row_ids(
+        character_key, [row["row_id"] for _, row in results]
+    )
+    return [(score, row) for score, row in results if row["row_id"] in existing]
+
+
+async def retrieve_memory_parts(character_key, user_input):
+    """発言に関連する過去の発言スニペットを <memory> テキスト Part にして返す。"""
+    if not MEMORY_INDEX_ENABLED or not character_key or not (user_input or "").strip():
+        return []
+    started_at = time.monotonic()
+    try:
+        results = await asyncio.to_thread(
+            search_conversation_memory, character_key, user_input
+        )
+    except Exception as e:
+        logger.error(f"記憶検索中にエラーが発生しました: {e}")
+        return []
+    observe_metric("memory.search_ms", (time.monotonic() - started_at) * 1000)
+    if not results:
+        return []
+    increment_metric("memory.hits", len(results))
+    lines = [
+        f"- [{(row['timestamp'] or '')[:16]}] {row['author']}: {row['snippet']}"
+        for _, row in results
+    ]
+    return [
+        Part.from_text(
+            text="<memory>関連する過去の発言:\n" + "\n".join(lines) + "\n</memory>"
+        )
+    ]
+
+
+@tasks.loop(minutes=5)
+async def index_conversation_memory():
+    """新しいユーザー発言を定期的に記憶索引へ追加する。"""
+    if not MEMORY_INDEX_ENABLED or not IS_MEMORY_INDEX_OWNER:
+        return
+    try:
+        await asyncio.to_thread(index_new_history_rows)
+    except Exception as e:
+        logger.error(f"記憶索引の更新中にエラーが発生しました: {e}")
+
+
+# --- ユーザーごとの記憶プロフィール ---
+USER_PROFILE_BATCH_ROWS = int(os.getenv("USER_PROFILE_BATCH_ROWS", "500"))
+USER_PROFILE_MAX_MESSAGES = int(
+    os.getenv("USER_PROFILE_MAX_MESSAGES", "40")
+)  # 1回の要約に渡す1人あたりの最大発言数
+USER_PROFILE_MAX_ITEMS = 8
+USER_PROFILE_FIELDS = {
+    "topics": "よく話す話題",
+    "preferences": "好きなもの・苦手なもの・こだわり",
+    "recent_subjects": "最近話したこと",
+}
+USER_PROFILE_SYSTEM_INSTRUCTION = (
+    "あなたは会話ログから参加者のプロフィールを管理する記録係です。"
+    "既存のプロフィールと新しい発言から、更新後のプロフィールを次のキーを持つJSONオブジェクトだけで出力してください。"
+    + " ".join(f'"{key}": {label}の配列' for key, label in USER_PROFILE_FIELDS.items())
+    + f"。各配列は重要なものから最大{USER_PROFILE_MAX_ITEMS}件、各要素は30文字以内の日本語の短い句にしてください。"
+    "recent_subjects は新しいものを先頭にしてください。発言から読み取れないことは推測で書かないでください。"
+)
+
+
+def _create_user_profile_tables(cursor):
+    # 表示名は重複・変更できるため、プロフィールは (サーバー, ユーザーID) ごとに持つ。
+    # 表示名で引いていた旧テーブルは他人に渡る恐れがあるので使わず、名前を変えて残す
+    cursor.execute("PRAGMA table_info(user_profiles)")
+    columns = {row["name"] for row in cursor.fetchall()}
+    if columns and "author_id" not in columns:
+        cursor.execute("ALTER TABLE user_profiles RENAME TO user_profiles_by_name")
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS user_profiles (
+        guild_id INTEGER NOT NULL,
+        author_id INTEGER NOT NULL,
+        author_name TEXT,
+        profile TEXT NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        last_seen TEXT,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (guild_id, author_id)
+    )
+    """
+    )
+    # 履歴テーブルごとに、どの行までプロフィールに反映したかを記録する
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS user_profile_cursors (
+        table_name TEXT PRIMARY KEY,
+        last_row_id INTEGER NOT NULL
+    )
+    """
+    )
+
+
+def get_user_profile(guild_id, author_id):
+    """
+    保存済みのプロフィールを dict で返す。まだなければ None。
+    guild_id はサーバーID (DM は ROUTE_SCOPE_ALL)、author_id は Discord のユーザーID。
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_user_profile_tables(cursor)
+        cursor.execute(
+            "SELECT profile, message_count, last_seen FROM user_profiles WHERE guild_id = ? AND author_id = ?",
+            (guild_id, author_id),
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    profile = json.loads(row["profile"])
+    profile["message_count"] = row["message_count"]
+    profile["last_seen"] = row["last_seen"]
+    return profile
+
+
+def save_user_profile(
+    guild_id, author_id, author_name, profile, message_count, last_seen
+):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_user_profile_tables(cursor)
+        cursor.execute(
+            """
+        INSERT OR REPLACE INTO user_profiles
+            (guild_id, author_id, author_name, profile, message_count, last_seen, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            (
+                guild_id,
+                author_id,
+                author_name,
+                json.dumps(
+                    {key: profile.get(key, []) for key in USER_PROFILE_FIELDS},
+                    ensure_ascii=False,
+                ),
+                message_count,
+                last_seen,
+                datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat(),
+            ),
+        )
+
+
+def _parse_user_profile_json(text):
+    """モデル出力からプロフィールJSONを取り出し、既知のキーと件数に整える。"""
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if not match:
+        raise ValueError(f"プロフィールJSONが見つかりません: {(text or '')[:100]}")
+    data = json.loads(match.group(0))
+    profile = {}
+    for key in USER_PROFILE_FIELDS:
+        values = data.get(key) or []
+        if isinstance(values, str):
+            values = [values]
+        profile[key] = [str(value)[:60] for value in values][:USER_PROFILE_MAX_ITEMS]
+    return profile
+
+
+def format_user_profile(profile):
+    lines = [
+        f"- {label}: {'、'.join(profile.get(key) or []) or '(不明)'}"
+        for key, label in USER_PROFILE_FIELDS.items()
+    ]
+    if profile.get("last_seen"):
+        lines.append(
+            f"- 最後に発言した日時: {profile['last_seen'][:16].replace('T', ' ')}"
+        )
+    return "\n".join(lines)
+
+
+def summarize_user_profile(author_name, previous_profile, messages):
+    """既存プロフィールと新しい発言から、軽量プロファイルでプロフィールを更新する。"""
+    prompt = (
+        f"参加者: {author_name}\n"
+        f"既存のプロフィール:\n{format_user_profile(previous_profile) if previous_profile else '(なし)'}\n"
+        "新しい発言 (古い順):\n" + "\n".join(f"- {message}" for message in messages)
+    )
+    profile_session = get_genai_client().chats.create(model=MODEL_NAME)
+    response = _send_message_with_retry(
+        profile_session,
+        [prompt],
+        profile=select_generation_profile(prompt, job_type="user_profile"),
+        system_instruction=USER_PROFILE_SYSTEM_INSTRUCTION,
+    )
+    return _parse_user_profile_json(response.text)
+
+
+def update_user_profiles():
+    """
+    各履歴テーブルの未反映のユーザー発言を発言者ごとにまとめ、プロフィールを差分更新する。
+    1回の実行では1テーブルあたり USER_PROFILE_BATCH_ROWS 行まで処理し、残りは次回に回す。
+    要約に失敗した発言者はログに残して飛ばし、カーソルは進める (同じ発言を数え直さないため)。
+    """
+    updated = 0
+    for table_name in list_history_tables():
+        try:
+            updated += _update_user_profiles_from_table(table_name)
+        except Exception as e:
+            # 1テーブルの失敗で他のキャラクターの履歴の反映を止めない
+            logger.error(
+                f"{table_name} からのユーザープロフィール更新中にエラーが発生しました: {e}"
+            )
+    if updated:
+        logger.info(f"ユーザープロフィールを {updated} 件更新しました。")
+        increment_metric("user_profiles.updated", updated)
+    return updated
+
+
+def _update_user_profiles_from_table(table_name):
+    """1テーブル分の未反映の発言をプロフィールに反映し、更新した人数を返す。"""
+    updated = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_user_profile_tables(cursor)
+        cursor.execute(
+            "SELECT last_row_id FROM user_profile_cursors WHERE table_name = ?",
+            (table_name,),
+        )
+        cursor_row = cursor.fetchone()
+        last_row_id = cursor_row["last_row_id"] if cursor_row else 0
+        # ユーザーIDのない行 (ID を記録する前の発言) は誰のものか確かめられないので使わない
+        cursor.execute(
+            f"""
+        SELECT id, author_name, content, timestamp, COALESCE(guild_id, {ROUTE_SCOPE_ALL}) AS guild_id, author_id
+        FROM {table_name}
+        WHERE id > ? AND role = 'user' AND author_name NOT IN ('system', 'bot')
+        ORDER BY id ASC LIMIT ?
+        """,
+            (last_row_id, USER_PROFILE_BATCH_ROWS),
+        )
+        rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    messages_by_author = defaultdict(list)
+    last_seen_by_author = {}
+    name_by_author = {}
+    for row in rows:
+        body = " ".join(_message_body(row).split())
+        if body and row["author_id"] is not None:
+            author = (row["guild_id"], row["author_id"])
+            messages_by_author[author].append(body[:300])
+            last_seen_by_author[author] = _to_archive_value(row["timestamp"])
+            name_by_author[author] = row["author_name"]  # 最新の表示名
+
+    for (guild_id, author_id), messages in messages_by_author.items():
+        author_name = name_by_author[(guild_id, author_id)]
+        try:
+            previous = get_user_profile(guild_id, author_id)
+            profile = summarize_user_profile(
+                author_name, previous, messages[-USER_PROFILE_MAX_MESSAGES:]
+            )
+            save_user_profile(
+                guild_id,
+                author_id,
+                author_name,
+                profile,
+                (previous or {}).get("message_count", 0) + len(messages),
+                last_seen_by_author[(guild_id, author_id)],
+            )
+        except Exception as e:
+            # この人の今回分の発言は反映せずに進める (次に発言したときは既存プロフィールから要約し直す)
+            logger.error(f"{author_name} のユーザープロフィール更新に失敗しました: {e}")
+            increment_metric("user_profiles.failed")
+            continue
+        updated += 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO user_profile_cursors (table_name, last_row_id) VALUES (?, ?)",
+            (table_name, rows[-1]["id"]),
+        )
+    return updated
+
+
+@tasks.loop(minutes=30)
+async def refresh_user_profiles():
+    """新しい発言を定期的にユーザープロフィールへ反映する。"""
+    now = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    run_key = now.strftime("%Y-%m-%dT%H:") + f"{now.minute // 30 * 30:02d}"
+    if not await asyncio.to_thread(claim_job_run, "user_profiles", run_key):
+        return
+    try:
+        await asyncio.to_thread(update_user_profiles)
+    except Exception as e:
+        logger.error(f"ユーザープロフィールの更新中にエラーが発生しました: {e}")
+
+
+# --- 会話のきっかけの先読み生成 (アイドル時) ---
+# 受付制御に空きがある間に、最近話した相手や autospeak 対象チャンネル向けの
+# 「話しかけ」を一発生成のチャットで作り置きし、!talktome やアイドル時の発言で即座に使う。
+# 相手の新しい発言 (チャンネルなら新しいメッセージ) が増えたら作り置きは古いものとして捨てる。
+STARTER_ENABLED = os.getenv("STARTER_ENABLED", "true").lower() not in ("0", "false")
+STARTER_TTL_MINUTES = int(os.getenv("STARTER_TTL_MINUTES", "180"))
+STARTER_IDLE_SECONDS = float(os.getenv("STARTER_IDLE_SECONDS", "60"))
+STARTER_MAX_PER_CYCLE = int(os.getenv("STARTER_MAX_PER_CYCLE", "3"))
+STARTER_ACTIVE_WINDOW_HOURS = int(os.getenv("STARTER_ACTIVE_WINDOW_HOURS", "24"))
+STARTER_MAX_USERS_PER_CHARACTER = int(
+    os.getenv("STARTER_MAX_USERS_PER_CHARACTER", "10")
+)
+STARTER_CONTEXT_MESSAGES = 10  # 生成時に渡す最近の発言数
+AUTOSPEAK_IDLE_MINUTES = int(os.getenv("AUTOSPEAK_IDLE_MINUTES", "180"))
+AUTOSPEAK_ACTIVE_HOURS = os.getenv(
+    "AUTOSPEAK_ACTIVE_HOURS", "9-23"
+)  # JST の「開始時-終了時」(終了時は含まない)
+autospeak_channel_ids = (
+    frozenset()
+)  # autospeak が有効なチャンネル (lean runtime のゲートウェイ絞り込みで使う)
+AUTOSPEAK_PROMPT = "チャンネルがしばらく静かです。特定の誰かではなくみんなに話しかけるような発言をしてください。挨拶のみ発言することは避け、最近の話題の繰り返しも避けてください。"
+
+
+def build_talktome_prompt(author_name):
+    return f"{author_name}との過去の会話を踏まえて、{author_name}との会話を再開するような発言をしてください。挨拶のみ発言することは避けてください。過去に自分が提案したことがある話題の繰り返しは避けるようにしてください。話題がない場合はキャラクター情報から会話のきっかけを考えてください。"
+
+
+def build_profile_starter_prompt(author_name, profile):
+    return (
+        f"{author_name}について覚えていること:\n{format_user_profile(profile)}\n"
+        f"これを踏まえて、{author_name}との会話を再開するような発言をしてください。挨拶のみ発言することは避けてください。"
+        "最近話したことの繰り返しは避け、話題を少し広げてください。"
+    )
+
+
+def _create_starter_tables(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS conversation_starters (
+        character_key TEXT NOT NULL,
+        target TEXT NOT NULL,
+        text TEXT NOT NULL,
+        marker INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        expires_at TEXT NOT NULL,
+        PRIMARY KEY (character_key, target)
+    )
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS autospeak_channels (
+        channel_id INTEGER PRIMARY KEY,
+        enabled INTEGER NOT NULL,
+        last_spoken_message_id INTEGER,
+        updated_at TEXT NOT NULL
+    )
+    """
+    )
+
+
+def user_starter_target(guild_id, author_id):
+    """相手ごとの作り置きのキー。表示名は重複・変更できるため (サーバー, ユーザーID) で持つ。"""
+    return f"user:{guild_id}:{author_id}"
+
+
+def _parse_user_starter_target(target):
+    _, guild_id, author_id = target.split(":")
+    return int(guild_id), int(author_id)
+
+
+def user_starter_marker(character_key, guild_id, author_id):
+    """相手の最新の発言の行ID。作り置き後にこれが進んでいたら、その作り置きは古い。"""
+    table_name = get_history_table_name(character_key)
+    create_table_if_not_exists(character_key)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+        SELECT MAX(id) FROM {table_name}
+        WHERE role = 'user' AND author_id = ? AND COALESCE(guild_id, {ROUTE_SCOPE_ALL}) = ?
+        """,
+            (author_id, guild_id),
+        )
+        return cursor.fetchone()[0] or 0
+
+
+def save_conversation_starter(character_key, target, text, marker):
+    now = datetime.datetime.now(JST)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            """
+        INSERT OR REPLACE INTO conversation_starters
+            (character_key, target, text, marker, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (
+                character_key,
+                target,
+                text,
+                marker,
+                now.isoformat(),
+                (now + datetime.timedelta(minutes=STARTER_TTL_MINUTES)).isoformat(),
+            ),
+        )
+
+
+def has_fresh_starter(character_key, target, marker):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            """
+        SELECT 1 FROM conversation_starters
+        WHERE character_key = ? AND target = ? AND marker >= ? AND expires_at > ?
+        """,
+            (character_key, target, marker, datetime.datetime.now(JST).isoformat()),
+        )
+        return cursor.fetchone() is not None
+
+
+def take_conversation_starter(character_key, target, marker):
+    """作り置きを取り出して削除する。期限切れや marker より古いものは捨てて None を返す。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            "SELECT text, marker, expires_at FROM conversation_starters WHERE character_key = ? AND target = ?",
+            (character_key, target),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            increment_metric("starters.misses")
+            return None
+        # 同じ作り置きを複数のワーカーが使わないよう、削除できた側だけが使う
+        cursor.execute(
+            "DELETE FROM conversation_starters WHERE character_key = ? AND target = ?",
+            (character_key, target),
+        )
+        if cursor.rowcount == 0:
+            increment_metric("starters.misses")
+            return None
+    if row["marker"] < marker:
+        increment_metric("starters.stale")
+        return None
+    if row["expires_at"] <= datetime.datetime.now(JST).isoformat():
+        increment_metric("starters.expired")
+        return None
+    increment_metric("starters.hits")
+    return row["text"]
+
+
+def purge_expired_starters():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            "DELETE FROM conversation_starters WHERE expires_at <= ?",
+            (datetime.datetime.now(JST).isoformat(),),
+        )
+
+
+def set_autospeak(channel_id, enabled):
+    global autospeak_channel_ids
+    if enabled:
+        autospeak_channel_ids = autospeak_channel_ids | {channel_id}
+    else:
+        autospeak_channel_ids = autospeak_channel_ids - {channel_id}
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            """
+        INSERT INTO autospeak_channels (channel_id, enabled, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET enabled = excluded.enabled, updated_at = excluded.updated_at
+        """,
+            (channel_id, int(enabled), datetime.datetime.now(JST).isoformat()),
+        )
+
+
+def list_autospeak_channels():
+    global autospeak_channel_ids
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            "SELECT channel_id, last_spoken_message_id FROM autospeak_channels WHERE enabled = 1"
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+    # 他のワーカーが !autospeak で変更した分もここで反映される
+    autospeak_channel_ids = frozenset(row["channel_id"] for row in rows)
+    return rows
+
+
+def mark_autospeak_spoken(channel_id, message_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_starter_tables(cursor)
+        cursor.execute(
+            "UPDATE autospeak_channels SET last_spoken_message_id = ?, updated_at = ? WHERE channel_id = ?",
+            (message_id, datetime.datetime.now(JST).isoformat(), channel_id),
+        )
+
+
+def _recent_history_rows(character_key, author=None):
+    """最近の発言を古い順に返す (author に (guild_id, author_id) を渡すとその相手の発言のみ)。"""
+    table_name = get_history_table_name(character_key)
+    create_table_if_not_exists(character_key)
+    condition = "1 = 1"
+    params = ()
+    if author is not None:
+        condition = f"role = 'user' AND author_id = ? AND COALESCE(guild_id, {ROUTE_SCOPE_ALL}) = ?"
+        params = (author[1], author[0])
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+        SELECT author_name, content FROM {table_name}
+        WHERE {condition} ORDER BY id DESC LIMIT ?
+        """,
+            params + (STARTER_CONTEXT_MESSAGES,),
+        )
+        return list(reversed(cursor.fetchall()))
+
+
+def _history_lines(rows):
+    """履歴の行を「発言者: 内容」の行にする。"""
+    lines = []
+    for row in rows:
+        body = " ".join(_message_body(row).split())
+        if body:
+            lines.append(f"- {row['author_name']}: {body[:300]}")
+    return lines
+
+
+def build_starter_prompt(character_key, target):
+    """作り置き用のプロンプト。共有セッションは使わないため、必要な文脈をここで渡す。"""
+    if target.startswith("channel:"):
+        lines = _history_lines(_recent_history_rows(character_key))
+        context = "最近の会話 (古い順):\n" + "\n".join(lines) + "\n" if lines else ""
+        return context + AUTOSPEAK_PROMPT
+    guild_id, author_id = _parse_user_starter_target(target)
+    rows = _recent_history_rows(character_key, (guild_id, author_id))
+    if not rows:
+        return None
+    name = rows[-1]["author_name"]  # 最新の表示名で呼びかける
+    profile = get_user_profile(guild_id, author_id)
+    if profile is not None:
+        return build_profile_starter_prompt(name, profile)
+    lines = _history_lines(rows)
+    return (
+        f"{name}の最近の発言 (古い順):\n" + "\n".join(lines) + "\n" if lines else ""
+    ) + build_talktome_prompt(name)
+
+
+def collect_starter_targets(channel_markers, include_users=True):
+    """
+    作り置きが必要な (character_key, target, marker) を、チャンネル・最近話した相手の順に返す。
+    channel_markers は {channel_id: (guild_id, last_message_id)} (Discord のキャッシュから取得済み)。
+    """
+    targets = []
+    for channel_id, (guild_id, last_message_id) in channel_markers.items():
+        character_key = resolve_channel_character(guild_id, channel_id)
+        target = f"channel:{channel_id}"
+        if not has_fresh_starter(character_key, target, last_message_id):
+            targets.append((character_key, target, last_message_id))
+    if not include_users:
+        return targets
+
+    since = datetime.datetime.now() - datetime.timedelta(
+        hours=STARTER_ACTIVE_WINDOW_HOURS
+    )
+    for character_key in list_routed_character_keys():
+        table_name = get_history_table_name(character_key)
+        create_table_if_not_exists(character_key)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+            SELECT COALESCE(guild_id, {ROUTE_SCOPE_ALL}) AS guild_id, author_id, MAX(id) AS last_id
+            FROM {table_name}
+            WHERE role = 'user' AND author_id IS NOT NULL AND timestamp >= ?
+            GROUP BY COALESCE(guild_id, {ROUTE_SCOPE_ALL}), author_id
+            ORDER BY last_id DESC LIMIT ?
+            """,
+                (since, STARTER_MAX_USERS_PER_CHARACTER),
+            )
+            rows = cursor.fetchall()
+        for row in rows:
+            target = user_starter_target(row["guild_id"], row["author_id"])
+            if not has_fresh_starter(character_key, target, row["last_id"]):
+                targets.append((character_key, target, row["last_id"]))
+    return targets
+
+
+def generate_conversation_starter(runtime, prompt):
+    """共有セッションとは別の一発生成のチャットで話しかけを作る。"""
+    response = _send_message_with_retry(
+        get_genai_client().chats.create(model=MODEL_NAME),
+        [prompt],
+        profile=select_generation_profile(prompt, job_type="talktome"),
+        system_instruction=runtime.system_instruction,
+    )
+    text = (response.text or "").strip()
+    if not text or len(text) > MAX_DISCORD_MESSAGE_LENGTH:
+        return None
+    return text
+
+
+def starter_capacity_available():
+    """ユーザーのリクエストを待たせない状況 (受付が暇でブレーカーも正常) のときだけ先読みする。"""
+    if shutting_down or not get_admission_controller().is_idle(STARTER_IDLE_SECONDS):
+        return False
+    model_name = select_generation_profile("", job_type="talktome").model
+    return get_circuit_breaker(model_name).state == "closed"
+
+
+@tasks.loop(seconds=60)
+async def pregenerate_conversation_starters():
+    """アイドル時に、作り置きのない (または古くなった) 相手・チャンネルの話しかけを生成する。"""
+    if not starter_capacity_available():
+        return
+    async with track_in_flight():
+        await _pregenerate_conversation_starters()
+
+
+async def _pregenerate_conversation_starters():
+    # チャンネルは見えているワーカーが担当し、相手ごとの作り置きは1分ごとに1ワーカーだけが作る
+    now = datetime.datetime.now(JST)
+    include_users = await asyncio.to_thread(
+        claim_job_run, "conversation_starters", now.strftime("%Y-%m-%dT%H:%M")
+    )
+    channel_markers = {}
+    for row in await asyncio.to_thread(list_autospeak_channels):
+        channel = bot.get_channel(row["channel_id"])
+        if channel is not None:  # 他のワーカーが担当するチャンネルは見えない
+            channel_markers[channel.id] = (
+                channel_route_ids(channel)[0],
+                channel.last_message_id or 0,
+            )
+    try:
+        await asyncio.to_thread(purge_expired_starters)
+        targets = await asyncio.to_thread(
+            collect_starter_targets, channel_markers, include_users
+        )
+        generated = 0
+        for character_key, target, marker in targets:
+            # ユーザーのリクエストが来たら、その時点で先読みをやめて枠を譲る
+            if generated >= STARTER_MAX_PER_CYCLE or not starter_capacity_available():
+                break
+            runtime = await asyncio.to_thread(get_character_runtime, character_key)
+            prompt = await asyncio.to_thread(
+                build_starter_prompt, character_key, target
+            )
+            if prompt is None:
+                continue
+            text = await asyncio.to_thread(
+                generate_conversation_starter, runtime, prompt
+            )
+            generated += 1
+            if text:
+                await asyncio.to_thread(
+                    save_conversation_starter, character_key, target, text, marker
+                )
+                increment_metric("starters.generated")
+    except Exception as e:
+        logger.error(f"会話のきっかけの先読み生成中にエラーが発生しました: {e}")
+
+
+def _within_autospeak_hours(hour):
+    start, _, end = AUTOSPEAK_ACTIVE_HOURS.partition("-")
+    start, end = int(start), int(end or 24)
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+@tasks.loop(minutes=5)
+async def autospeak_idle_channels():
+    """autospeak が有効で AUTOSPEAK_IDLE_MINUTES 以上静かなチャンネルに、作り置きの話しかけを送る。"""
+    if shutting_down or not _within_autospeak_hours(datetime.datetime.now(JST).hour):
+        return
+    try:
+        rows = await asyncio.to_thread(list_autospeak_channels)
+    except sqlite3.Error as e:
+        logger.error(f"autospeak 設定の読み込みに失敗しました: {e}")
+        return
+    idle_threshold = datetime.timedelta(minutes=AUTOSPEAK_IDLE_MINUTES)
+    for row in rows:
+        if shutting_down:
+            break
+        channel = bot.get_channel(row["channel_id"])
+        if channel is None or not channel.last_message_id:
+            continue
+        if channel.last_message_id == row["last_spoken_message_id"]:
+            continue  # 前回の自分の発言のあと、まだ誰も話していない
+        last_message_at = discord.utils.snowflake_time(channel.last_message_id)
+        if discord.utils.utcnow() - last_message_at < idle_threshold:
+            continue
+        try:
+            character_key = await asyncio.to_thread(
+                resolve_channel_character, *channel_route_ids(channel)
+            )
+            text = await asyncio.to_thread(
+                take_conversation_starter,
+                character_key,
+                f"channel:{channel.id}",
+                channel.last_message_id,
+            )
+            if text is None:
+                continue  # 次のアイドル時に pregenerate_conversation_starters が作る
+            async with track_in_flight():
+                await _send_autospeak(channel, character_key, text)
+        except Exception as e:
+            logger.error(
+                f"autospeak の送信中にエラーが発生しました ({channel.id}): {e}"
+            )
+
+
+async def _send_autospeak(channel, character_key, text):
+    """作り置きの話しかけを送り、履歴と送信済みの印を記録する。"""
+    runtime = await asyncio.to_thread(get_character_runtime, character_key)
+    sent = await channel.send(text)
+    await runtime.record_exchange("system", AUTOSPEAK_PROMPT, text)
+    guild_id = channel_route_ids(channel)[0] or None
+    await asyncio.to_thread(
+        add_message_to_db,
+        character_key,
+        "user",
+        "system",
+        AUTOSPEAK_PROMPT,
+        guild_id,
+    )
+    await asyncio.to_thread(
+        add_message_to_db, character_key, "model", "bot", text, guild_id
+    )
+    await asyncio.to_thread(mark_autospeak_spoken, channel.id, sent.id)
+    increment_metric("starters.autospeak_sent")
+
+
+# --- キャラクターごとのランタイムとチャンネル割り当て ---
+DEFAULT_CHARACTER_KEY = os.getenv("DEFAULT_CHARACTER_KEY", "lycaon")
+ROUTE_SCOPE_ALL = (
+    0  # guild_id / channel_id の 0 は「全体」「サーバー全体」の既定値を表す
+)
+
+
+class CharacterRuntime:
+    """
+    1キャラクター分の実行時資源。組み立て済みのシステムプロンプトとチャットセッションを、
+    そのキャラクターが割り当てられた全チャンネルで共有する。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.display_name = key
+        self.system_instruction = None
+        self.initial_history = []
+        self.chat_session = None
+        self.turn_encoder = TurnEncoder()
+
+    def start_session(self, history, encoder=None):
+        """history は encoder で表記済みであること (以降のライブの発言も同じ encoder で続ける)。"""
+        self.turn_encoder = encoder or TurnEncoder()
+        chat_config = build_generation_config(
+            self.system_instruction, DEFAULT_GENERATION_PROFILE
+        )
+        self.chat_session = get_genai_client().chats.create(
+            model=MODEL_NAME,
+            history=self.initial_history + history,
+            config=chat_config,
+        )
+
+    async def send(self, contents, speaker=None, **kwargs):
+        """
+        このキャラクターのセッションとシステムプロンプトで送信する。
+        speaker を指定すると先頭のテキストを turn_encoder で表記してから送る。
+        """
+        if speaker is None:
+            return await send_message_async(
+                self.chat_session,
+                contents,
+                system_instruction=self.system_instruction,
+                **kwargs,
+            )
+        encoder = self.turn_encoder
+        saved_state = {}
+        text, *rest = contents
+
+        def encode_contents():
+            # 見出しの有無は直前のターンで決まるため、送信と同じロックの中で表記する
+            saved_state.update(encoder.to_dict())
+            return [encoder.encode(speaker, text)] + rest
+
+        try:
+            return await send_message_async(
+                self.chat_session,
+                encode_contents,
+                system_instruction=self.system_instruction,
+                **kwargs,
+            )
+        except Exception:
+            if saved_state:
+                # 履歴に残らなかったターンの別名・時刻は無かったことにする
+                encoder.restore(saved_state)
+            raise
+
+    async def record_exchange(self, speaker, user_text, model_text):
+        """別セッションで生成したやり取りを、表記をそろえてこのセッションの履歴に追記する。"""
+        await record_exchange_async(
+            self.chat_session,
+            lambda: self.turn_encoder.encode(speaker, user_text),
+            model_text,
+        )
+
+
+character_runtimes = {}  # キャラクターキー -> CharacterRuntime
+_character_runtimes_lock = threading.RLock()
+
+
+def _create_channel_characters_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS channel_characters (
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        character_key TEXT NOT NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (guild_id, channel_id)
+    )
+    """
+    )
+
+
+_channel_characters_migrated = False
+
+
+def _migrate_current_character_setting():
+    """旧設定 current_character_key を全体の既定キャラクターとして引き継ぐ (初回のみ)。"""
+    global _channel_characters_migrated
+    if _channel_characters_migrated:
+        return
+    legacy_key = get_setting_from_db("current_character_key", None)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_channel_characters_table(cursor)
+        if legacy_key:
+            cursor.execute(
+                "INSERT OR IGNORE INTO channel_characters (guild_id, channel_id, character_key, updated_at) VALUES (?, ?, ?, ?)",
+                (ROUTE_SCOPE_ALL, ROUTE_SCOPE_ALL, legacy_key, datetime.datetime.now()),
+            )
+            cursor.execute(
+                "DELETE FROM bot_settings WHERE key = 'current_character_key'"
+            )
+    _channel_characters_migrated = True
+
+
+def resolve_channel_character(guild_id, channel_id):
+    """チャンネル → サーバー既定 → 全体既定 の順で割り当てられたキャラクターを返す。"""
+    _migrate_current_character_setting()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+        SELECT character_key FROM channel_characters
+        WHERE (guild_id = ? AND channel_id = ?)
+           OR (guild_id = ? AND channel_id = 0)
+           OR (guild_id = 0 AND channel_id = 0)
+        ORDER BY channel_id DESC, guild_id DESC LIMIT 1
+        """,
+            (guild_id or 0, channel_id or 0, guild_id or 0),
+        )
+        row = cursor.fetchone()
+    return row["character_key"] if row else DEFAULT_CHARACTER_KEY
+
+
+def set_channel_character(guild_id, channel_id, character_key):
+    _migrate_current_character_setting()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO channel_characters (guild_id, channel_id, character_key, updated_at) VALUES (?, ?, ?, ?)",
+            (guild_id, channel_id, character_key, datetime.datetime.now()),
+        )
+
+
+def list_routed_character_keys():
+    """割り当て表に現れるキャラクターと全体既定のキャラクターを返す。"""
+    _migrate_current_character_setting()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT character_key FROM channel_characters")
+        keys = [row["character_key"] for row in cursor.fetchall()]
+    default_key = get_default_character_key()
+    return [default_key] + [key for key in keys if key != default_key]
+
+
+def get_default_character_key():
+    """定期ジョブなど特定のチャンネルに属さない発言に使う、全体既定のキャラクター。"""
+    return resolve_channel_character(ROUTE_SCOPE_ALL, ROUTE_SCOPE_ALL)
+
+
+def channel_route_ids(channel):
+    guild = getattr(channel, "guild", None)
+    return (guild.id if guild else ROUTE_SCOPE_ALL, channel.id)
+
+
+def get_character_runtime(character_key):
+    """キャラクターのランタイムを返す。未読み込みなら読み込み、他キャラには影響しない。"""
+    with _character_runtimes_lock:
+        runtime = character_runtimes.get(character_key)
+        if runtime is None or runtime.chat_session is None:
+            runtime = load_character_runtime(character_key)
+        return runtime
+
+
+def get_channel_runtime(channel):
+    return get_character_runtime(resolve_channel_character(*channel_route_ids(channel)))
+
+
+def get_default_runtime():
+    return get_character_runtime(get_default_character_key())
+
+
+def load_routed_character_runtimes(restore_snapshot=False):
+    """起動時に、割り当て済みのキャラクターをまとめて読み込む。"""
+    return [
+        load_character_runtime(character_key, restore_snapshot=restore_snapshot)
+        for character_key in list_routed_character_keys()
+    ]
+
+
+# --- リクエストごとの生成プロファイル選択 (モデル・思考レベル・ツール・出力上限) ---
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "true").lower() not in (
+    "0",
+    "false",
+    "off",
+)
+ROUTING_LIGHT_MODEL_NAME = os.getenv("ROUTING_LIGHT_MODEL_NAME", "") or MODEL_NAME
+ROUTING_LIGHT_MAX_CHARS = int(os.getenv("ROUTING_LIGHT_MAX_CHARS", "20"))
+URL_PATTERN = re.compile(r"https?://[^\s<>()\[\]「」『』]+")
+QUESTION_MARKERS = (
+    "?",
+    "？",
+    "教えて",
+    "調べ",
+    "とは",
+    "って何",
+    "なに",
+    "何",
+    "いつ",
+    "どこ",
+    "誰",
+    "だれ",
+    "なぜ",
+    "なんで",
+    "どう",
+    "どれ",
+    "おすすめ",
+    "最新",
+    "ニュース",
+    "天気",
+)
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    name: str
+    model: str
+    thinking_level: str
+    use_search: bool
+    use_url_context: bool
+    max_output_tokens: Optional[int] = None
+
+
+# 従来どおりの設定 (ルーティング無効時やセッション既定の設定)
+DEFAULT_GENERATION_PROFILE = GenerationProfile(
+    "default", MODEL_NAME, "low", use_search=True, use_url_context=True
+)
+GENERATION_PROFILES = {
+    profile.name: profile
+    for profile in (
+        DEFAULT_GENERATION_PROFILE,
+        # 挨拶や相槌などの短文: ツールなし・最小思考
+        GenerationProfile(
+            "light",
+            ROUTING_LIGHT_MODEL_NAME,
+            "minimal",
+            False,
+            False,
+            max_output_tokens=2048,
+        ),
+        # 通常の雑談: 事実確認用の検索のみ
+        GenerationProfile(
+            "chat", MODEL_NAME, "low", True, False, max_output_tokens=4096
+        ),
+        # 質問・調べもの
+        GenerationProfile(
+            "research", MODEL_NAME, "low", True, False, max_output_tokens=8192
+        ),
+        # URL を含む発言
+        GenerationProfile("url", MODEL_NAME, "low", True, True, max_output_tokens=8192),
+        # 画像・音声付き
+        GenerationProfile(
+            "multimodal", MODEL_NAME, "low", False, False, max_output_tokens=4096
+        ),
+        # 定期アナウンスなど検索前提のジョブ
+        GenerationProfile(
+            "grounded", MODEL_NAME, "low", True, False, max_output_tokens=8192
+        ),
+        # 収集済みの事実をキャラクターの口調に整えるだけの描画
+        GenerationProfile(
+            "render", MODEL_NAME, "low", False, False, max_output_tokens=8192
+        ),
+    )
+}
+JOB_TYPE_PROFILES = {
+    "grounding": "grounded",
+    "weather": "render",
+    "news": "render",
+    "alcohol_review": "render",
+    "talktome": "chat",
+    "update": "light",
+    "user_profile": "light",
+}
+
+
+def select_generation_profile(
+    user_input, attachment_count=0, job_type="chat", urls_prefetched=False
+):
+    """
+    メッセージの特徴 (長さ・URL・疑問表現・添付・ジョブ種別) から生成プロファイルを選ぶ。
+    URL の本文をすべて事前取得済みなら UrlContext なしのプロファイルにする。
+    """
+    if not ROUTING_ENABLED:
+        return DEFAULT_GENERATION_PROFILE
+    if job_type != "chat":
+        return GENERATION_PROFILES[JOB_TYPE_PROFILES.get(job_type, "default")]
+
+    text = user_input or ""
+    if URL_PATTERN.search(text):
+        if urls_prefetched:
+            return GENERATION_PROFILES["research"]
+        return GENERATION_PROFILES["url"]
+    if attachment_count:
+        return GENERATION_PROFILES["multimodal"]
+    has_question = any(marker in text for marker in QUESTION_MARKERS)
+    if has_question:
+        return GENERATION_PROFILES["research"]
+    if len(text.strip()) <= ROUTING_LIGHT_MAX_CHARS:
+        return GENERATION_PROFILES["light"]
+    return GENERATION_PROFILES["chat"]
+
+
+@functools.lru_cache(maxsize=64)
+def build_generation_config(system_instruction, profile):
+    """
+    (システムプロンプト, プロファイル) ごとの設定を組み立てる。同じキャラクターを使う
+    全チャンネル・全リクエストで同じ設定オブジェクトを共有する (変更時は model_copy を使う)。
+    """
+    tools = []
+    if profile.use_search:
+        tools.append(google_search_tool)
+    if profile.use_url_context:
+        tools.append(google_url_context_tool)
+    return GenerateContentConfig(
+        response_modalities=["TEXT"],
+        system_instruction=system_instruction,
+        thinking_config=(
+            ThinkingConfig(thinking_level=profile.thinking_level)
+            if profile.model == MODEL_NAME
+            else None  # 他モデルは thinking_level 非対応の場合があるため既定値に任せる
+        ),
+        tools=tools or None,
+        max_output_tokens=profile.max_output_tokens,
+    )
+
+
+def _create_routing_log_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS routing_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        profile TEXT NOT NULL,
+        model TEXT NOT NULL,
+        latency_ms REAL NOT NULL,
+        prompt_tokens INTEGER,
+        output_tokens INTEGER,
+        thoughts_tokens INTEGER,
+        succeeded INTEGER NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+    )
+
+
+def record_routing_decision(profile, model_name, latency_seconds, response=None):
+    """プロファイル選択の結果 (レイテンシ・トークン数) をメトリクスと routing_log に記録する。"""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    thoughts_tokens = getattr(usage, "thoughts_token_count", None)
+    latency_ms = latency_seconds * 1000
+
+    increment_metric(f"routing.{profile.name}.calls")
+    observe_metric(f"routing.{profile.name}.latency_ms", latency_ms)
+    if prompt_tokens is not None:
+        observe_metric(f"routing.{profile.name}.prompt_tokens", prompt_tokens)
+    if response is None:
+        increment_metric(f"routing.{profile.name}.failures")
+    logger.info(
+        "Gemini API 呼び出し",
+        extra={
+            "event": "gemini.call",
+            "profile": profile.name,
+            "model": model_name,
+            "latency_ms": round(latency_ms, 1),
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "thoughts_tokens": thoughts_tokens,
+            "succeeded": response is not None,
+        },
+    )
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            _create_routing_log_table(cursor)
+            cursor.execute(
+                """
+            INSERT INTO routing_log
+                (profile, model, latency_ms, prompt_tokens, output_tokens, thoughts_tokens, succeeded, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    profile.name,
+                    model_name,
+                    latency_ms,
+                    prompt_tokens,
+                    output_tokens,
+                    thoughts_tokens,
+                    int(response is not None),
+                    datetime.datetime.now(),
+                ),
+            )
+    except sqlite3.Error as e:
+        logger.error(f"ルーティング記録の保存に失敗しました: {e}")
+
+
+def summarize_routing_log(days=7):
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        _create_routing_log_table(cursor)
+        cursor.execute(
+            """
+        SELECT profile, model, COUNT(*) AS calls,
+               AVG(latency_ms) AS avg_latency_ms,
+               AVG(prompt_tokens) AS avg_prompt_tokens,
+               AVG(output_tokens) AS avg_output_tokens
+        FROM routing_log
+        WHERE timestamp >= ?
+        GROUP BY profile, model
+        ORDER BY calls DESC
+        """,
+            (since,),
+        )
+        return cursor.fetchall()
+
+
+def load_character_runtime(character_key_to_load, restore_snapshot=False):
+    """
+    キャラクターのランタイムを (再) 構築してレジストリに登録する。既存のランタイムは
+    同じオブジェクトのままセッションを作り直すため、他キャラクターのセッションには触れない。
+    restore_snapshot=True の場合、有効なスナップショットがあればそこから復元し、
+    以降に書き込まれた DB 行だけを追加で読み込む。
+    """
+    system_instruction_text, initial_conversation_history, display_name = (
+        load_character_definition(character_key_to_load)
+    )
+    with _character_runtimes_lock:
+        runtime = character_runtimes.get(character_key_to_load)
+        if runtime is None:
+            runtime = character_runtimes[character_key_to_load] = CharacterRuntime(
+                character_key_to_load
+            )
+    runtime.display_name = display_name
+    runtime.system_instruction = system_instruction_text
+    runtime.initial_history = initial_conversation_history
+
+    if not system_instruction_text:
+        logger.warning(
+            f"警告: キャラクター「{character_key_to_load}」のプロンプトでセッションを開始できません。"
+        )
+        runtime.chat_session = None
+        return runtime
+
+    create_table_if_not_exists(character_key_to_load)  # DBテーブル作成
+
+    snapshot = None
+    if restore_snapshot:
+        snapshot = load_session_snapshot(character_key_to_load, system_instruction_text)
+
+    if snapshot:
+        # スナップショット (実際のモデル応答を含む履歴) + 以降の DB 行だけを再生
+        # 別名の対応が履歴と食い違わないよう、表記の状態もスナップショットから引き継ぐ
+        encoder = TurnEncoder(snapshot.get("turn_encoder"))
+        replay_rows = load_history_rows_after(
+            character_key_to_load, snapshot["last_row_id"]
+        )
+        history_from_db = snapshot["history"] + _rows_to_model_history(
+            replay_rows, encoder
+        )
+        logger.info(
+            f"スナップショットから {len(snapshot['history'])} 件の履歴を復元し、"
+            f"以降の DB 履歴 {len(replay_rows)} 件を再生しました。"
+        )
+    else:
+        # DBから履歴を読み込み
+        encoder = TurnEncoder()
+        history_from_db = load_history_from_db(
+            character_key_to_load, limit=30, encoder=encoder
+        )
+
+    # 最終的な履歴を作成: (キャラクタープロンプト + DBからの会話履歴)
+    runtime.start_session(history_from_db, encoder)
+    logger.info(
+        f"チャットセッションがキャラクター「{runtime.display_name}」とDB履歴で初期化されました。"
+    )
+    return runtime
+
+
+# --- セッションスナップショット (正常終了時に保存し、次回起動時に復元) ---
+SESSION_SNAPSHOT_VERSION = 2  # 2: 読み込み済みの全キャラクターを保存
+SESSION_SNAPSHOT_FILE = os.getenv("SESSION_SNAPSHOT_FILE", "session_snapshot.json.gz")
+SESSION_SNAPSHOT_MAX_AGE_SECONDS = float(
+    os.getenv("SESSION_SNAPSHOT_MAX_AGE_SECONDS", "86400")
+)
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS = float(
+    os.getenv("SHUTDOWN_DRAIN_TIMEOUT_SECONDS", "20")
+)
+OMITTED_ATTACHMENT_TEXT = "[添付ファイルは省略]"
+
+shutting_down = False
+in_flight_requests = 0
+
+
+@contextlib.asynccontextmanager
+async def track_in_flight():
+    """終了時にドレインを待つため、処理中のリクエスト数を数える。"""
+    global in_flight_requests
+    in_flight_requests += 1
+    try:
+        yield
+    finally:
+        in_flight_requests -= 1
+
+
+def _snapshot_path():
+    if IS_MULTI_WORKER:
+        # ワーカーごとにセッションを持つため、担当シャードごとに保存先を分ける
+        root, ext = SESSION_SNAPSHOT_FILE.split(".", 1)
+        shard_suffix = "-".join(str(shard_id) for shard_id in SHARD_IDS or [])
+        return f"{root}.shard{shard_suffix}.{ext}"
+    return SESSION_SNAPSHOT_FILE
+
+
+def _instruction_digest(system_instruction):
+    return hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest()
+
+
+def _serialize_history_for_snapshot(history):
+    """履歴をテキストのみの dict に変換する。添付データなどのバイナリは保存しない。"""
+    serialized = []
+    for content in history:
+        texts = []
+        for part in content.parts or []:
+            if part.text is not None:
+                if not part.thought:
+                    texts.append(part.text)
+            elif part.inline_data is not None:
+                texts.append(OMITTED_ATTACHMENT_TEXT)
+        serialized.append(
+            {"role": content.role, "parts": [{"text": text} for text in texts]}
+        )
+    return serialized
+
+
+def save_session_snapshot():
+    """読み込み済みの全キャラクターのセッション履歴を、圧縮したバージョン付きスナップショットとして書き出す。"""
+    with _character_runtimes_lock:
+        runtimes = [
+            runtime
+            for runtime in character_runtimes.values()
+            if runtime.chat_session is not None
+        ]
+    if not runtimes:
+        return False
+    snapshot = {
+        "version": SESSION_SNAPSHOT_VERSION,
+        "model": MODEL_NAME,
+        "saved_at": time.time(),
+        "characters": {
+            runtime.key: {
+                "instruction_digest": _instruction_digest(runtime.system_instruction),
+                "last_row_id": get_latest_history_row_id(runtime.key),
+                "history": _serialize_history_for_snapshot(
+                    runtime.chat_session.get_history(curated=True)
+                ),
+                "turn_encoder": runtime.turn_encoder.to_dict(),
+            }
+            for runtime in runtimes
+        },
+    }
+    path = _snapshot_path()
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temp_path, path)  # 書き込み途中で落ちても壊れたファイルを残さない
+    logger.info(
+        f"セッションスナップショットを保存しました: {path} ({len(runtimes)} キャラクター)"
+    )
+    return True
+
+
+_pending_snapshot_characters = (
+    None  # 読み込み済みスナップショットのうち未使用のキャラクター分
+)
+
+
+def _read_session_snapshot_file():
+    """
+    スナップショットを1度だけ読み込み、バージョン・モデル・期限を検証する。
+    読み込んだファイルは削除し、クラッシュ後に古い状態を再利用しないようにする。
+    """
+    path = _snapshot_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except Exception as e:
+        logger.error(f"セッションスナップショットの読み込みに失敗しました: {e}")
+        snapshot = None
+    finally:
+        os.remove(path)
+
+    if not snapshot:
+        return {}
+    reasons = []
+    if snapshot.get("version") != SESSION_SNAPSHOT_VERSION:
+        reasons.append("バージョン不一致")
+    if snapshot.get("model") != MODEL_NAME:
+        reasons.append("モデル不一致")
+    if time.time() - snapshot.get("saved_at", 0) > SESSION_SNAPSHOT_MAX_AGE_SECONDS:
+        reasons.append("期限切れ")
+    if reasons:
+        logger.info(
+            f"セッションスナップショットを使用しません ({'・'.join(reasons)})。"
+        )
+        return {}
+    return snapshot.get("characters") or {}
+
+
+def load_session_snapshot(character_key, system_instruction):
+    """キャラクターとシステムプロンプトが一致するスナップショットを返す (1キャラクター1回まで)。"""
+    global _pending_snapshot_characters
+    with _character_runtimes_lock:
+        if _pending_snapshot_characters is None:
+            _pending_snapshot_characters = _read_session_snapshot_file()
+        entry = _pending_snapshot_characters.pop(character_key, None)
+    if not entry:
+        return None
+    if entry.get("instruction_digest") != _instruction_digest(system_instruction):
+        logger.info(
+            f"セッションスナップショットを使用しません ({character_key}: システムプロンプト変更)。"
+        )
+        return None
+    return entry
+
+
+async def graceful_shutdown():
+    """SIGTERM 受信時: 新規受付を止め、処理中のリクエストを待ってからスナップショットを保存して終了する。"""
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    logger.info(
+        f"終了シグナルを受信しました。処理中のリクエスト {in_flight_requests} 件の完了を待ちます。"
+    )
+
+    drain_deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT_SECONDS
+    while in_flight_requests > 0 and time.monotonic() < drain_deadline:
+        await asyncio.sleep(0.2)
+    if in_flight_requests > 0:
+        logger.warning(
+            f"ドレインがタイムアウトしました (未完了 {in_flight_requests} 件)。"
+        )
+    if scheduled_job_tasks:
+        # 終わらなかった定期ジョブは中断し、cancelled (再試行しない) と記録されるのを待つ
+        for task in scheduled_job_tasks:
+            task.cancel()
+        await asyncio.wait(set(scheduled_job_tasks), timeout=5)
+
+    try:
+        await asyncio.to_thread(save_session_snapshot)
+    except Exception as e:
+        logger.error(f"セッションスナップショットの保存に失敗しました: {e}")
+    await close_url_http_session()
+    await bot.close()
+
+
+# --- 受付制御 (全体の同時実行枠・ユーザー/チャンネルごとの上限・公平なキューイング) ---
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "4"))
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "1"))
+ADMISSION_MAX_PER_CHANNEL = int(os.getenv("ADMISSION_MAX_PER_CHANNEL", "2"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "20"))
+ADMISSION_MAX_QUEUED_PER_USER = int(os.getenv("ADMISSION_MAX_QUEUED_PER_USER", "1"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+ADMISSION_BUSY_NOTICE_INTERVAL_SECONDS = float(
+    os.getenv("ADMISSION_BUSY_NOTICE_INTERVAL_SECONDS", "60")
+)  # 混雑通知自体がスパムにならないよう、チャンネルごとに間隔を空ける
+# "ユーザーID:重み" のカンマ区切り。重みが大きいほどキュー内で優先される (既定 1)
+ADMISSION_USER_WEIGHTS = {
+    int(user_id): float(weight)
+    for user_id, weight in (
+        item.split(":", 1)
+        for item in os.getenv("ADMISSION_USER_WEIGHTS", "").split(",")
+        if ":" in item
+    )
+}
+BUSY_NOTICE_TEXT = (
+    "いま混み合っているので、少し時間をおいてからもう一度話しかけてください。"
+)
+
+
+class AdmissionTicket:
+    """受付1件分の状態。status は admitted / queued / merged / shed のいずれか。"""
+
+    def __init__(self, user_id, channel_id, start_tag, finish_tag):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.status = "queued"
+        self.merged_inputs = []  # 待機中に同じユーザーから届いて合流したメッセージ
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class AdmissionController:
+    """
+    Gemini 呼び出しの同時実行数を全体・ユーザー・チャンネル単位で制限する。
+    枠が空くのを待つリクエストは重み付きの開始時刻タグ (start-time fair queueing) 順に
+    実行し、連投するユーザーが他のユーザーの順番を奪わないようにする。
+    イベントループ上からのみ呼び出す前提のためロックは持たない。
+    """
+
+    def __init__(
+        self,
+        max_in_flight,
+        max_per_user,
+        max_per_channel,
+        max_queued,
+        max_queued_per_user,
+        max_wait_seconds,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait_seconds = max_wait_seconds
+        self.in_flight = 0
+        self._user_in_flight = defaultdict(int)
+        self._channel_in_flight = defaultdict(int)
+        self._queue = []
+        self._virtual_time = 0.0
+        self._user_finish_tags = {}
+        self._last_busy_notice = {}
+        self.last_activity = time.monotonic()
+
+    def is_idle(self, idle_seconds):
+        """実行中・待機中のリクエストがなく、最後の受付から idle_seconds 以上経っているか。"""
+        return (
+            self.in_flight == 0
+            and not self._queue
+            and time.monotonic() - self.last_activity >= idle_seconds
         )
-        return
 
-    is_mentioned = bot.user.mentioned_in(message)
-    should_respond = should_respond_to_message(message)
+    @property
+    def queued(self):
+        return len(self._queue)
 
-    if not should_respond:
-        return
+    def _can_start(self, user_id, channel_id):
+        return (
+            self.in_flight < self.max_in_flight
+            and self._user_in_flight[user_id] < self.max_per_user
+            and self._channel_in_flight[channel_id] < self.max_per_channel
+        )
 
-    async with message.channel.typing():
-        attachment_contents = []
-        if message.attachments:
-            attachment_contents = await extract_supported_attachment_parts(message)
+    def _start(self, ticket):
+        self.in_flight += 1
+        self._user_in_flight[ticket.user_id] += 1
+        self._channel_in_flight[ticket.channel_id] += 1
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        ticket.status = "admitted"
+        # 仮想時刻に追い越されたタグは start_tag の計算に影響しないので捨てる
+        # (一度話しただけのユーザーの分が溜まり続けないように)
+        self._user_finish_tags = {
+            user_id: finish_tag
+            for user_id, finish_tag in self._user_finish_tags.items()
+            if finish_tag > self._virtual_time
+        }
+
+    def _dispatch(self):
+        """実行可能なキュー内のリクエストを、開始時刻タグの小さい順に開始する。"""
+        while self._queue:
+            runnable = [
+                ticket
+                for ticket in self._queue
+                if self._can_start(ticket.user_id, ticket.channel_id)
+            ]
+            if not runnable:
+                return
+            ticket = min(runnable, key=lambda t: (t.start_tag, t.finish_tag))
+            self._queue.remove(ticket)
+            self._start(ticket)
+            ticket.future.set_result(True)
+
+    async def acquire(self, user_id, channel_id, text=None):
+        """
+        実行枠を取得して AdmissionTicket を返す。待ちきれない場合や溢れた場合は
+        status="shed"、待機中の自分のメッセージに合流した場合は status="merged" になる。
+        """
+        self.last_activity = time.monotonic()
+        weight = ADMISSION_USER_WEIGHTS.get(user_id, 1.0)
+        start_tag = max(self._virtual_time, self._user_finish_tags.get(user_id, 0.0))
+        ticket = AdmissionTicket(user_id, channel_id, start_tag, start_tag + 1 / weight)
+
+        # 枠が空くたびに _dispatch するため、キューに残っているのはユーザー/チャンネルの
+        # 上限で止まっているものだけ。全体枠が空いていれば追い越して開始してよい
+        if self._can_start(user_id, channel_id):
+            self._start(ticket)
+            self._user_finish_tags[user_id] = ticket.finish_tag
+            increment_metric("admission.admitted")
+            return ticket
+
+        user_queued = [t for t in self._queue if t.user_id == user_id]
+        if len(user_queued) >= self.max_queued_per_user:
+            same_channel = [t for t in user_queued if t.channel_id == channel_id]
+            if text is not None and same_channel:
+                # 連投は待機中のリクエストにまとめ、モデル呼び出しを増やさない
+                same_channel[-1].merged_inputs.append(text)
+                ticket.status = "merged"
+                increment_metric("admission.merged")
+            else:
+                ticket.status = "shed"
+                increment_metric("admission.shed")
+                increment_metric("admission.shed_user_quota")
+            return ticket
+        if len(self._queue) >= self.max_queued:
+            ticket.status = "shed"
+            increment_metric("admission.shed")
+            increment_metric("admission.shed_queue_full")
+            return ticket
+
+        self._queue.append(ticket)
+        self._user_finish_tags[user_id] = ticket.finish_tag
+        increment_metric("admission.delayed")
+        enqueued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(ticket.future), timeout=self.max_wait_seconds
+            )
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if ticket.future.done():
+                # _dispatch で枠を割り当てた直後に呼び出し元がキャンセルされた。
+                # 呼び出し元は ticket を受け取れず release できないので、ここで枠を返す
+                self.release(ticket)
+            raise
+        finally:
+            if not ticket.future.done():
+                # タイムアウト・キャンセル時はキューから外す
+                self._queue.remove(ticket)
+                ticket.future.cancel()
+                ticket.status = "shed"
+                increment_metric("admission.shed")
+                increment_metric("admission.shed_timeout")
+        observe_metric(
+            "admission.queue_wait_ms", (time.monotonic() - enqueued_at) * 1000
+        )
+        if ticket.status == "admitted":
+            increment_metric("admission.admitted")
+        return ticket
 
-        author_name = message.author.display_name
-        user_input = build_user_input(message, is_mentioned)
-        bot_reply = await handle_shared_discord_message(
-            author_name, user_input, attachment_contents
+    def release(self, ticket):
+        if ticket.status != "admitted":
+            return
+        ticket.status = "released"
+        self.last_activity = time.monotonic()
+        self.in_flight -= 1
+        self._user_in_flight[ticket.user_id] -= 1
+        self._channel_in_flight[ticket.channel_id] -= 1
+        if not self._user_in_flight[ticket.user_id]:
+            del self._user_in_flight[ticket.user_id]
+        if not self._channel_in_flight[ticket.channel_id]:
+            del self._channel_in_flight[ticket.channel_id]
+        self._dispatch()
+        if not self.in_flight and not self._queue:
+            # 誰も待っていなければ過去の順番は公平性に関係しないので忘れる
+            self._user_finish_tags.clear()
+
+    def should_send_busy_notice(self, channel_id):
+        now = time.monotonic()
+        if (
+            now - self._last_busy_notice.get(channel_id, float("-inf"))
+            < ADMISSION_BUSY_NOTICE_INTERVAL_SECONDS
+        ):
+            return False
+        self._last_busy_notice[channel_id] = now
+        return True
+
+
+admission_controller = None
+
+
+def get_admission_controller():
+    # AdmissionTicket が Future を作るため、イベントループ上で初めて使うときに生成する
+    global admission_controller
+    if admission_controller is None:
+        admission_controller = AdmissionController(
+            ADMISSION_MAX_IN_FLIGHT,
+            ADMISSION_MAX_PER_USER,
+            ADMISSION_MAX_PER_CHANNEL,
+            ADMISSION_MAX_QUEUED,
+            ADMISSION_MAX_QUEUED_PER_USER,
+            ADMISSION_MAX_WAIT_SECONDS,
         )
+    return admission_controller
 
-        if bot_reply and bot_reply.strip():  # Ensure there's non-whitespace content
-            await message.reply(bot_reply, mention_author=False)
-        else:
-            print(
-                f"Warning: Bot generated an empty or whitespace-only reply for user input: '{user_input}'"
-            )
 
+@contextlib.asynccontextmanager
+async def admit_request(user_id, channel_id, text=None):
+    """受付制御を通してから処理する。ticket.status が admitted 以外なら呼び出し側で応答を省く。"""
+    controller = get_admission_controller()
+    ticket = await controller.acquire(user_id, channel_id, text)
+    try:
+        yield ticket
+    finally:
+        controller.release(ticket)
 
-# --- グローバルなChatSession (メモリキャッシュとして) ---
-# スクリプトが再起動されると失われるため、ファイル保存と組み合わせる
-shared_chat_session = None
-MODEL_NAME = "gemini-3-flash-preview"
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-client = genai.Client(api_key=GOOGLE_API_KEY)
-google_search_tool = Tool(google_search=GoogleSearch())
-google_url_context_tool = Tool(url_context=UrlContext())
 
+# --- Gemini API 呼び出しの信頼性制御 (デッドライン・リトライ予算・サーキットブレーカー) ---
+RETRYABLE_CLIENT_ERROR_CODES = {408, 429}
 
-DB_FILE = "chat_history.db"
+_exponential_backoff = wait_exponential(multiplier=1, min=2, max=30)
 
 
-def adapt_datetime_iso(dt_obj):
-    """datetime.datetime オブジェクトをISO 8601形式の文字列に変換するアダプタ"""
-    return dt_obj.isoformat()
+class GeminiUnavailableError(Exception):
+    """デッドライン内に Gemini から応答を得られなかったことを表す例外。"""
 
 
-def convert_iso_to_datetime(iso_str_bytes):
-    """ISO 8601形式の文字列 (bytes型) をdatetime.datetime オブジェクトに変換するコンバータ"""
-    # DBから読み取られる値はbytes型なので、適切なエンコーディングでstr型にデコードする
-    return datetime.datetime.fromisoformat(iso_str_bytes.decode("utf-8"))
+class CircuitOpenError(GeminiUnavailableError):
+    """サーキットブレーカーが開いているため呼び出しを即座に打ち切ったことを表す例外。"""
 
 
-def get_db_connection():
-    # detect_types パラメータを設定して、登録したコンバータが機能するようにする
-    conn = sqlite3.connect(
-        DB_FILE, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-    )
-    conn.row_factory = sqlite3.Row  # カラム名でアクセスできるようにする
-    return conn
+class CircuitBreaker:
+    """連続失敗でバックエンドを一定時間遮断する、モデルごとのサーキットブレーカー。"""
 
+    def __init__(self, name, failure_threshold, cooldown_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
 
-# sqlite3モジュールにアダプタを登録: Pythonのdatetime.datetime型を上記関数で変換
-sqlite3.register_adapter(datetime.datetime, adapt_datetime_iso)
+    @property
+    def state(self):
+        with self._lock:
+            return self._state_locked()
 
-# sqlite3モジュールにコンバータを登録: DBの "datetime" 型 (宣言) の値を上記関数で変換
-# "datetime" はテーブル作成時の型宣言 (TIMESTAMP や DATETIME) に対応
-sqlite3.register_converter(
-    "datetime", convert_iso_to_datetime
-)  # テーブルの型宣言に合わせる
-sqlite3.register_converter(
-    "timestamp", convert_iso_to_datetime
-)  # TIMESTAMP型も同様に扱う場合
+    def _state_locked(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown_seconds:
+            return "half_open"
+        return "open"
 
+    def before_call(self):
+        """
+        呼び出し可否を判定し、遮断中なら CircuitOpenError を送出する。
+        クールダウン明けの試験呼び出しとして通した場合は True を返す。
+        """
+        with self._lock:
+            state = self._state_locked()
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_in_progress:
+                # クールダウン明けは1件だけ試験的に通す
+                self._trial_in_progress = True
+                return True
+            raise CircuitOpenError(
+                f"サーキットブレーカー作動中のため {self.name} への呼び出しをスキップしました。"
+            )
 
-def get_history_table_name(character_key):
-    # キャラクターキーから安全なテーブル名を生成
-    # ここでは簡易的にキーのプレフィックスとするが、より厳密な検証が必要な場合がある
-    if (
-        not isinstance(character_key, str) or not character_key.isalnum()
-    ):  # 例: 英数字のみを許可
-        print(f"警告: 不正なキャラクターキーが指定されました: {character_key}")
-        # 不正なキーの場合はデフォルトやエラーを示すテーブル名を返す
-        return "history_default_invalid"
-    return f"history_{character_key}"
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def release_trial(self):
+        """成功・失敗を記録しなかった試験呼び出しを終え、次の試験呼び出しを通せるようにする。"""
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            was_trial = self._trial_in_progress
+            self._trial_in_progress = False
+            if was_trial or self._consecutive_failures >= self.failure_threshold:
+                if self._opened_at is None or was_trial:
+                    logger.error(
+                        f"サーキットブレーカー: {self.name} を {self.cooldown_seconds:.0f} 秒間遮断します"
+                        f" (連続失敗 {self._consecutive_failures} 回)。"
+                    )
+                self._opened_at = time.monotonic()
 
 
-def create_table_if_not_exists():
-    global active_character_key
+class RetryBudget:
+    """初回試行ごとにリトライ枠を積み立て、リトライ時に消費するトークンバケット。
 
-    if active_character_key is None:
-        raise ValueError(
-            "アクティブなキャラクターキーが設定されていません。テーブル名決定できません。"
-        )
+    障害時にリトライが負荷を増幅するのを防ぐため、リトライ総数を初回試行数の一定割合に抑える。
+    """
 
-    table_name = get_history_table_name(active_character_key)
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            f"""
-        CREATE TABLE IF NOT EXISTS {table_name} (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            role TEXT NOT NULL,
-            author_name TEXT,
-            content TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """
-        )
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
 
+    def try_withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
 
-def add_message_to_db(role, author_name, content):
-    global active_character_key
 
-    if active_character_key is None:
-        raise ValueError(
-            "アクティブなキャラクターキーが設定されていません。メッセージ保存できません。"
-        )
+gemini_retry_budget = RetryBudget(
+    GEMINI_RETRY_BUDGET_RATIO, GEMINI_RETRY_BUDGET_MAX_TOKENS
+)
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
 
-    table_name = get_history_table_name(active_character_key)
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            f"""
-        INSERT INTO {table_name} (role, author_name, content, timestamp)
-        VALUES (?, ?, ?, ?)
-        """,
-            (role, author_name, content, datetime.datetime.now()),
-        )
+def get_circuit_breaker(model_name):
+    with _circuit_breakers_lock:
+        if model_name not in _circuit_breakers:
+            _circuit_breakers[model_name] = CircuitBreaker(
+                model_name,
+                GEMINI_BREAKER_FAILURE_THRESHOLD,
+                GEMINI_BREAKER_COOLDOWN_SECONDS,
+            )
+        return _circuit_breakers[model_name]
 
 
-PROMPT_DIR = "character_prompts"
+def _is_retryable_gemini_error(error):
+    """一時的な障害 (5xx・レート制限・タイムアウト) かどうかを判定する。"""
+    if isinstance(error, ServerError):
+        return True
+    if isinstance(error, ClientError):
+        return error.code in RETRYABLE_CLIENT_ERROR_CODES
+    return isinstance(error, (httpx.TimeoutException, httpx.TransportError))
 
 
-def _load_raw_character_data(character_filename_key):
-    """指定されたキーのキャラクターデータをJSONファイルからそのまま読み込むヘルパー関数"""
-    prompt_file_path = os.path.join(PROMPT_DIR, f"{character_filename_key}.json")
-    if not os.path.exists(prompt_file_path):
-        print(f"警告: キャラクターデータファイルが見つかりません: {prompt_file_path}")
+def _parse_duration_seconds(value):
+    """Duration 表記 ("12s", "1.5s") や秒数文字列を秒数に変換する。解釈できなければ None。"""
+    if value is None:
         return None
+    text = str(value).strip().lower()
+    if text.endswith("s"):
+        text = text[:-1]
     try:
-        with open(prompt_file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
-    except Exception as e:
-        print(
-            f"エラー: キャラクターデータファイルの読み込み/解析に失敗 ({prompt_file_path}): {e}"
-        )
+        seconds = float(text)
+    except ValueError:
         return None
+    return seconds if seconds >= 0 else None
 
 
-def load_character_definition(main_character_key, processed_relations=None):
-    """
-    指定されたキー (ファイル名から拡張子を除いたもの) に基づいて
-    キャラクタープロンプトファイルを読み込み、初期履歴と表示名を返す。
-    """
-    if processed_relations is None:
-        processed_relations = set()
-
-    if main_character_key in processed_relations:
-        return "", [], main_character_key
-
-    processed_relations.add(main_character_key)
+def _find_retry_delay(details):
+    """エラー詳細 (google.rpc.RetryInfo) から retryDelay を再帰的に探す。"""
+    if isinstance(details, dict):
+        if "retryDelay" in details:
+            return _parse_duration_seconds(details["retryDelay"])
+        values = details.values()
+    elif isinstance(details, list):
+        values = details
+    else:
+        return None
+    for value in values:
+        found = _find_retry_delay(value)
+        if found is not None:
+            return found
+    return None
 
-    main_char_data = _load_raw_character_data(main_character_key)
-    if not main_char_data:
-        return "", [], main_character_key
 
-    display_name = main_char_data.get("character_name_display", main_character_key)
-    system_instruction_user = main_char_data.get(
-        "system_instruction_user", ""
-    )  # メインキャラの基本指示
-    # 以下は Gemini のプロンプト ベストプラクティスに沿った構造化された補助指示です。
-    system_instruction_user += (
-        "\n\n<context>キャラクター設定として上記のプロンプトを前提とする。</context>\n"
-        "<task>目的: ユーザーと自然な会話を継続し、キャラクター性（口調・動機）を一貫して守る。</task>\n"
-        "<input_format>ユーザー発言は次の形式で送られます\n発言者名\n送信時刻(ISO 8601, タイムゾーン付き・日本標準時/JSTで提供されます)\n発言内容\n画像は別のPartオブジェクトとして渡されることがある。</input_format>\n"
-        "<note>送信時刻は JST の ISO 形式で与えられます。発言内容の時間的文脈が必要な場合はこの時刻を参照してください。モデルは自身で時刻を推測せず、この提供された時刻を優先して扱ってください。</note>\n"
-        "<output_requirements>言語: 日本語。デフォルトは簡潔で直接的。必要ならユーザーが「詳しく」と要求する。出力は会話文、相手の名前を明示して応答、Discord制限: 最大2000文字。</output_requirements>\n"
-        "<constraints>'私はAI' を明示しない。差別的・違法行為助長表現禁止。\n発言者名が異なる場合は別人として扱うこと。\n文体・語彙・文長を定期的に変化させ、過度に似た導入句や決まり文句を避ける。過去の自分の発言をそのまま繰り返したり逐次的に修正するような出力を行わないこと。\n回答に必要な事実がプロンプト内にない場合は推測で断定せず、GoogleSearch を使って確認すること。\nキャラクター設定に不足している情報が必要な場合も、創作せず GoogleSearch で確認し、確認できない要素は断定しないこと。</constraints>\n"
-        "<tools>利用可能なツール: UrlContext(指定されたURLの内容を読み取る)、GoogleSearch(情報検索)。これらのツールは必要に応じて使用して正確な情報を取得してください。プロンプトや会話履歴・画像だけでは回答に必要な情報が不足している場合や、キャラクター情報の補完が必要な場合は、推測で補わず GoogleSearch を使って確認してください。ツールを使った結果はツールの出力を忠実に扱い、事実確認が取れない場合はその旨を明示してください。</tools>\n"
-        "<multi_modal>画像: Partオブジェクトを受け取る。画像に基づく記述は簡潔に、視覚的情報を補助的に扱う。</multi_modal>\n"
-        "<priority>優先順: task/constraints/output_requirements > tools > multi_modal。</priority>\n"
-        "<anchor>上記指示に基づき、以下のユーザー入力に答えてください:</anchor>\n"
-    )
+def _retry_hint_seconds(error):
+    """サーバーが提示した再試行までの待ち時間 (Retry-After / RetryInfo) を返す。"""
+    if not isinstance(error, APIError):
+        return None
+    hint = _find_retry_delay(error.details)
+    if hint is not None:
+        return hint
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        return _parse_duration_seconds(headers.get("retry-after"))
+    return None
 
-    if not system_instruction_user:
-        print(
-            f"警告: メインキャラクター「{display_name}」のプロンプト基本情報が不完全です。"
-        )
 
-    final_initial_prompts = []
-    return system_instruction_user, final_initial_prompts, display_name
+def _wait_for_gemini_retry(retry_state):
+    """指数バックオフとサーバーの再試行ヒントの長い方だけ待つ。"""
+    backoff = _exponential_backoff(retry_state)
+    hint = _retry_hint_seconds(retry_state.outcome.exception())
+    return max(backoff, hint) if hint is not None else backoff
 
 
-def get_setting_from_db(key, default_value=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)"
-        )
-        cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-        row = cursor.fetchone()
-    return row[0] if row else default_value
+def _should_retry_gemini(retry_state):
+    if not retry_state.outcome.failed:
+        return False
+    return _is_retryable_gemini_error(retry_state.outcome.exception())
 
 
-def set_setting_in_db(key, value):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)"
-        )
-        cursor.execute(
-            "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
-            (key, value),
-        )
+def _stop_at_deadline(deadline):
+    """次の待機を挟むとデッドラインを超える場合にリトライを打ち切る stop 条件。"""
 
+    def stop(retry_state):
+        return time.monotonic() + (retry_state.upcoming_sleep or 0) >= deadline
 
-def load_history_from_db(limit=100):  # 例: 直近100件のやり取りを読み込む
-    global active_character_key
+    return stop
 
-    if active_character_key is None:
-        raise ValueError(
-            "アクティブなキャラクターキーが設定されていません。履歴読み込みできません。"
-        )
 
-    table_name = get_history_table_name(active_character_key)
+def _stop_when_retry_budget_exhausted(retry_state):
+    """
+    リトライ予算から1回分を引き出し、足りなければ打ち切る stop 条件。
+    実際に再試行するときだけ消費するよう、他の stop 条件より後ろに置くこと
+    (stop_any は先頭から評価し、打ち切りが決まった時点で残りを評価しない)。
+    """
+    if gemini_retry_budget.try_withdraw():
+        return False
+    logger.warning("Gemini API: リトライ予算を使い切ったため再試行しません。")
+    return True
+
+
+def _attempt_config(config, deadline):
+    """1回の試行の HTTP タイムアウトをデッドラインまでの残り時間以下に抑えた設定を返す。"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise GeminiUnavailableError("デッドライン超過のため送信を打ち切りました。")
+    if config is None or remaining >= GEMINI_ATTEMPT_TIMEOUT_SECONDS:
+        return config  # クライアント既定の試行タイムアウトのままでよい
+    return config.model_copy(
+        update={"http_options": HttpOptions(timeout=max(1, int(remaining * 1000)))}
+    )
 
-    conn = None
-    raw_rows_from_db = []  # DBから直接読み込んだ行データ
 
+def _send_once(chat_session, contents, breaker, deadline, config=None):
+    attempt_config = _attempt_config(config, deadline)
+    is_trial = breaker.before_call()
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # timestampの降順で最新N件を取得し、それをさらに昇順に並べ替える
-        # (SQLiteではサブクエリやウィンドウ関数が使えるが、シンプルに全件取得してPython側でハンドリングも可)
-        # ここではシンプルに最新N件のメッセージを取得（userとmodelそれぞれを1件と数える）
-        cursor.execute(
-            f"""
-        SELECT role, author_name, content FROM (
-            SELECT role, author_name, content, timestamp
-            FROM {table_name}
-            ORDER BY timestamp DESC
-            LIMIT ?
-        ) ORDER BY timestamp ASC
-        """,
-            (limit,),
-        )
-        raw_rows_from_db = cursor.fetchall()
-        print(
-            f"テーブル {table_name} から {len(raw_rows_from_db)} 件の履歴をDBより読み込みました。"
-        )  # テーブル名を出力
-    except sqlite3.OperationalError as e:
-        # テーブルが存在しない場合などに発生するエラー
-        print(
-            f"情報: テーブル {table_name} が見つからないかアクセスできません。新しい履歴として扱います。エラー詳細: {e}"
-        )
-        # raw_rows_from_db は空のまま
+        response = chat_session.send_message(contents, config=attempt_config)
+        breaker.record_success()
+        if response.text is None:
+            raise Exception("Response text is None.")
+        return response
     except Exception as e:
-        print(f"DB履歴の読み込み中に予期せぬエラーが発生しました ({table_name}): {e}")
-        raw_rows_from_db = []  # 念のため空にする
-    finally:
-        if conn:
-            conn.close()
-
-    history_for_model = []
-
-    if not raw_rows_from_db:
-        print(f"DBテーブル {table_name} から読み込む有効な会話履歴はありませんでした。")
-    else:
-        # 履歴が必ず "user" メッセージから始まるように調整
-        start_index = -1
-        for i, row_data in enumerate(raw_rows_from_db):
-            if row_data["role"] == "user":
-                start_index = i
-                break
-
-        if start_index != -1:
-            # "user" メッセージが見つかった場合、そこから履歴を開始
-            effective_rows = raw_rows_from_db[start_index:]
-            if start_index > 0:
-                print(
-                    f"読み込んだDB履歴の先頭 {start_index} 件 (modelロール) をスキップし、最初のuserロールのメッセージから履歴を開始します。"
-                )
-
-            for row_data in effective_rows:
-                if row_data["role"] == "user":
-                    text_content = row_data["content"]
-                    history_for_model.append(
-                        {"role": "user", "parts": [{"text": text_content}]}
-                    )
-                else:
-                    # 過去のボット応答は逐語でモデルに渡すと自己模倣を助長するため省略またはプレースホルダを渡す
-                    history_for_model.append(
-                        {"role": "model", "parts": [{"text": "[前のボット応答は省略]"}]}
-                    )
-            print(
-                f"DBから {len(effective_rows)} 件の整形済み会話履歴をモデル入力用に準備しました。"
+        if _is_retryable_gemini_error(e):
+            breaker.record_failure()
+            logger.error(
+                f"Gemini API で一時的なエラーが発生しました ({breaker.name}): {e}"
             )
         else:
-            # 読み込んだ履歴内に "user" メッセージが見つからなかった場合
-            print(
-                f"読み込んだDB履歴 {len(raw_rows_from_db)} 件の中にuserロールのメッセージが見つからなかったため、DBからの会話履歴は使用しません。"
-            )
-
-    return history_for_model
-
+            logger.error(f"Gemini API呼び出し中に予期せぬエラーが発生しました: {e}")
+        raise
+    finally:
+        if is_trial:
+            # リトライ対象外のエラーで終わった試験呼び出しもここで解除する
+            breaker.release_trial()
 
-active_character_key = None
-active_character_display_name = (
-    "デフォルト"  # 現在のキャラクター表示名を保持するグローバル変数
-)
 
+def _send_to_model_with_retry(
+    chat_session, contents, model_name, deadline, config=None
+):
+    """デッドラインとリトライ予算の範囲で1つのモデルに送信する。"""
+    breaker = get_circuit_breaker(model_name)
+    gemini_retry_budget.deposit()
+    retrying = Retrying(
+        stop=(
+            stop_after_attempt(GEMINI_MAX_ATTEMPTS)
+            | _stop_at_deadline(deadline)
+            | _stop_when_retry_budget_exhausted
+        ),
+        wait=_wait_for_gemini_retry,
+        retry=_should_retry_gemini,
+        reraise=True,
+    )
+    return retrying(_send_once, chat_session, contents, breaker, deadline, config)
 
-def _create_chat_session(system_instruction: str = None, history: list = None):
-    """Helper function to create a new chat session."""
-    global shared_chat_session
-    if history is None:
-        history = []
 
-    chat_config = GenerateContentConfig(
-        response_modalities=["TEXT"],
-        system_instruction=system_instruction,
-        thinking_config=ThinkingConfig(thinking_level="low"),
-        tools=[google_search_tool, google_url_context_tool],
+def _send_with_alternate_model(chat_session, contents, model_name, config, deadline):
+    """chat_session の履歴を引き継いだ一時セッションで別モデルに送信し、結果を元の履歴へ記録する。"""
+    base_history = chat_session.get_history(curated=True)
+    alternate_session = get_genai_client().chats.create(
+        model=model_name, history=base_history, config=config
     )
-
-    shared_chat_session = client.chats.create(
-        model=MODEL_NAME, history=history, config=chat_config
+    response = _send_to_model_with_retry(
+        alternate_session, contents, model_name, deadline, config
     )
+    new_entries = alternate_session.get_history(curated=True)[len(base_history) :]
+    if new_entries:
+        chat_session.record_history(
+            user_input=new_entries[0],
+            model_output=new_entries[1:],
+            automatic_function_calling_history=[],
+            is_valid=True,
+        )
+    return response
 
 
-def initialize_chat_session(character_key_to_load=None):
+def _send_message_with_retry(
+    chat_session, contents, deadline=None, profile=None, system_instruction=None
+):
     """
-    ボット起動時に呼び出され、チャットセッションを初期化または復元する。
+    Gemini ChatSessionのsend_messageをリトライ付きで実行するヘルパー関数。
+    profile (GenerationProfile) を指定するとその設定で送信し、結果を routing_log に記録する。
+    system_instruction はキャラクターのシステムプロンプト (CharacterRuntime.send が渡す)。
+    deadline (time.monotonic 基準) までに応答が得られない場合やブレーカー作動中は、
+    フォールバックモデルを試し、それも失敗すれば GeminiUnavailableError を送出する。
     """
-    global shared_chat_session, active_character_key, active_character_display_name
+    if deadline is None:
+        deadline = time.monotonic() + GEMINI_REQUEST_DEADLINE_SECONDS
+    if profile is None:
+        profile = DEFAULT_GENERATION_PROFILE
+
+    started_at = time.monotonic()
+    response = None
+    model_used = profile.model
+    try:
+        response, model_used = _send_with_profile(
+            chat_session,
+            contents,
+            profile,
+            deadline,
+            system_instruction,
+        )
+        return response
+    finally:
+        record_routing_decision(
+            profile, model_used, time.monotonic() - started_at, response
+        )
 
-    if character_key_to_load is None:
-        character_key_to_load = get_setting_from_db("current_character_key", "lycaon")
 
-    system_instruction_text, initial_conversation_history, display_name = (
-        load_character_definition(character_key_to_load)
-    )
-    active_character_key = character_key_to_load
-    active_character_display_name = display_name  # グローバルな表示名を更新
+_session_locks = weakref.WeakKeyDictionary()
 
-    if not system_instruction_text:
-        print(
-            f"警告: キャラクター「{character_key_to_load}」のプロンプトでセッションを開始できません。"
-        )
-        shared_chat_session = None
-        return
 
-    create_table_if_not_exists()  # DBテーブル作成
+async def send_message_async(chat_session, contents, **kwargs):
+    """
+    _send_message_with_retry をワーカースレッドで実行し、イベントループを塞がないようにする。
+    同じセッションへの送信は履歴の整合性を保つため1件ずつ直列化する。
+    """
+    lock = _session_locks.get(chat_session)
+    if lock is None:
+        lock = _session_locks[chat_session] = asyncio.Lock()
+    async with lock:
+        if callable(contents):
+            # ロック取得後でないと決められない入力 (発言の見出しなど) はここで組み立てる
+            contents = contents()
+        return await asyncio.to_thread(
+            _send_message_with_retry, chat_session, contents, **kwargs
+        )
 
-    # DBから履歴を読み込み
-    history_from_db = load_history_from_db(limit=30)
 
-    # 最終的な履歴を作成: (キャラクタープロンプト + DBからの会話履歴)
-    final_history_for_session = initial_conversation_history + history_from_db
-    _create_chat_session(
-        system_instruction=system_instruction_text, history=final_history_for_session
-    )
-    set_setting_in_db(
-        "current_character_key", character_key_to_load
-    )  # 現在のキャラをDBに保存
-    print(
-        f"チャットセッションがキャラクター「{active_character_display_name}」とDB履歴で初期化されました。"
-    )
+async def record_exchange_async(chat_session, user_text, model_text):
+    """別セッションで生成したやり取りを chat_session の履歴に追記する (送信と同じロックで直列化)。"""
+    lock = _session_locks.get(chat_session)
+    if lock is None:
+        lock = _session_locks[chat_session] = asyncio.Lock()
+    async with lock:
+        if callable(user_text):
+            user_text = user_text()
+        chat_session.record_history(
+            user_input=Content(role="user", parts=[Part.from_text(text=user_text)]),
+            model_output=[
+                Content(role="model", parts=[Part.from_text(text=model_text)])
+            ],
+            automatic_function_calling_history=[],
+            is_valid=True,
+        )
 
 
-# Gemini API呼び出しにリトライを適用するヘルパー関数
-@retry(
-    stop=stop_after_attempt(5),  # 最大5回試行 (初回 + 4回リトライ)
-    wait=wait_exponential(
-        multiplier=1, min=4, max=30
-    ),  # 最小4秒、その後8秒、16秒と指数関数的に増加し、最大30秒まで待機
-)
-def _send_message_with_retry(chat_session, contents):
-    """
-    Gemini ChatSessionのsend_messageをリトライ付きで実行するヘルパー関数。
-    """
-    # print("Gemini APIにメッセージを送信中...")
+def _send_with_profile(chat_session, contents, profile, deadline, system_instruction):
+    config = build_generation_config(system_instruction, profile)
     try:
-        response = chat_session.send_message(contents)
-        # print("Gemini APIからの応答を受信しました。")
-        if response.text is None:
-            raise Exception("Response text is None.")
-        return response
-    except ServerError as e:
-        print(
-            f"Gemini APIでServiceUnavailableエラーが発生しました。リトライします: {e}"
+        if profile.model == MODEL_NAME:
+            response = _send_to_model_with_retry(
+                chat_session, contents, MODEL_NAME, deadline, config
+            )
+        else:
+            response = _send_with_alternate_model(
+                chat_session, contents, profile.model, config, deadline
+            )
+        return response, profile.model
+    except Exception as e:
+        if not (isinstance(e, CircuitOpenError) or _is_retryable_gemini_error(e)):
+            raise
+        primary_error = e
+
+    if not GEMINI_FALLBACK_MODEL_NAME or GEMINI_FALLBACK_MODEL_NAME == profile.model:
+        raise GeminiUnavailableError(str(primary_error)) from primary_error
+    if deadline - time.monotonic() < GEMINI_FALLBACK_MIN_SECONDS:
+        raise GeminiUnavailableError(
+            f"デッドラインまでの残り時間が少ないため応答を打ち切りました: {primary_error}"
+        ) from primary_error
+
+    logger.warning(
+        f"Gemini API: {profile.model} が利用できないため {GEMINI_FALLBACK_MODEL_NAME} にフォールバックします: {primary_error}"
+    )
+    increment_metric("gemini.fallbacks")
+    # フォールバックモデルは thinking_level に対応していない場合があるため既定値に任せる
+    fallback_config = config.model_copy(update={"thinking_config": None})
+    try:
+        response = _send_with_alternate_model(
+            chat_session,
+            contents,
+            GEMINI_FALLBACK_MODEL_NAME,
+            fallback_config,
+            deadline,
         )
-        raise  # tenacityがこの例外を捕捉してリトライを処理します
+        return response, GEMINI_FALLBACK_MODEL_NAME
     except Exception as e:
-        print(f"Gemini API呼び出し中に予期せぬエラーが発生しました: {e}")
-        raise  # その他のエラーはリトライせずそのまま送出
-
-    # より簡潔な形式でも良い: "%Y/%m/%d %H:%M"
+        if isinstance(e, CircuitOpenError) or _is_retryable_gemini_error(e):
+            raise GeminiUnavailableError(str(e)) from e
+        raise
 
 
 async def handle_shared_discord_message(
-    author_name, user_message_content, attachment_contents=None
+    runtime,
+    author_name,
+    user_message_content,
+    attachment_contents=None,
+    profile=None,
+    guild_id=None,
+    author_id=None,
 ):
     """
     Discordのメッセージを受け取り、Gemini APIに応答を生成させる (共有・効率化版)
+    runtime はチャンネルに割り当てられたキャラクターの CharacterRuntime。
+    guild_id は発言のあったサーバー (DM は None)、author_id は発言者のユーザーIDで、履歴に一緒に保存する。
     """
-    global shared_chat_session, active_character_key
-
-    if not shared_chat_session:
+    if not runtime.chat_session:
         # ボット起動時に初期化されているはずだが、念のため
-        print("エラー: チャットセッションが初期化されていません。")
-        initialize_chat_session()  # 強制的に初期化を試みる（本番では on_ready で行うべき）
-        if not shared_chat_session:
+        logger.error("エラー: チャットセッションが初期化されていません。")
+        await asyncio.to_thread(
+            load_character_runtime, runtime.key
+        )  # 強制的に初期化を試みる
+        if not runtime.chat_session:
             return "申し訳ありません、ボットのチャット機能が正しく起動していません。管理者にご連絡ください。"
 
-    # 送信時刻 (ローカルタイム、タイムゾーン付き ISO 8601)
-    # 送信時刻を日本標準時(JST)で取得してISO 8601形式で送る
-    send_time_iso = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
-    original_message_for_api = f"{author_name}\n{send_time_iso}\n{user_message_content}"
-    print(original_message_for_api)
+    # 発言者・送信時刻の見出しは runtime.send(speaker=...) が turn_encoder で簡潔に付ける
+    logger.info(
+        "メッセージを受信しました",
+        extra={
+            "event": "message.received",
+            "character": runtime.key,
+            "author": author_name,
+            "chars": len(user_message_content),
+        },
+    )
 
     try:
         MAX_HISTORY_LENGTH = 60  # 履歴内の最大メッセージ数 (初期プロンプト + 会話)
 
         # Chatオブジェクトから現在の履歴を取得 (curated=True でモデルに送信される履歴を取得)
-        current_history_list = shared_chat_session.get_history(curated=True)
+        current_history_list = runtime.chat_session.get_history(curated=True)
 
         if len(current_history_list) > MAX_HISTORY_LENGTH:
-            print(
+            logger.info(
                 f"現在の履歴長 ({len(current_history_list)}) が最大長 ({MAX_HISTORY_LENGTH}) を超えたため、履歴を整理します。"
             )
 
-            initialize_chat_session(active_character_key)
+            await asyncio.to_thread(load_character_runtime, runtime.key)
 
     except Exception as e:
-        print(f"履歴の整理中にエラーが発生しました: {e}")
+        logger.error(f"履歴の整理中にエラーが発生しました: {e}")
         # 致命的ではないかもしれないので、処理を続行する。エラーメッセージを返すことも検討。
 
     # --- Gemini APIへの送信と応答長チェック ---
-    first_api_call_contents = [original_message_for_api]
+    first_api_call_contents = [user_message_content]
     if attachment_contents:
         for attachment_part in attachment_contents:
             first_api_call_contents.append(attachment_part)
 
     MAX_ATTEMPTS_FOR_LENGTH = 3  # 初回試行 + 2回の短縮試行
     bot_response_text = ""
+    # 短縮のための再送信も含めて1つのデッドラインを共有し、最悪応答時間を抑える
+    deadline = time.monotonic() + GEMINI_REQUEST_DEADLINE_SECONDS
 
     for attempt in range(MAX_ATTEMPTS_FOR_LENGTH):
         current_api_call_input_parts: list
+        speaker = None
 
         if attempt == 0:
             current_api_call_input_parts = first_api_call_contents
+            speaker = author_name
         else:
             # 応答が長すぎたため再試行
             shortening_prompt_text = "あなたの直前の応答はDiscordの文字数制限(2000文字)を超過しました。内容を維持しつつ、2000文字以内で簡潔に言い直してください。"
-            print(
+            logger.info(
                 f"応答短縮を要求します (試行 {attempt + 1}/{MAX_ATTEMPTS_FOR_LENGTH}): {shortening_prompt_text}"
             )
             current_api_call_input_parts = [shortening_prompt_text]
 
         try:
-            # APIに送信。shared_chat_session.historyはこの呼び出しによって更新される
+            # APIに送信。runtime.chat_session の履歴はこの呼び出しによって更新される
             # (入力内容が'user'として、応答内容が'model'として追加される)
-            response = _send_message_with_retry(
-                shared_chat_session, current_api_call_input_parts
+            response = await runtime.send(
+                current_api_call_input_parts,
+                speaker=speaker,
+                deadline=deadline,
+                profile=profile,
             )
             bot_response_text = response.text
 
             if len(bot_response_text) <= MAX_DISCORD_MESSAGE_LENGTH:
                 # 応答が適切な長さであれば、DBに保存して返す
-                add_message_to_db(
+                await asyncio.to_thread(
+                    add_message_to_db,
+                    runtime.key,
                     role="user",
                     author_name=author_name,
-                    content=original_message_for_api,
+                    content=user_message_content,
+                    guild_id=guild_id,
+                    author_id=author_id,
+                )
+                await asyncio.to_thread(
+                    add_message_to_db,
+                    runtime.key,
+                    role="model",
+                    author_name="bot",
+                    content=bot_response_text,
+                    guild_id=guild_id,
                 )
-                add_message_to_db(
-                    role="model", author_name="bot", content=bot_response_text
+                logger.info(
+                    "Geminiから応答を受け取りました",
+                    extra={
+                        "event": "gemini.reply",
+                        "character": runtime.key,
+                        "attempt": attempt + 1,
+                        "chars": len(bot_response_text),
+                    },
                 )
-                print(
-                    f"Geminiからの応答（試行 {attempt + 1}）: {bot_response_text[:200]}..."
-                )  # ログには一部表示
                 return bot_response_text
             else:
                 # 応答が長すぎる場合
-                print(
+                logger.warning(
                     f"Geminiの応答が長すぎます ({len(bot_response_text)}文字)。試行 {attempt + 1}/{MAX_ATTEMPTS_FOR_LENGTH}。"
                 )
                 # 長すぎた応答はDBには保存しない。ループが継続すれば短縮が試みられる。
@@ -1111,8 +6239,13 @@ async def handle_shared_discord_message(
                     # これが最後の試行でも長すぎた場合
                     break  # ループを抜けて最終処理へ
 
+        except GeminiUnavailableError as e:  # デッドライン超過・ブレーカー作動中
+            logger.info(
+                f"Gemini APIから期限内に応答を得られませんでした（試行 {attempt + 1}）：{e}"
+            )
+            return "いま応答を生成できない状態です。しばらくしてからもう一度お試しください。"
         except ServerError as e:  # _send_message_with_retry がリトライを諦めた場合
-            print(
+            logger.error(
                 f"Gemini APIでサーバーエラーが発生しました（試行 {attempt + 1}）：{e}"
             )
             if attempt == MAX_ATTEMPTS_FOR_LENGTH - 1:  # 最後の試行でのエラー
@@ -1121,22 +6254,26 @@ async def handle_shared_discord_message(
             # ServerErrorがここまで来たということは、_send_message_with_retry内のリトライが尽きたということ。
             return "Gemini APIとの通信中にエラーが発生しました。"  # ここで終了させる
         except Exception as e:  # その他の予期せぬエラー
-            print(
+            logger.error(
                 f"メッセージ処理中に予期せぬエラーが発生しました（試行 {attempt + 1}）：{e}"
             )
             return "メッセージの処理中に予期せぬエラーが発生しました。"
 
     # ループが完了しても適切な長さの応答が得られなかった場合
     if len(bot_response_text) > MAX_DISCORD_MESSAGE_LENGTH:
-        print(
+        logger.warning(
             f"Geminiの応答は、{MAX_ATTEMPTS_FOR_LENGTH}回の試行後も長すぎます。最終応答長: {len(bot_response_text)}"
         )
         # この長すぎた最終応答はDBには保存しない。セッション履歴には残っている。
         return "エラー、回答できませんでした。"
 
     # 通常ここには到達しないはずだが、万が一のためのフォールバック
-    print("予期せぬ状態で応答生成が終了しました。")
+    logger.info("予期せぬ状態で応答生成が終了しました。")
     return "予期せぬエラーにより応答を生成できませんでした。"
 
 
-bot.run(TOKEN)
+if __name__ == "__main__":
+    if SHARD_MODE == "coordinator":
+        run_shard_coordinator()
+    else:
+        bot.run(TOKEN, log_handler=None)  # discord.py のログも同じパイプラインに流す
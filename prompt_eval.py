@@ -0,0 +1,367 @@
+"""
+キャラクター定義のプロンプト回帰・トークンコスト評価ツール (オフライン CLI)。
+
+bot.py と同じ組み立て (load_character_definition / TurnEncoder / select_generation_profile /
+build_generation_config) で各キャラクターの最終的なシステムプロンプトを作り、固定のサンプル発言
+(prompt_eval_corpus.json) をバックエンドに送って、保存済みのベースラインとの差分を表示する。
+
+使用例:
+    python prompt_eval.py                      # スタブで評価してベースラインと比較
+    python prompt_eval.py --save-baseline      # 現在の結果をベースラインとして保存
+    python prompt_eval.py --backend gemini -c ryo,kikuri --batch-size 4
+    python prompt_eval.py --fail-threshold 5   # 入力トークンが 5% 超増えたら終了コード 1
+
+スタブのトークン数は文字種からの概算、レイテンシはトークン数からの概算で、実際の API は呼ばない。
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+# bot.py は相対パス (character_prompts/ など) を前提にしているため、リポジトリ直下で読み込む
+INVOKED_FROM = os.getcwd()  # コマンドラインで渡されたパスはここからの相対パスとして扱う
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(REPO_DIR)
+os.environ.setdefault("LOG_LEVEL", "WARNING")  # 評価結果の表示にボットのログを混ぜない
+
+import bot  # noqa: E402
+
+DEFAULT_CORPUS_FILE = os.path.join(REPO_DIR, "prompt_eval_corpus.json")
+DEFAULT_BASELINE_FILE = os.path.join(REPO_DIR, "prompt_eval_baseline.json")
+EVAL_SENT_AT = datetime.datetime(
+    2025, 1, 1, 12, 0, tzinfo=bot.JST
+)  # 見出しの時刻を固定して結果を再現可能にする
+
+# スタブのレイテンシ概算 (ミリ秒)。実測ではなくトークン数の増減を時間に換算した目安
+STUB_BASE_LATENCY_MS = 300.0
+STUB_MS_PER_PROMPT_TOKEN = 0.05
+STUB_MS_PER_OUTPUT_TOKEN = 8.0
+
+REPORTED_METRICS = (
+    ("instruction_chars", "指示文字"),
+    ("instruction_tokens", "指示tok"),
+    ("prompt_tokens", "入力tok"),
+    ("output_tokens", "出力tok"),
+    ("latency_ms", "遅延ms"),
+    ("response_chars", "応答文字"),
+)
+
+
+def estimate_tokens(text):
+    """文字種からのトークン数の概算 (ASCII は4文字で1トークン、それ以外は1文字1トークン)。"""
+    text = text or ""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _history_text(history):
+    return "\n".join(
+        part.get("text", "") for entry in history for part in entry.get("parts", [])
+    )
+
+
+@dataclass
+class TurnResult:
+    character: str
+    turn_id: str
+    profile: str
+    prompt_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    latency_ms: Optional[float] = None
+    response_chars: Optional[int] = None
+    error: Optional[str] = None
+
+
+class StubBackend:
+    """API を呼ばずに、入力の大きさから決定的な結果を返すバックエンド。"""
+
+    name = "stub"
+
+    def count_tokens(self, text):
+        return estimate_tokens(text)
+
+    def generate(self, system_instruction, history, contents, profile):
+        prompt_tokens = (
+            estimate_tokens(system_instruction)
+            + estimate_tokens(_history_text(history))
+            + estimate_tokens(contents)
+        )
+        reply = (
+            f"{contents.splitlines()[-1][:60]}…について、{profile.name} で応答します。"
+        )
+        output_tokens = estimate_tokens(reply)
+        latency_ms = (
+            STUB_BASE_LATENCY_MS
+            + prompt_tokens * STUB_MS_PER_PROMPT_TOKEN
+            + output_tokens * STUB_MS_PER_OUTPUT_TOKEN
+        )
+        return prompt_tokens, output_tokens, latency_ms, reply
+
+
+class GeminiBackend:
+    """本番と同じ生成設定で Gemini API を呼ぶバックエンド (GOOGLE_API_KEY が必要)。"""
+
+    name = "gemini"
+
+    def __init__(self):
+        if not bot.GOOGLE_API_KEY:
+            raise RuntimeError("GOOGLE_API_KEY が設定されていません。")
+        self.client = bot.get_genai_client()
+
+    def count_tokens(self, text):
+        return self.client.models.count_tokens(
+            model=bot.MODEL_NAME, contents=text
+        ).total_tokens
+
+    def generate(self, system_instruction, history, contents, profile):
+        chat = self.client.chats.create(
+            model=profile.model,
+            history=history,
+            config=bot.build_generation_config(system_instruction, profile),
+        )
+        started_at = time.monotonic()
+        response = chat.send_message(contents)
+        latency_ms = (time.monotonic() - started_at) * 1000
+        usage = response.usage_metadata
+        return (
+            getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None),
+            latency_ms,
+            response.text or "",
+        )
+
+
+BACKENDS = {"stub": StubBackend, "gemini": GeminiBackend}
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("turns", [])
+
+
+def assemble_characters(character_keys):
+    """各キャラクターの最終的なシステムプロンプトと初期履歴を bot.py と同じ手順で組み立てる。"""
+    characters = {}
+    for key in character_keys:
+        system_instruction, initial_history, display_name = (
+            bot.load_character_definition(key)
+        )
+        if not system_instruction:
+            print(f"警告: {key} のシステムプロンプトを組み立てられませんでした。")
+            continue
+        characters[key] = {
+            "display_name": display_name,
+            "system_instruction": system_instruction,
+            "initial_history": initial_history,
+        }
+    return characters
+
+
+def run_turn(backend, character_key, character, turn):
+    encoder = bot.TurnEncoder()
+    contents = encoder.encode(turn.get("author", "user"), turn["text"], EVAL_SENT_AT)
+    profile = bot.select_generation_profile(
+        turn["text"], job_type=turn.get("job_type", "chat")
+    )
+    result = TurnResult(character_key, turn["id"], profile.name)
+    try:
+        prompt_tokens, output_tokens, latency_ms, reply = backend.generate(
+            character["system_instruction"],
+            character["initial_history"],
+            contents,
+            profile,
+        )
+    except Exception as e:
+        result.error = str(e)
+        return result
+    result.prompt_tokens = prompt_tokens
+    result.output_tokens = output_tokens
+    result.latency_ms = round(latency_ms, 1)
+    result.response_chars = len(reply)
+    return result
+
+
+def run_corpus(backend, characters, turns, batch_size):
+    """(キャラクター, 発言) の組を batch_size 件ずつ並列に実行する。"""
+    tasks = [
+        (key, character, turn)
+        for key, character in characters.items()
+        for turn in turns
+    ]
+    results = []
+    with ThreadPoolExecutor(max_workers=batch_size) as pool:
+        for start in range(0, len(tasks), batch_size):
+            batch = tasks[start : start + batch_size]
+            results.extend(pool.map(lambda task: run_turn(backend, *task), batch))
+    return results
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return round(statistics.fmean(values), 1) if values else None
+
+
+def summarize(backend, characters, results):
+    summary = {}
+    for key, character in characters.items():
+        turn_results = [result for result in results if result.character == key]
+        summary[key] = {
+            "instruction_chars": len(character["system_instruction"]),
+            "instruction_tokens": backend.count_tokens(character["system_instruction"]),
+            "prompt_tokens": _mean(r.prompt_tokens for r in turn_results),
+            "output_tokens": _mean(r.output_tokens for r in turn_results),
+            "latency_ms": _mean(r.latency_ms for r in turn_results),
+            "response_chars": _mean(r.response_chars for r in turn_results),
+            "errors": sum(1 for r in turn_results if r.error),
+        }
+    return summary
+
+
+def _format_delta(current, previous):
+    if current is None:
+        return "-"
+    if previous is None:
+        return f"{current:g}"
+    delta = current - previous
+    percent = f" {delta / previous * 100:+.1f}%" if previous else ""
+    return f"{current:g} ({delta:+g}{percent})"
+
+
+def format_report(summary, baseline):
+    baseline_characters = (baseline or {}).get("characters", {})
+    lines = []
+    for key, values in summary.items():
+        previous = baseline_characters.get(key, {})
+        cells = [
+            f"{label}={_format_delta(values[metric], previous.get(metric))}"
+            for metric, label in REPORTED_METRICS
+        ]
+        marker = "" if key in baseline_characters or not baseline else " [新規]"
+        errors = f" エラー={values['errors']}" if values["errors"] else ""
+        lines.append(f"{key}{marker}: " + "  ".join(cells) + errors)
+    for key in sorted(set(baseline_characters) - set(summary)):
+        lines.append(f"{key}: [ベースラインのみ]")
+    return "\n".join(lines)
+
+
+def find_regressions(summary, baseline, threshold_percent):
+    """入力トークン (システムプロンプト込み) の平均が閾値を超えて増えたキャラクター。"""
+    regressions = []
+    for key, values in summary.items():
+        previous = (baseline or {}).get("characters", {}).get(key, {})
+        before, after = previous.get("prompt_tokens"), values["prompt_tokens"]
+        if before and after and (after - before) / before * 100 > threshold_percent:
+            regressions.append(key)
+    return regressions
+
+
+def _user_path(path):
+    return os.path.join(INVOKED_FROM, path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="キャラクター定義ごとのトークン数・レイテンシ・応答長をベースラインと比較します。"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS) + ["auto"],
+        default="auto",
+        help="auto は GOOGLE_API_KEY があれば gemini、なければ stub",
+    )
+    parser.add_argument(
+        "-c", "--characters", help="評価するキャラクター (カンマ区切り、既定は全員)"
+    )
+    parser.add_argument("--corpus", type=_user_path, default=DEFAULT_CORPUS_FILE)
+    parser.add_argument("--baseline", type=_user_path, default=DEFAULT_BASELINE_FILE)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="今回の結果をベースラインに保存"
+    )
+    parser.add_argument("--batch-size", type=int, default=4, help="並列に送る発言数")
+    parser.add_argument(
+        "--json", dest="json_path", type=_user_path, help="発言ごとの結果の出力先"
+    )
+    parser.add_argument(
+        "--fail-threshold",
+        type=float,
+        help="入力トークンの平均がこの割合 (%%) を超えて増えたら終了コード 1",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    backend_name = args.backend
+    if backend_name == "auto":
+        backend_name = "gemini" if bot.GOOGLE_API_KEY else "stub"
+    backend = BACKENDS[backend_name]()
+
+    character_keys = (
+        [key.strip() for key in args.characters.split(",") if key.strip()]
+        if args.characters
+        else bot.list_available_character_keys()
+    )
+    characters = assemble_characters(character_keys)
+    turns = load_corpus(args.corpus)
+    results = run_corpus(backend, characters, turns, max(1, args.batch_size))
+    summary = summarize(backend, characters, results)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("backend") != backend.name:
+            print(
+                f"警告: ベースラインは {baseline.get('backend')} バックエンドの結果です"
+                f" (今回は {backend.name})。"
+            )
+
+    print(
+        f"バックエンド: {backend.name} / モデル: {bot.MODEL_NAME} / "
+        f"{len(characters)} キャラクター × {len(turns)} 発言"
+    )
+    print(format_report(summary, baseline))
+    for result in results:
+        if result.error:
+            print(f"エラー: {result.character}/{result.turn_id}: {result.error}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(
+                [asdict(result) for result in results], f, ensure_ascii=False, indent=2
+            )
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "created_at": datetime.datetime.now(bot.JST).isoformat(),
+                    "backend": backend.name,
+                    "model": bot.MODEL_NAME,
+                    "characters": summary,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"ベースラインを保存しました: {args.baseline}")
+
+    if args.fail_threshold is not None and baseline:
+        regressions = find_regressions(summary, baseline, args.fail_threshold)
+        if regressions:
+            print(
+                f"入力トークンが {args.fail_threshold}% を超えて増加: {', '.join(regressions)}"
+            )
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())